@@ -1,56 +1,284 @@
+import io
+import json
 import sqlite3
+import time
 
 import flask
 from flask import Flask
 
 import advisor_lib
 import git_utils
+import metrics
+import retention
 
 advisor_blueprint = flask.Blueprint("advisor", __name__)
 
 
+# How often, in SQLite virtual machine instructions, queries check whether the
+# request they are running for has timed out.
+_TIMEOUT_CHECK_INSTRUCTIONS = 10000
+
+
+@advisor_blueprint.before_request
+def _set_request_deadline():
+    request_timeout_seconds = flask.current_app.config["REQUEST_TIMEOUT_SECONDS"]
+    if request_timeout_seconds is not None:
+        flask.g.request_deadline = time.monotonic() + request_timeout_seconds
+
+
+def _get_remaining_seconds() -> float | None:
+    if "request_deadline" not in flask.g:
+        return None
+    return max(flask.g.request_deadline - time.monotonic(), 0)
+
+
+def _request_timed_out() -> bool:
+    return _get_remaining_seconds() == 0
+
+
 def _get_db():
     if "db" not in flask.g:
-        flask.g.db = advisor_lib.setup_db(flask.current_app.config["DB_PATH"])
+        flask.g.db = flask.current_app.config["DB_POOL"].acquire_read_connection(
+            _get_remaining_seconds()
+        )
+        if "request_deadline" in flask.g:
+            # Interrupt queries that run past the deadline of the request.
+            flask.g.db.set_progress_handler(
+                _request_timed_out, _TIMEOUT_CHECK_INSTRUCTIONS
+            )
     return flask.g.db
 
 
 def _close_db(exception):
     db = flask.g.pop("db", None)
     if db is not None:
-        db.close()
+        db.set_progress_handler(None, 0)
+        flask.current_app.config["DB_POOL"].release_read_connection(db)
+
+
+def _get_index_wait_timeout_seconds() -> float:
+    remaining_seconds = _get_remaining_seconds()
+    if remaining_seconds is None:
+        return git_utils.DEFAULT_INDEX_WAIT_TIMEOUT_SECONDS
+    return min(remaining_seconds, git_utils.DEFAULT_INDEX_WAIT_TIMEOUT_SECONDS)
+
+
+def _get_commit_index(commit_sha: str) -> int | None:
+    return git_utils.get_commit_index(
+        commit_sha,
+        _get_db(),
+        flask.current_app.config["COMMIT_INDEXER"],
+        _get_index_wait_timeout_seconds(),
+    )
+
+
+@advisor_blueprint.errorhandler(TimeoutError)
+def _handle_timeout(error):
+    return flask.Response(str(error), status=503)
+
+
+@advisor_blueprint.errorhandler(sqlite3.OperationalError)
+def _handle_interrupted_query(error):
+    if not _request_timed_out():
+        raise error
+    return flask.Response("Timed out running database queries.", status=503)
 
 
 @advisor_blueprint.route("/upload", methods=["POST"])
 def upload():
-    advisor_lib.upload_failures(
-        flask.request.json, _get_db(), flask.current_app.config["REPO_PATH"]
-    )
+    # Look up the commit index before taking the write connection, as the
+    # commit indexer needs it to make progress.
+    base_commit_index = _get_commit_index(flask.request.json["base_commit_sha"])
+    with flask.current_app.config["DB_POOL"].write_connection(
+        _get_remaining_seconds()
+    ) as db:
+        advisor_lib.upload_failures(
+            flask.request.json,
+            db,
+            base_commit_index,
+            flask.current_app.config["EXPLAIN_CACHE"],
+        )
     return flask.Response(status=204)
 
 
+@advisor_blueprint.route("/upload_batch", methods=["POST"])
+def upload_batch():
+    # The body is newline delimited JSON with one FailureUpload per line. Read
+    # it line by line rather than decoding it as a single document. The raw
+    # request stream reads lines a byte at a time, so buffer it.
+    record_statuses = []
+    failure_infos = []
+    for line_number, line in enumerate(
+        io.BufferedReader(flask.request.stream), start=1
+    ):
+        if not line.strip():
+            continue
+        try:
+            failure_info = json.loads(line)
+        except ValueError as decode_error:
+            error = f"Invalid JSON: {decode_error}"
+        else:
+            error = advisor_lib.validate_failure_upload(failure_info)
+        if error is not None:
+            record_statuses.append(
+                {"line": line_number, "status": "error", "error": error}
+            )
+            continue
+        record_statuses.append({"line": line_number, "status": "uploaded"})
+        failure_infos.append((failure_info, record_statuses[-1]))
+
+    # Resolve every distinct base commit once, before taking the write
+    # connection, as the commit indexer needs it to make progress.
+    base_commit_indices = git_utils.get_commit_indices(
+        [failure_info["base_commit_sha"] for failure_info, _ in failure_infos],
+        _get_db(),
+        flask.current_app.config["COMMIT_INDEXER"],
+        _get_index_wait_timeout_seconds(),
+    )
+    for failure_info, record_status in failure_infos:
+        record_status["base_commit_index"] = base_commit_indices[
+            failure_info["base_commit_sha"]
+        ]
+    with flask.current_app.config["DB_POOL"].write_connection(
+        _get_remaining_seconds()
+    ) as db:
+        uploaded_failures = advisor_lib.upload_failure_batch(
+            [failure_info for failure_info, _ in failure_infos],
+            db,
+            base_commit_indices,
+            flask.current_app.config["EXPLAIN_CACHE"],
+        )
+    return {"uploaded_failures": uploaded_failures, "records": record_statuses}
+
+
 @advisor_blueprint.route("/explain")
 def explain():
     return advisor_lib.explain_failures(
         flask.request.json,
-        flask.current_app.config["REPO_PATH"],
+        _get_commit_index(flask.request.json["base_commit_sha"]),
         _get_db(),
-        flask.current_app.config["DEBUG_FOLDER"],
+        flask.current_app.config["EXPLANATION_LOGGER"],
+        flask.current_app.config["EXPLAIN_CACHE"],
+    )
+
+
+@advisor_blueprint.route("/ready")
+def ready():
+    # Explanations for failures on commits that have not been indexed yet are
+    # less accurate, so only take traffic once the indexer has caught up.
+    commit_indexer_ready = flask.current_app.config["COMMIT_INDEXER"].ready
+    return {"commit_indexer_ready": commit_indexer_ready}, (
+        200 if commit_indexer_ready else 503
     )
 
 
+@advisor_blueprint.route("/metrics")
+def export_metrics():
+    rendered_metrics, content_type = metrics.render()
+    return flask.Response(rendered_metrics, content_type=content_type)
+
+
 @advisor_blueprint.route("/flaky_tests")
 def flaky_tests():
     return advisor_lib.get_flaky_tests(_get_db())
 
 
-def create_app(db_path: str, repository_path: str, debug_folder: str):
+def _record_request_start():
+    flask.g.request_start_time = time.perf_counter()
+
+
+def _record_request_duration(response: flask.Response) -> flask.Response:
+    if "request_start_time" in flask.g:
+        url_rule = flask.request.url_rule
+        metrics.REQUEST_SECONDS.labels(
+            url_rule.rule if url_rule is not None else "unmatched",
+            flask.request.method,
+            response.status_code,
+        ).observe(time.perf_counter() - flask.g.request_start_time)
+    return response
+
+
+def create_app(
+    db_path: str,
+    repository_path: str,
+    debug_folder: str | None,
+    max_read_connections: int = 16,
+    fetch_interval_seconds: float = 60,
+    debug_sample_rate: float = 1.0,
+    retention_commits: int | None = None,
+    retention_archive_path: str | None = None,
+    request_timeout_seconds: float | None = None,
+    explain_cache_max_entries: int = 100000,
+    explain_cache_ttl_seconds: float = 300,
+    table_rows_interval_seconds: float = 300,
+):
     app = Flask(__name__)
     app.register_blueprint(advisor_blueprint)
     app.teardown_appcontext(_close_db)
+    app.before_request(_record_request_start)
+    app.after_request(_record_request_duration)
     git_utils.clone_repository_if_not_present(repository_path)
     with app.app_context():
         app.config["DB_PATH"] = db_path
+        app.config["REQUEST_TIMEOUT_SECONDS"] = request_timeout_seconds
+        app.config["DB_POOL"] = advisor_lib.ConnectionPool(
+            db_path, max_read_connections
+        )
+        app.config["EXPLAIN_CACHE"] = None
+        if explain_cache_max_entries > 0:
+            app.config["EXPLAIN_CACHE"] = advisor_lib.ExplainCache(
+                explain_cache_max_entries, explain_cache_ttl_seconds
+            )
         app.config["REPO_PATH"] = repository_path
+        app.config["COMMIT_INDEXER"] = git_utils.CommitIndexer(
+            repository_path,
+            app.config["DB_POOL"].write_connection,
+            fetch_interval_seconds,
+            after_failures_indexed=(
+                app.config["EXPLAIN_CACHE"].clear
+                if app.config["EXPLAIN_CACHE"] is not None
+                else None
+            ),
+        )
+        app.config["COMMIT_INDEXER"].start()
+        app.config["TABLE_ROWS_UPDATER"] = metrics.TableRowsUpdater(
+            app.config["DB_POOL"].read_connection, table_rows_interval_seconds
+        )
+        app.config["TABLE_ROWS_UPDATER"].start()
         app.config["DEBUG_FOLDER"] = debug_folder
+        app.config["EXPLANATION_LOGGER"] = None
+        if debug_folder:
+            app.config["EXPLANATION_LOGGER"] = advisor_lib.ExplanationLogger(
+                debug_folder, debug_sample_rate
+            )
+            app.config["EXPLANATION_LOGGER"].start()
+        app.config["RETENTION_SCHEDULER"] = None
+        if retention_commits is not None:
+            app.config["RETENTION_SCHEDULER"] = retention.RetentionScheduler(
+                app.config["DB_POOL"].write_connection,
+                retention_commits,
+                archive_db_path=retention_archive_path,
+                after_age_out=(
+                    app.config["EXPLAIN_CACHE"].clear
+                    if app.config["EXPLAIN_CACHE"] is not None
+                    else None
+                ),
+            )
+            app.config["RETENTION_SCHEDULER"].start()
     return app
+
+
+def shutdown_app(app: Flask):
+    """Stop the background work of an app and close its database connections.
+
+    This should only be called once the app has finished serving requests.
+    """
+    for background_worker in [
+        app.config["RETENTION_SCHEDULER"],
+        app.config["EXPLANATION_LOGGER"],
+        app.config["TABLE_ROWS_UPDATER"],
+        app.config["COMMIT_INDEXER"],
+    ]:
+        if background_worker is not None:
+            background_worker.stop()
+    app.config["DB_POOL"].close()
@@ -1,12 +1,20 @@
+from collections.abc import Iterable, Iterator
+import collections
 from typing import TypedDict
+import contextlib
+import hashlib
 import time
 import sqlite3
 import logging
 import re
 import json
 import os
+import queue
+import random
+import threading
 
-import git_utils
+import flakiness
+import metrics
 
 
 class TestFailure(TypedDict):
@@ -36,243 +44,977 @@ class TestExplanationRequest(TypedDict):
 
 class FlakyTestInfo(TypedDict):
     test_name: str
+    platform: str
     first_failed_index: str
     last_failed_index: str
     failure_range_commit_count: int
     fail_count: int
+    flakiness_score: float
+
+
+# Rules for removing details from failure messages that differ between runs
+# of the same failure, applied in order. Each rule is only applied if the
+# message contains its trigger, which is much cheaper to check for than
+# running the regular expression over messages that can be many KB long.
+_MESSAGE_NORMALIZATION_RULES = [
+    # Checkouts of llvm-project in different locations.
+    ("/home/", re.compile(r"/home/\S*?/llvm-project"), "llvm-project"),
+    (":\\", re.compile(r"[A-Za-z]:\\\S*?\\llvm-project"), "llvm-project"),
+    # Temporary files and directories.
+    ("/tmp/", re.compile(r"/tmp/[^\s/:'\"]+"), "/tmp/<tmp>"),
+    ("\\", re.compile(r"\\Temp\\[^\s\\:'\"]+", re.IGNORECASE), r"\\Temp\\<tmp>"),
+    # Process IDs, like in the ==1234== prefix of sanitizer reports.
+    ("==", re.compile(r"==\d+=="), "==<pid>=="),
+    (
+        "",
+        re.compile(r"(pid|PID|process|Process|thread|Thread)([ :=#]+)\d+"),
+        r"\1\2<pid>",
+    ),
+    # Timestamps and durations.
+    (
+        "",
+        re.compile(
+            r"\d+(?:-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:[.,]\d+)?(?:Z|[+-]\d\d:?\d\d)?"
+            r"|(?:\.\d+)?(?:ms|us|s)\b)"
+        ),
+        "<time>",
+    ),
+    # Memory addresses.
+    ("0x", re.compile(r"0x[0-9a-fA-F]{6,}\b"), "0x<address>"),
+    # Line and column numbers in source locations, like file.cpp:12:34.
+    (":", re.compile(r"(\.\w+|<stdin>):\d+(?::\d+)?\b"), r"\1:<line>"),
+]
+
+
+def normalize_message(message: str) -> str:
+    """Remove details that differ between runs of the same failure."""
+    for trigger, pattern, replacement in _MESSAGE_NORMALIZATION_RULES:
+        if trigger in message:
+            message = pattern.sub(replacement, message)
+    return message
+
+
+def fingerprint_message(message: str) -> int:
+    """Compute a compact fingerprint of a normalized failure message.
+
+    Failure messages that only differ in details that change between runs,
+    like temporary paths or addresses, get the same fingerprint. The
+    fingerprint is a signed 64-bit integer so that it can be stored in an
+    SQLite INTEGER column.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(
+            normalize_message(message).encode("utf-8"), digest_size=8
+        ).digest(),
+        "big",
+        signed=True,
+    )
 
 
-_TABLE_SCHEMAS = {
+def _fingerprint_existing_failures(connection: sqlite3.Connection):
+    last_rowid = 0
+    while True:
+        failures = connection.execute(
+            "SELECT rowid, failure_message FROM failures "
+            "WHERE rowid > ? ORDER BY rowid LIMIT 10000",
+            (last_rowid,),
+        ).fetchall()
+        if not failures:
+            return
+        connection.executemany(
+            "UPDATE failures SET message_fingerprint=? WHERE rowid=?",
+            [
+                (fingerprint_message(failure_message), rowid)
+                for rowid, failure_message in failures
+            ],
+        )
+        last_rowid = failures[-1][0]
+
+
+_POPULATE_FAILURE_AGGREGATES = (
+    "INSERT INTO failure_aggregates "
+    "SELECT test_file, platform, message_fingerprint, COUNT(*), "
+    "MIN(commit_index), MAX(commit_index) FROM failures "
+    "WHERE source_type='postcommit' "
+    "GROUP BY test_file, platform, message_fingerprint"
+)
+
+# The schema used before the database schema was versioned. Databases created
+# back then have a user_version of zero.
+_LEGACY_TABLE_SCHEMAS = {
     "failures": "CREATE TABLE failures(source_type, base_commit_sha, commit_index, source_id, test_file, failure_message, platform)",
     "commits": "CREATE TABLE commits(commit_sha, commit_index)",
 }
 
-EXPLAINED_HEAD_MAX_COMMIT_INDEX_DIFFERENCE = 5
-EXPLAINED_FLAKY_MIN_COMMIT_RANGE = 200
+# Each entry contains the statements that upgrade the database schema by one
+# version, either as SQL or as functions taking the connection. The version a
+# database is at is stored in its user_version pragma, so migrations must only
+# ever be appended to this list and never modified.
+_SCHEMA_MIGRATIONS = [
+    # Version 1: The legacy schema.
+    [
+        table_schema.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS")
+        for table_schema in _LEGACY_TABLE_SCHEMAS.values()
+    ],
+    # Version 2: Typed columns and indexes for the explain, flaky test and
+    # commit index lookups.
+    [
+        "CREATE TABLE failures_typed("
+        "source_type TEXT, "
+        "base_commit_sha TEXT, "
+        "commit_index INTEGER, "
+        "source_id TEXT, "
+        "test_file TEXT, "
+        "failure_message TEXT, "
+        "platform TEXT)",
+        "INSERT INTO failures_typed SELECT * FROM failures",
+        "DROP TABLE failures",
+        "ALTER TABLE failures_typed RENAME TO failures",
+        "CREATE INDEX failures_by_test ON failures("
+        "source_type, platform, test_file, commit_index, base_commit_sha)",
+        "CREATE INDEX failures_by_test_file ON failures(test_file, commit_index)",
+        "CREATE TABLE commits_typed("
+        "commit_sha TEXT PRIMARY KEY, commit_index INTEGER NOT NULL) "
+        "WITHOUT ROWID",
+        "INSERT INTO commits_typed "
+        "SELECT commit_sha, MIN(commit_index) FROM commits GROUP BY commit_sha",
+        "DROP TABLE commits",
+        "ALTER TABLE commits_typed RENAME TO commits",
+        "CREATE INDEX commits_by_index ON commits(commit_index)",
+    ],
+    # Version 3: Find failures uploaded before their base commit was indexed.
+    [
+        "CREATE INDEX failures_pending_commit_index ON failures(base_commit_sha) "
+        "WHERE commit_index IS NULL",
+    ],
+    # Version 4: Cache the index of the merge base on main of commits that
+    # are not on main themselves.
+    [
+        "CREATE TABLE merge_bases("
+        "commit_sha TEXT PRIMARY KEY, commit_index INTEGER NOT NULL) "
+        "WITHOUT ROWID",
+    ],
+    # Version 5: Aggregate postcommit failures by test, platform and message
+    # so that flaky tests can be found without scanning the failure history.
+    # The aggregates are kept up to date by triggers, so they are updated in
+    # the same transaction as the failures they summarize.
+    [
+        "ALTER TABLE failures ADD COLUMN message_fingerprint INTEGER",
+        _fingerprint_existing_failures,
+        "CREATE TABLE failure_aggregates("
+        "test_file TEXT NOT NULL, "
+        "platform TEXT NOT NULL, "
+        "message_fingerprint INTEGER NOT NULL, "
+        "failure_count INTEGER NOT NULL, "
+        "first_commit_index INTEGER, "
+        "last_commit_index INTEGER, "
+        "PRIMARY KEY(test_file, platform, message_fingerprint)) WITHOUT ROWID",
+        _POPULATE_FAILURE_AGGREGATES,
+        """CREATE TRIGGER failure_aggregates_insert AFTER INSERT ON failures
+        WHEN NEW.source_type='postcommit'
+        BEGIN
+          INSERT INTO failure_aggregates VALUES(
+            NEW.test_file, NEW.platform, NEW.message_fingerprint, 1,
+            NEW.commit_index, NEW.commit_index)
+          ON CONFLICT DO UPDATE SET
+            failure_count=failure_count + 1,
+            first_commit_index=MIN(
+              IFNULL(first_commit_index, excluded.first_commit_index),
+              IFNULL(excluded.first_commit_index, first_commit_index)),
+            last_commit_index=MAX(
+              IFNULL(last_commit_index, excluded.last_commit_index),
+              IFNULL(excluded.last_commit_index, last_commit_index));
+        END""",
+        """CREATE TRIGGER failure_aggregates_index AFTER UPDATE OF commit_index
+        ON failures
+        WHEN NEW.source_type='postcommit' AND OLD.commit_index IS NULL
+        BEGIN
+          UPDATE failure_aggregates SET
+            first_commit_index=MIN(
+              IFNULL(first_commit_index, NEW.commit_index), NEW.commit_index),
+            last_commit_index=MAX(
+              IFNULL(last_commit_index, NEW.commit_index), NEW.commit_index)
+          WHERE test_file=NEW.test_file AND platform=NEW.platform
+            AND message_fingerprint=NEW.message_fingerprint;
+        END""",
+    ],
+    # Version 6: Fingerprint normalized failure messages, and match failures
+    # at head on the fingerprint from the index alone.
+    [
+        "DROP INDEX failures_by_test",
+        _fingerprint_existing_failures,
+        "DELETE FROM failure_aggregates",
+        _POPULATE_FAILURE_AGGREGATES,
+        "CREATE INDEX failures_by_test ON failures("
+        "source_type, platform, test_file, message_fingerprint, commit_index, "
+        "base_commit_sha)",
+    ],
+    # Version 7: Count postcommit failures in buckets of 10 commits to score
+    # the flakiness of tests over windows of commits, see flakiness.py. Like
+    # the aggregates, the buckets are kept when failures are aged out. Only
+    # failures that are still in the failures table are counted for
+    # databases that already aged out failures.
+    [
+        "CREATE TABLE failure_buckets("
+        "test_file TEXT NOT NULL, "
+        "platform TEXT NOT NULL, "
+        "message_fingerprint INTEGER NOT NULL, "
+        "bucket_index INTEGER NOT NULL, "
+        "failure_count INTEGER NOT NULL, "
+        "PRIMARY KEY(test_file, platform, message_fingerprint, bucket_index)) "
+        "WITHOUT ROWID",
+        "INSERT INTO failure_buckets "
+        "SELECT test_file, platform, message_fingerprint, commit_index / 10, "
+        "COUNT(*) FROM failures "
+        "WHERE source_type='postcommit' AND commit_index IS NOT NULL "
+        "GROUP BY test_file, platform, message_fingerprint, commit_index / 10",
+        """CREATE TRIGGER failure_buckets_insert AFTER INSERT ON failures
+        WHEN NEW.source_type='postcommit' AND NEW.commit_index IS NOT NULL
+        BEGIN
+          INSERT INTO failure_buckets VALUES(
+            NEW.test_file, NEW.platform, NEW.message_fingerprint,
+            NEW.commit_index / 10, 1)
+          ON CONFLICT DO UPDATE SET failure_count=failure_count + 1;
+        END""",
+        """CREATE TRIGGER failure_buckets_index AFTER UPDATE OF commit_index
+        ON failures
+        WHEN NEW.source_type='postcommit' AND OLD.commit_index IS NULL
+          AND NEW.commit_index IS NOT NULL
+        BEGIN
+          INSERT INTO failure_buckets VALUES(
+            NEW.test_file, NEW.platform, NEW.message_fingerprint,
+            NEW.commit_index / 10, 1)
+          ON CONFLICT DO UPDATE SET failure_count=failure_count + 1;
+        END""",
+    ],
+]
 
+SCHEMA_VERSION = len(_SCHEMA_MIGRATIONS)
 
-def _create_table(table_name: str, connection: sqlite3.Connection):
-    logging.info("Did not find failures table, creating.")
-    connection.execute(_TABLE_SCHEMAS[table_name])
-    connection.commit()
+WRITE_CACHE_SIZE_KIB = 64 * 1024
 
+EXPLAINED_HEAD_MAX_COMMIT_INDEX_DIFFERENCE = 5
+# Failures are explained as flaky, and tests are reported as flaky, if their
+# flakiness confidence is at least this high. See flakiness.py.
+EXPLAINED_FLAKY_MIN_CONFIDENCE = 0.5
+FLAKY_TESTS_MIN_FAILURE_COUNT = 10
 
-def setup_db(db_path: str) -> sqlite3.Connection:
-    connection = sqlite3.connect(db_path)
-    for table_name in _TABLE_SCHEMAS:
-        tables = connection.execute("SELECT name from sqlite_master").fetchall()
-        if (table_name,) not in tables:
-            _create_table(table_name, connection)
-            continue
 
-        table_schema = connection.execute(
-            "SELECT sql FROM sqlite_master WHERE name=?", (table_name,)
+def _set_aside_unknown_legacy_tables(connection: sqlite3.Connection):
+    """Rename unversioned tables whose schema we do not know how to migrate."""
+    for table_name, table_schema in _LEGACY_TABLE_SCHEMAS.items():
+        current_schema = connection.execute(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name=?",
+            (table_name,),
         ).fetchone()
-        if table_schema == (_TABLE_SCHEMAS[table_name],):
+        if current_schema is None or current_schema == (table_schema,):
             continue
 
-        # The schema of the table does not match what we were expecting. Keep the
-        # current table around just in case by renaming it and recreate the
-        # table using the expected schema.
+        # Keep the current table around just in case by renaming it. The
+        # migrations will recreate the table using the expected schema.
         new_table_name = f"{table_name}_old_{int(time.time())}"
+        logging.warning(
+            "Unexpected schema for table %s, renaming it to %s.",
+            table_name,
+            new_table_name,
+        )
         connection.execute(f"ALTER TABLE {table_name} RENAME TO {new_table_name}")
         connection.commit()
 
-        _create_table(table_name, connection)
+
+def _migrate_schema(connection: sqlite3.Connection, schema_version: int):
+    for target_version in range(schema_version + 1, SCHEMA_VERSION + 1):
+        logging.info("Migrating database schema to version %d.", target_version)
+        # Run each migration in its own transaction so that a failure part of
+        # the way through leaves the database at the previous version.
+        connection.execute("BEGIN")
+        try:
+            for statement in _SCHEMA_MIGRATIONS[target_version - 1]:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {target_version}")
+            connection.commit()
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+
+
+def setup_db(db_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(db_path)
+    # Let retention give space back to the file system bit by bit. This only
+    # takes effect for new databases, older ones need a full VACUUM first.
+    connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # Use write-ahead logging so that uploads do not block explanation
+    # requests reading from the database.
+    connection.execute("PRAGMA journal_mode=WAL")
+    schema_version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if schema_version > SCHEMA_VERSION:
+        raise ValueError(
+            f"Database schema version {schema_version} is newer than the "
+            f"latest known version {SCHEMA_VERSION}."
+        )
+    if schema_version == 0:
+        _set_aside_unknown_legacy_tables(connection)
+    _migrate_schema(connection, schema_version)
     return connection
 
 
-def _canonicalize_failures(failures: list[TestFailure]):
-    for failure in failures:
-        failure["message"] = re.sub(
-            r"\/home\/.*\/llvm-project", "llvm-project", failure["message"]
+class ConnectionPool:
+    """A process wide pool of connections to the advisor database.
+
+    The database schema is set up once when the pool is created. Afterwards,
+    read connections are handed out to request handlers and returned to the
+    pool once they are done, up to one per worker thread. All writes go
+    through a single connection that is only ever used by one thread at a
+    time, as SQLite only supports a single writer anyways.
+    """
+
+    def __init__(self, db_path: str, max_read_connections: int = 16):
+        setup_db(db_path).close()
+        self._db_path = db_path
+        self._max_read_connections = max_read_connections
+        self._read_connection_count = 0
+        self._read_connection_count_lock = threading.Lock()
+        self._idle_read_connections: queue.LifoQueue[sqlite3.Connection] = (
+            queue.LifoQueue()
         )
+        self._write_connection = self._connect()
+        # With WAL journaling, NORMAL only gives up durability of the last
+        # transactions on power loss, not consistency, and saves an fsync per
+        # commit. Batch uploads touch index pages all over the failures table,
+        # so give the writer a larger page cache than the 2MiB default.
+        self._write_connection.execute("PRAGMA synchronous=NORMAL")
+        self._write_connection.execute(f"PRAGMA cache_size=-{WRITE_CACHE_SIZE_KIB}")
+        self._write_lock = threading.Lock()
 
+    def _connect(self) -> sqlite3.Connection:
+        # Connections are handed between threads, but only ever used by a
+        # single thread at a time.
+        return sqlite3.connect(self._db_path, check_same_thread=False)
 
-def upload_failures(
-    failure_info: FailureUpload, db_connection: sqlite3.Connection, repository_path: str
-):
-    _canonicalize_failures(failure_info["failures"])
-    failures = []
+    def acquire_read_connection(
+        self, timeout_seconds: float | None = None
+    ) -> sqlite3.Connection:
+        """Take a read connection out of the pool.
+
+        Args:
+          timeout_seconds: How long to wait for a connection to be released if
+            all of them are in use. Waits indefinitely if None.
+
+        Raises:
+          TimeoutError: If no connection was released within the timeout.
+        """
+        try:
+            connection = self._idle_read_connections.get_nowait()
+            metrics.record_cache_lookup("read_connection", True)
+            return connection
+        except queue.Empty:
+            metrics.record_cache_lookup("read_connection", False)
+        with self._read_connection_count_lock:
+            if self._read_connection_count < self._max_read_connections:
+                self._read_connection_count += 1
+                return self._connect()
+        try:
+            return self._idle_read_connections.get(timeout=timeout_seconds)
+        except queue.Empty:
+            raise TimeoutError("Timed out waiting for a read connection.")
+
+    def release_read_connection(self, connection: sqlite3.Connection):
+        # Make sure we do not hold on to a snapshot of the database, or
+        # anything written by the previous user of the connection.
+        if connection.in_transaction:
+            connection.rollback()
+        self._idle_read_connections.put(connection)
+
+    @contextlib.contextmanager
+    def read_connection(self) -> Iterator[sqlite3.Connection]:
+        connection = self.acquire_read_connection()
+        try:
+            yield connection
+        finally:
+            self.release_read_connection(connection)
+
+    @contextlib.contextmanager
+    def write_connection(
+        self, timeout_seconds: float | None = None
+    ) -> Iterator[sqlite3.Connection]:
+        """Take the write connection, waiting for other writers to finish.
+
+        Args:
+          timeout_seconds: How long to wait for the write connection. Waits
+            indefinitely if None.
+
+        Raises:
+          TimeoutError: If the write connection did not become available within
+            the timeout.
+        """
+        if not self._write_lock.acquire(
+            timeout=-1 if timeout_seconds is None else timeout_seconds
+        ):
+            raise TimeoutError("Timed out waiting for the write connection.")
+        try:
+            yield self._write_connection
+        finally:
+            if self._write_connection.in_transaction:
+                self._write_connection.rollback()
+            self._write_lock.release()
+
+    def close(self):
+        with self._write_lock:
+            self._write_connection.close()
+        while True:
+            try:
+                self._idle_read_connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class ExplainCache:
+    """An LRU cache of the evidence used to explain failures, with a TTL.
+
+    Entries are keyed by platform, base commit, test file and message
+    fingerprint. The evidence for a failure only changes when postcommit
+    failures of the same test on the same platform are added, or when
+    failures are aged out of the database. Uploads invalidate the entries of
+    the tests they contain, and retention clears the whole cache. The TTL
+    bounds how long changes made by other processes, like the retention CLI,
+    take to be picked up.
+
+    Filling in the commit index of failures uploaded before their base commit
+    was indexed changes the evidence as well, so the commit indexer clears the
+    cache when it does so.
+
+    To avoid caching evidence read before an invalidation, callers get the
+    version of a test before reading its evidence from the database, and the
+    evidence is only cached if the version did not change in the meantime.
+    """
+
+    def __init__(self, max_entries: int = 100000, ttl_seconds: float = 300):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict[
+            tuple, tuple[float, tuple[float, int]]
+        ] = collections.OrderedDict()
+        self._keys_by_test: dict[tuple[str, str], set[tuple]] = {}
+        self._test_versions: dict[tuple[str, str], int] = {}
+        self._clear_count = 0
+
+    def get_version(self, platform: str, test_file: str) -> int:
+        with self._lock:
+            return self._clear_count + self._test_versions.get((platform, test_file), 0)
+
+    def get(self, cache_key: tuple) -> tuple[float, int] | None:
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(cache_key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+        metrics.record_cache_lookup("explain", entry is not None)
+        return entry[1] if entry is not None else None
+
+    def put(
+        self,
+        cache_key: tuple,
+        evidence: tuple[float, int],
+        version: int,
+    ):
+        platform, _, test_file, _ = cache_key
+        with self._lock:
+            if (
+                self._clear_count + self._test_versions.get((platform, test_file), 0)
+                != version
+            ):
+                return
+            self._entries[cache_key] = (time.monotonic() + self._ttl_seconds, evidence)
+            self._entries.move_to_end(cache_key)
+            self._keys_by_test.setdefault((platform, test_file), set()).add(cache_key)
+            while len(self._entries) > self._max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, platform: str, test_files: Iterable[str]):
+        with self._lock:
+            for test_file in test_files:
+                test_key = (platform, test_file)
+                self._test_versions[test_key] = self._test_versions.get(test_key, 0) + 1
+                for cache_key in self._keys_by_test.pop(test_key, set()):
+                    del self._entries[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._clear_count += 1
+            self._entries.clear()
+            self._keys_by_test.clear()
+
+    def _remove(self, cache_key: tuple):
+        platform, _, test_file, _ = cache_key
+        del self._entries[cache_key]
+        test_cache_keys = self._keys_by_test[(platform, test_file)]
+        test_cache_keys.discard(cache_key)
+        if not test_cache_keys:
+            del self._keys_by_test[(platform, test_file)]
+
+
+def _get_failure_rows(
+    failure_info: FailureUpload, base_commit_index: int | None
+) -> Iterator[tuple]:
     for failure in failure_info["failures"]:
-        failures.append(
-            (
-                failure_info["source_type"],
-                failure_info["base_commit_sha"],
-                git_utils.get_commit_index(
-                    failure_info["base_commit_sha"], repository_path, db_connection
-                ),
-                failure_info["source_id"],
-                failure["name"],
-                failure["message"],
+        yield (
+            failure_info["source_type"],
+            failure_info["base_commit_sha"],
+            base_commit_index,
+            failure_info["source_id"],
+            failure["name"],
+            failure["message"],
+            failure_info["platform"],
+            fingerprint_message(failure["message"]),
+        )
+
+
+def _invalidate_explanations(
+    failure_infos: Iterable[FailureUpload], explain_cache: ExplainCache | None
+):
+    if explain_cache is None:
+        return
+    for failure_info in failure_infos:
+        # Only postcommit failures are used as evidence.
+        if failure_info["source_type"] == "postcommit":
+            explain_cache.invalidate(
                 failure_info["platform"],
+                {failure["name"] for failure in failure_info["failures"]},
             )
+
+
+def upload_failures(
+    failure_info: FailureUpload,
+    db_connection: sqlite3.Connection,
+    base_commit_index: int | None,
+    explain_cache: ExplainCache | None = None,
+):
+    failure_rows = list(_get_failure_rows(failure_info, base_commit_index))
+    with metrics.DB_QUERY_SECONDS.labels("upload").time():
+        db_connection.executemany(
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)", failure_rows
         )
-    db_connection.executemany(
-        "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?)", failures
+        db_connection.commit()
+    _invalidate_explanations([failure_info], explain_cache)
+
+
+def validate_failure_upload(failure_info) -> str | None:
+    """Check that a decoded JSON value is a well formed FailureUpload.
+
+    Returns:
+      A description of the first problem found, or None if the value is valid.
+    """
+    if not isinstance(failure_info, dict):
+        return "Expected a JSON object."
+    for field in ["source_type", "base_commit_sha", "source_id", "platform"]:
+        if not isinstance(failure_info.get(field), str):
+            return f"Expected {field} to be a string."
+    failures = failure_info.get("failures")
+    if not isinstance(failures, list):
+        return "Expected failures to be a list."
+    for failure in failures:
+        if not (
+            isinstance(failure, dict)
+            and isinstance(failure.get("name"), str)
+            and isinstance(failure.get("message"), str)
+        ):
+            return "Expected each failure to have a string name and message."
+    return None
+
+
+def upload_failure_batch(
+    failure_infos: list[FailureUpload],
+    db_connection: sqlite3.Connection,
+    base_commit_indices: dict[str, int | None],
+    explain_cache: ExplainCache | None = None,
+) -> int:
+    """Upload several sets of failures in a single transaction.
+
+    Args:
+      failure_infos: The failure uploads to store. They are expected to have
+        been checked with validate_failure_upload.
+      db_connection: The database connection to write to.
+      base_commit_indices: The index of the base commit of each upload, keyed
+        by SHA. Uploads whose base commit is missing or None are stored
+        without an index and filled in once the commit is indexed.
+      explain_cache: If set, the cache to invalidate explanations of the
+        uploaded tests in.
+
+    Returns:
+      The number of failures stored.
+    """
+    failure_rows = [
+        failure_row
+        for failure_info in failure_infos
+        for failure_row in _get_failure_rows(
+            failure_info, base_commit_indices.get(failure_info["base_commit_sha"])
+        )
+    ]
+    # Insert in the order of the failure_aggregates key (test file, platform,
+    # fingerprint) so that consecutive rows mostly touch the same index pages.
+    failure_rows.sort(
+        key=lambda failure_row: (failure_row[4], failure_row[6], failure_row[7])
     )
-    db_connection.commit()
+    try:
+        with metrics.DB_QUERY_SECONDS.labels("upload_batch").time():
+            db_connection.executemany(
+                "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)", failure_rows
+            )
+            db_connection.commit()
+    except Exception:
+        db_connection.rollback()
+        raise
+    _invalidate_explanations(failure_infos, explain_cache)
+    return len(failure_rows)
+
+
+_EXPLAIN_REQUEST_TABLE_SCHEMA = (
+    "CREATE TEMP TABLE IF NOT EXISTS explain_requests("
+    "request_index, test_file, message_fingerprint)"
+)
+
+# Computes, for every failure in an explanation request, how many matching
+# postcommit failures fall close to the base commit (used to detect failures
+# at head) in a single query.
+_EXPLAIN_QUERY_TEMPLATE = """
+SELECT
+  explain_requests.request_index,
+  (
+    SELECT COUNT(*)
+    FROM failures
+    WHERE failures.source_type='postcommit'
+      AND failures.platform=:platform
+      AND failures.test_file=explain_requests.test_file
+      AND failures.message_fingerprint=explain_requests.message_fingerprint
+      AND {at_head_condition}
+  )
+FROM explain_requests
+"""
 
+# Gets the failure bucket counts of every failure in an explanation request,
+# to score how likely the failures are to be flaky.
+_EXPLAIN_BUCKETS_QUERY = """
+SELECT
+  explain_requests.request_index,
+  failure_buckets.bucket_index,
+  failure_buckets.failure_count
+FROM explain_requests
+JOIN failure_buckets
+  ON failure_buckets.test_file=explain_requests.test_file
+  AND failure_buckets.platform=:platform
+  AND failure_buckets.message_fingerprint=explain_requests.message_fingerprint
+ORDER BY explain_requests.request_index, failure_buckets.bucket_index
+"""
 
-def _try_explain_failing_at_head(
+
+def _get_failure_evidence(
     db_connection: sqlite3.Connection,
-    test_failure: TestFailure,
+    failure_keys: list[tuple[str, int]],
     base_commit_sha: str,
     base_commit_index: int | None,
     platform: str,
-) -> FailureExplanation | None:
-    query = (
-        "SELECT failure_message FROM failures "
-        "WHERE source_type='postcommit' AND platform=? AND test_file=?"
-    )
-    query_params = (
-        platform,
-        test_failure["name"],
-    )
+) -> list[tuple[float, int]]:
+    """Look up the historical evidence for a list of test failures at once.
+
+    Args:
+      db_connection: The database connection.
+      failure_keys: The test file and message fingerprint of each test failure
+        to look up evidence for.
+      base_commit_sha: The SHA of the commit the failures were seen on top of.
+      base_commit_index: The index of the base commit, if known.
+      platform: The platform the tests failed on.
+
+    Returns:
+      A list with one entry per test failure, in the same order as
+      failure_keys. Each entry contains the confidence that the failure is
+      flaky, from its postcommit history, and the number of matching
+      postcommit failures at the base commit.
+    """
+    query_params = {"platform": platform}
     if base_commit_index:
-        min_commit_index = (
-            base_commit_index - EXPLAINED_HEAD_MAX_COMMIT_INDEX_DIFFERENCE
+        at_head_condition = (
+            "failures.commit_index > :min_commit_index "
+            "AND failures.commit_index <= :base_commit_index"
         )
-        query += (
-            f" AND commit_index > {min_commit_index} "
-            f"AND commit_index <= {base_commit_index}"
+        query_params["min_commit_index"] = (
+            base_commit_index - EXPLAINED_HEAD_MAX_COMMIT_INDEX_DIFFERENCE
         )
+        query_params["base_commit_index"] = base_commit_index
     else:
-        query += "AND base_commit_sha=?"
-        query_params += (base_commit_sha,)
-    test_name_matches = db_connection.execute(
-        query,
-        query_params,
-    ).fetchall()
-    for test_name_match in test_name_matches:
-        failure_message = test_name_match[0]
-        if failure_message == test_failure["message"]:
-            return {
-                "name": test_failure["name"],
-                "explained": True,
-                "reason": "This test is already failing at the base commit.",
-            }
-    return None
+        at_head_condition = "failures.base_commit_sha=:base_commit_sha"
+        query_params["base_commit_sha"] = base_commit_sha
+
+    db_connection.execute(_EXPLAIN_REQUEST_TABLE_SCHEMA)
+    db_connection.executemany(
+        "INSERT INTO explain_requests VALUES(?, ?, ?)",
+        [
+            (request_index, test_file, message_fingerprint)
+            for request_index, (test_file, message_fingerprint) in enumerate(
+                failure_keys
+            )
+        ],
+    )
+    try:
+        with metrics.DB_QUERY_SECONDS.labels("explain").time():
+            evidence_rows = db_connection.execute(
+                _EXPLAIN_QUERY_TEMPLATE.format(at_head_condition=at_head_condition),
+                query_params,
+            ).fetchall()
+            bucket_rows = db_connection.execute(
+                _EXPLAIN_BUCKETS_QUERY, {"platform": platform}
+            ).fetchall()
+    finally:
+        db_connection.execute("DELETE FROM explain_requests")
+    flaky_confidences = [0.0] * len(failure_keys)
+    if bucket_rows:
+        request_indices, bucket_indices, failure_counts = zip(*bucket_rows)
+        flakiness_scores = flakiness.score_failure_buckets(
+            request_indices, bucket_indices, failure_counts
+        )
+        for request_index, confidence in zip(
+            flakiness_scores["key_ids"].tolist(),
+            flakiness_scores["confidence"].tolist(),
+        ):
+            flaky_confidences[request_index] = confidence
+    return [
+        (flaky_confidences[request_index], at_head_count)
+        for request_index, at_head_count in sorted(evidence_rows)
+    ]
 
 
-def _try_explain_flaky_failure(
+def _get_cached_failure_evidence(
+    explain_cache: ExplainCache,
     db_connection: sqlite3.Connection,
-    test_failure: TestFailure,
+    failure_keys: list[tuple[str, int]],
+    base_commit_sha: str,
+    base_commit_index: int | None,
     platform: str,
-) -> FailureExplanation | None:
-    """See if a failure is flaky at head.
+) -> list[tuple[float, int]]:
+    base_commit = base_commit_index if base_commit_index else base_commit_sha
+    cache_keys = [
+        (platform, base_commit, test_file, message_fingerprint)
+        for test_file, message_fingerprint in failure_keys
+    ]
+    # Get the versions before reading from the database, so that evidence read
+    # before a concurrent upload is not cached after the upload invalidated it.
+    versions = [
+        explain_cache.get_version(platform, test_file) for test_file, _ in failure_keys
+    ]
+    evidence = [explain_cache.get(cache_key) for cache_key in cache_keys]
+    missing_indices = [
+        failure_index
+        for failure_index, failure_evidence in enumerate(evidence)
+        if failure_evidence is None
+    ]
+    if not missing_indices:
+        return evidence
+    missing_evidence = _get_failure_evidence(
+        db_connection,
+        [failure_keys[failure_index] for failure_index in missing_indices],
+        base_commit_sha,
+        base_commit_index,
+        platform,
+    )
+    for failure_index, failure_evidence in zip(missing_indices, missing_evidence):
+        evidence[failure_index] = failure_evidence
+        explain_cache.put(
+            cache_keys[failure_index], failure_evidence, versions[failure_index]
+        )
+    return evidence
+
 
-    This function looks at a test failure and tries to see if the failure is
-    a known flake at head. It does this heuristically, by seeing if there have
-    been at least two failures across more than 200 commits. This has the
-    advantage of being a simple heuristic and performant. We do not
-    explicitly handle the case where a test has been failing continiously
-    for this amount of time as this is an OOM more range than any non-flaky
-    tests have stayed in tree.
+def _explain_failure(
+    test_failure: TestFailure, flaky_confidence: float, at_head_count: int
+) -> FailureExplanation:
+    """Explain a test failure given its historical evidence.
+
+    We want to try and explain flaky failures first. Otherwise we might
+    explain a flaky failure as a failure at head if there is a recent failure
+    in the last couple of commits.
+
+    A failure is considered flaky if the confidence that the same failure is
+    flaky, from how it failed over windows of commits in postcommit, is at
+    least EXPLAINED_FLAKY_MIN_CONFIDENCE. Tests that failed on most commits
+    of a window are considered broken rather than flaky.
 
     Args:
-      db_connection: The database connection.
-      test_failure: The test failure to try and explain.
-      platform: The platform the test failed on.
+      test_failure: The test failure to explain.
+      flaky_confidence: The confidence that the failure is flaky.
+      at_head_count: The number of matching postcommit failures at the base
+        commit.
 
     Returns:
-      Either None, if the test could not be explained as flaky, or a
-      FailureExplanation object explaining the test failure.
+      A FailureExplanation object for the test failure.
     """
-    test_name_matches = db_connection.execute(
-        "SELECT failure_message, commit_index FROM failures WHERE source_type='postcommit' AND platform=? AND test_file=?",
-        (
-            platform,
-            test_failure["name"],
-        ),
-    ).fetchall()
-    commit_indices = []
-    for failure_message, commit_index in test_name_matches:
-        if failure_message == test_failure["message"]:
-            commit_indices.append(commit_index)
-    if len(commit_indices) == 0:
-        return None
-    commit_range = max(commit_indices) - min(commit_indices)
-    if commit_range > EXPLAINED_FLAKY_MIN_COMMIT_RANGE:
+    if flaky_confidence >= EXPLAINED_FLAKY_MIN_CONFIDENCE:
         return {
             "name": test_failure["name"],
             "explained": True,
             "reason": "This test is flaky in main.",
         }
-    return None
+    if at_head_count > 0:
+        return {
+            "name": test_failure["name"],
+            "explained": True,
+            "reason": "This test is already failing at the base commit.",
+        }
+    return {"name": test_failure["name"], "explained": False, "reason": None}
 
 
-def _log_explanation_request(
-    explanation_request: TestExplanationRequest,
-    base_commit_index: int,
-    db_connection: sqlite3.Connection,
-    explanations: list[FailureExplanation],
-    debug_folder: str,
-):
-    explanation_log = {
-        "request": explanation_request,
-        "explanations": explanations,
-        "base_commit_index": base_commit_index,
-        "relevant_previous_failures": [],
-    }
-    for failure in explanation_request["failures"]:
-        test_name_matches = db_connection.execute(
-            "SELECT failure_message, commit_index, test_file "
-            "FROM failures WHERE source_type='postcommit' AND platform=? AND test_file=?",
-            (
-                explanation_request["platform"],
-                failure["name"],
-            ),
-        ).fetchall()
-        explanation_log["relevant_previous_failures"].extend(test_name_matches)
-    with open(
-        os.path.join(
-            debug_folder, str(base_commit_index) + "-" + str(int(time.time())) + ".txt"
-        ),
-        "w",
-    ) as output_file:
-        json.dump(explanation_log, output_file)
+class ExplanationLogger:
+    """Writes debug logs of explanation requests from a background thread.
+
+    Request handlers only sample and queue logs. A background thread writes
+    each of them to its own JSON file in the debug folder, deleting the
+    oldest files to keep the folder under a maximum number of files and total
+    size. Logs that arrive while the queue is full are dropped rather than
+    slowing down requests.
+    """
+
+    def __init__(
+        self,
+        debug_folder: str,
+        sample_rate: float = 1.0,
+        max_files: int = 1000,
+        max_total_bytes: int = 256 << 20,
+        max_queued_logs: int = 100,
+    ):
+        self._debug_folder = debug_folder
+        self._sample_rate = sample_rate
+        self._max_files = max_files
+        self._max_total_bytes = max_total_bytes
+        self._queue: queue.Queue[dict | None] = queue.Queue(max_queued_logs)
+        self._log_files: collections.deque[tuple[str, int]] = collections.deque()
+        self._total_bytes = 0
+        self._thread = threading.Thread(
+            target=self._run, name="explanation-logger", daemon=True
+        )
+        self.dropped_logs = 0
+
+    def start(self):
+        # Count logs left behind by previous runs towards the limits, so that
+        # restarts do not let the folder grow without bound.
+        existing_log_files = []
+        for directory_entry in os.scandir(self._debug_folder):
+            if directory_entry.is_file():
+                file_stat = directory_entry.stat()
+                existing_log_files.append(
+                    (file_stat.st_mtime, directory_entry.path, file_stat.st_size)
+                )
+        for _, log_path, log_size in sorted(existing_log_files):
+            self._add_log_file(log_path, log_size)
+        self._thread.start()
+
+    def stop(self):
+        """Write out all queued logs and stop the background thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def flush(self):
+        """Wait for all queued logs to be written."""
+        self._queue.join()
+
+    def log(self, explanation_log: dict):
+        """Queue a log to be written, subject to sampling.
+
+        The log must not be modified after it has been queued.
+        """
+        if random.random() >= self._sample_rate:
+            return
+        try:
+            self._queue.put_nowait(explanation_log)
+        except queue.Full:
+            self.dropped_logs += 1
+
+    def _add_log_file(self, log_path: str, log_size: int):
+        self._log_files.append((log_path, log_size))
+        self._total_bytes += log_size
+        while self._log_files and (
+            len(self._log_files) > self._max_files
+            or self._total_bytes > self._max_total_bytes
+        ):
+            oldest_log_path, oldest_log_size = self._log_files.popleft()
+            self._total_bytes -= oldest_log_size
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(oldest_log_path)
+
+    def _write_log(self, explanation_log: dict):
+        log_contents = json.dumps(explanation_log).encode("utf-8")
+        log_path = os.path.join(
+            self._debug_folder,
+            f"{explanation_log['base_commit_index']}-{time.time_ns()}.txt",
+        )
+        with open(log_path, "wb") as output_file:
+            output_file.write(log_contents)
+        self._add_log_file(log_path, len(log_contents))
+
+    def _run(self):
+        while True:
+            explanation_log = self._queue.get()
+            try:
+                if explanation_log is None:
+                    return
+                self._write_log(explanation_log)
+            except OSError:
+                logging.exception("Failed to write explanation log.")
+            finally:
+                self._queue.task_done()
 
 
 def explain_failures(
     explanation_request: TestExplanationRequest,
-    repository_path: str,
+    base_commit_index: int | None,
     db_connection: sqlite3.Connection,
-    debug_folder: str | None = None,
+    explanation_logger: ExplanationLogger | None = None,
+    explain_cache: ExplainCache | None = None,
 ) -> list[FailureExplanation]:
-    _canonicalize_failures(explanation_request["failures"])
-    explanations = []
-    commit_index = git_utils.get_commit_index(
-        explanation_request["base_commit_sha"], repository_path, db_connection
-    )
-    for test_failure in explanation_request["failures"]:
-        # We want to try and explain flaky failures first. Otherwise we might
-        # explain a flaky failure as a failure at head if there is a recent
-        # failure in the last couple of commits.
-        explained_as_flaky = _try_explain_flaky_failure(
+    failure_keys = [
+        (test_failure["name"], fingerprint_message(test_failure["message"]))
+        for test_failure in explanation_request["failures"]
+    ]
+    if explain_cache is None:
+        failure_evidence = _get_failure_evidence(
             db_connection,
-            test_failure,
+            failure_keys,
+            explanation_request["base_commit_sha"],
+            base_commit_index,
             explanation_request["platform"],
         )
-        if explained_as_flaky:
-            explanations.append(explained_as_flaky)
-            continue
-        explained_at_head = _try_explain_failing_at_head(
+    else:
+        failure_evidence = _get_cached_failure_evidence(
+            explain_cache,
             db_connection,
-            test_failure,
+            failure_keys,
             explanation_request["base_commit_sha"],
-            commit_index,
+            base_commit_index,
             explanation_request["platform"],
         )
-        if explained_at_head:
-            explanations.append(explained_at_head)
-            continue
-        explanations.append(
-            {"name": test_failure["name"], "explained": False, "reason": None}
+    explanations = [
+        _explain_failure(test_failure, flaky_confidence, at_head_count)
+        for test_failure, (flaky_confidence, at_head_count) in zip(
+            explanation_request["failures"], failure_evidence
         )
-    if debug_folder:
-        _log_explanation_request(
-            explanation_request, commit_index, db_connection, explanations, debug_folder
+    ]
+    if explanation_logger is not None:
+        explanation_logger.log(
+            {
+                "request": explanation_request,
+                "explanations": explanations,
+                "base_commit_index": base_commit_index,
+                "failure_evidence": [
+                    {
+                        "flaky_confidence": flaky_confidence,
+                        "at_head_count": at_head_count,
+                    }
+                    for flaky_confidence, at_head_count in failure_evidence
+                ],
+            }
         )
     return explanations
 
@@ -280,43 +1022,55 @@ def explain_failures(
 def get_flaky_tests(
     db_connection: sqlite3.Connection,
 ) -> list[FlakyTestInfo]:
-    possibly_flaky_tests = db_connection.execute(
-        "SELECT test_file, commit_index FROM failures where test_file "
-        "IN (SELECT test_file FROM failures GROUP BY test_file "
-        "HAVING COUNT(test_file) > 10)"
-    ).fetchall()
-    flaky_test_info: dict[str, FlakyTestInfo] = {}
-    for test_name, commit_index in possibly_flaky_tests:
-        if test_name not in flaky_test_info:
-            flaky_test_info[test_name] = {
-                "test_name": test_name,
-                "first_failed_index": commit_index,
-                "last_failed_index": commit_index,
-                "failure_range_commit_count": 0,
-                "fail_count": 1,
-            }
-            continue
+    """Find the tests that are flaky on each platform.
 
-        flaky_test_info[test_name]["first_failed_index"] = min(
-            flaky_test_info[test_name]["first_failed_index"], commit_index
-        )
-        flaky_test_info[test_name]["last_failed_index"] = max(
-            flaky_test_info[test_name]["last_failed_index"], commit_index
+    Tests are reported per platform if they failed often enough and their
+    flakiness confidence, over failures with any message, is at least
+    EXPLAINED_FLAKY_MIN_CONFIDENCE.
+    """
+    with metrics.DB_QUERY_SECONDS.labels("flaky_tests").time():
+        possibly_flaky_tests = db_connection.execute(
+            "SELECT test_file, platform, MIN(first_commit_index), "
+            "MAX(last_commit_index), SUM(failure_count) FROM failure_aggregates "
+            "WHERE first_commit_index IS NOT NULL "
+            "GROUP BY test_file, platform HAVING SUM(failure_count) > ? "
+            "ORDER BY test_file, platform",
+            (FLAKY_TESTS_MIN_FAILURE_COUNT,),
+        ).fetchall()
+        tests, key_ids, bucket_indices, failure_counts = (
+            flakiness.load_test_failure_buckets(db_connection)
         )
-        flaky_test_info[test_name]["failure_range_commit_count"] = (
-            flaky_test_info[test_name]["last_failed_index"]
-            - flaky_test_info[test_name]["first_failed_index"]
+    flakiness_scores = flakiness.score_failure_buckets(
+        key_ids, bucket_indices, failure_counts
+    )
+    confidences = {
+        tests[key_id]: confidence
+        for key_id, confidence in zip(
+            flakiness_scores["key_ids"].tolist(),
+            flakiness_scores["confidence"].tolist(),
         )
-        flaky_test_info[test_name]["fail_count"] += 1
-
+    }
     output_list: list[FlakyTestInfo] = []
-    for test_name in flaky_test_info:
-        if (
-            flaky_test_info[test_name]["failure_range_commit_count"]
-            == flaky_test_info[test_name]["fail_count"] - 1
-        ):
+    for (
+        test_name,
+        platform,
+        first_failed_index,
+        last_failed_index,
+        fail_count,
+    ) in possibly_flaky_tests:
+        confidence = confidences.get((test_name, platform), 0.0)
+        if confidence < EXPLAINED_FLAKY_MIN_CONFIDENCE:
             continue
-
-        output_list.append(flaky_test_info[test_name])
+        output_list.append(
+            {
+                "test_name": test_name,
+                "platform": platform,
+                "first_failed_index": first_failed_index,
+                "last_failed_index": last_failed_index,
+                "failure_range_commit_count": last_failed_index - first_failed_index,
+                "fail_count": fail_count,
+                "flakiness_score": confidence,
+            }
+        )
 
     return output_list
@@ -3,49 +3,170 @@ import tempfile
 import sqlite3
 import json
 import os
+import threading
 
 import advisor_lib
+import git_utils
 
 
 class AdvisorLibDbSetupTest(unittest.TestCase):
+    EXPECTED_SCHEMA_OBJECTS = [
+        ("index", "commits_by_index"),
+        ("index", "failures_by_test"),
+        ("index", "failures_by_test_file"),
+        ("index", "failures_pending_commit_index"),
+        ("table", "commits"),
+        ("table", "failure_aggregates"),
+        ("table", "failure_buckets"),
+        ("table", "failures"),
+        ("table", "merge_bases"),
+        ("trigger", "failure_aggregates_index"),
+        ("trigger", "failure_aggregates_insert"),
+        ("trigger", "failure_buckets_index"),
+        ("trigger", "failure_buckets_insert"),
+    ]
+
     def setUp(self):
         self.db_file = tempfile.NamedTemporaryFile()
 
     def tearDown(self):
         self.db_file.close()
 
+    def _get_schema_objects(self, connection: sqlite3.Connection):
+        return connection.execute(
+            "SELECT type, name FROM sqlite_master ORDER BY type, name"
+        ).fetchall()
+
     def test_create_tables(self):
         db_connection = advisor_lib.setup_db(self.db_file.name)
         db_connection.close()
         connection = sqlite3.connect(self.db_file.name)
-        tables = connection.execute("SELECT name from sqlite_master").fetchall()
-        self.assertListEqual(tables, [("failures",), ("commits",)])
-        table_schema = connection.execute("SELECT sql FROM sqlite_master").fetchall()
         self.assertListEqual(
-            table_schema,
-            [
-                (advisor_lib._TABLE_SCHEMAS["failures"],),
-                (advisor_lib._TABLE_SCHEMAS["commits"],),
-            ],
+            self._get_schema_objects(connection), self.EXPECTED_SCHEMA_OBJECTS
+        )
+        self.assertEqual(
+            connection.execute("PRAGMA user_version").fetchone(),
+            (advisor_lib.SCHEMA_VERSION,),
+        )
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone(), ("wal",))
+        connection.close()
+
+    def test_reopen_db(self):
+        advisor_lib.setup_db(self.db_file.name).close()
+        connection = advisor_lib.setup_db(self.db_file.name)
+        self.assertListEqual(
+            self._get_schema_objects(connection), self.EXPECTED_SCHEMA_OBJECTS
+        )
+        self.assertEqual(
+            connection.execute("PRAGMA user_version").fetchone(),
+            (advisor_lib.SCHEMA_VERSION,),
         )
         connection.close()
 
-    def test_create_one_table(self):
+    def test_migrate_legacy_tables(self):
         connection_setup = sqlite3.connect(self.db_file.name)
-        connection_setup.execute(advisor_lib._TABLE_SCHEMAS["failures"])
+        connection_setup.execute(advisor_lib._LEGACY_TABLE_SCHEMAS["failures"])
+        connection_setup.execute(
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?)",
+            ("postcommit", "abcdef", 1, "1", "a.ll", "failed", "linux-x86_64"),
+        )
+        connection_setup.execute(advisor_lib._LEGACY_TABLE_SCHEMAS["commits"])
+        connection_setup.executemany(
+            "INSERT INTO commits VALUES(?, ?)", [("abcdef", 1), ("abcdef", 1)]
+        )
+        connection_setup.commit()
         connection_setup.close()
 
         connection = advisor_lib.setup_db(self.db_file.name)
-        tables = connection.execute("SELECT name from sqlite_master").fetchall()
-        self.assertListEqual(tables, [("failures",), ("commits",)])
-        table_schema = connection.execute("SELECT sql FROM sqlite_master").fetchall()
         self.assertListEqual(
-            table_schema,
+            connection.execute("SELECT * FROM failures").fetchall(),
             [
-                (advisor_lib._TABLE_SCHEMAS["failures"],),
-                (advisor_lib._TABLE_SCHEMAS["commits"],),
+                (
+                    "postcommit",
+                    "abcdef",
+                    1,
+                    "1",
+                    "a.ll",
+                    "failed",
+                    "linux-x86_64",
+                    advisor_lib.fingerprint_message("failed"),
+                )
             ],
         )
+        self.assertListEqual(
+            connection.execute("SELECT * FROM failure_aggregates").fetchall(),
+            [
+                (
+                    "a.ll",
+                    "linux-x86_64",
+                    advisor_lib.fingerprint_message("failed"),
+                    1,
+                    1,
+                    1,
+                )
+            ],
+        )
+        self.assertListEqual(
+            connection.execute("SELECT * FROM commits").fetchall(), [("abcdef", 1)]
+        )
+        self.assertListEqual(
+            self._get_schema_objects(connection), self.EXPECTED_SCHEMA_OBJECTS
+        )
+        connection.close()
+
+    def test_newer_schema_version(self):
+        connection_setup = sqlite3.connect(self.db_file.name)
+        connection_setup.execute(
+            f"PRAGMA user_version = {advisor_lib.SCHEMA_VERSION + 1}"
+        )
+        connection_setup.close()
+
+        with self.assertRaises(ValueError):
+            advisor_lib.setup_db(self.db_file.name)
+
+    def test_migrate_fingerprints(self):
+        # Set up a database as it was at version 5, with a fingerprint of the
+        # message before normalization.
+        connection_setup = advisor_lib.setup_db(self.db_file.name)
+        connection_setup.execute("DROP TRIGGER failure_buckets_insert")
+        connection_setup.execute("DROP TRIGGER failure_buckets_index")
+        connection_setup.execute("DROP TABLE failure_buckets")
+        connection_setup.execute("DROP INDEX failures_by_test")
+        connection_setup.execute(
+            "CREATE INDEX failures_by_test ON failures("
+            "source_type, platform, test_file, commit_index, base_commit_sha)"
+        )
+        connection_setup.execute(
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                "postcommit",
+                "abcdef",
+                1,
+                "1",
+                "a.ll",
+                "failed at 0x7ffd4a2b1c30",
+                "linux-x86_64",
+                1234,
+            ),
+        )
+        connection_setup.execute("PRAGMA user_version = 5")
+        connection_setup.commit()
+        connection_setup.close()
+
+        connection = advisor_lib.setup_db(self.db_file.name)
+        fingerprint = advisor_lib.fingerprint_message("failed at 0x<address>")
+        self.assertListEqual(
+            connection.execute("SELECT message_fingerprint FROM failures").fetchall(),
+            [(fingerprint,)],
+        )
+        self.assertListEqual(
+            connection.execute("SELECT * FROM failure_aggregates").fetchall(),
+            [("a.ll", "linux-x86_64", fingerprint, 1, 1, 1)],
+        )
+        self.assertListEqual(
+            connection.execute("SELECT * FROM failure_buckets").fetchall(),
+            [("a.ll", "linux-x86_64", fingerprint, 0, 1)],
+        )
         connection.close()
 
     def test_update_schema(self):
@@ -69,13 +190,365 @@ class AdvisorLibDbSetupTest(unittest.TestCase):
                 continue
         self.assertTrue(found_failures_table)
         self.assertTrue(found_old_failures_table)
-        table_schema = connection.execute(
-            "SELECT sql FROM sqlite_master WHERE name=?", ("failures",)
-        ).fetchone()
-        self.assertEqual(table_schema, (advisor_lib._TABLE_SCHEMAS["failures"],))
+        self.assertListEqual(
+            connection.execute("SELECT * FROM failures").fetchall(), []
+        )
         connection.close()
 
 
+class MessageNormalizationTest(unittest.TestCase):
+    def assertNormalizesTo(self, message: str, normalized_message: str):
+        self.assertEqual(advisor_lib.normalize_message(message), normalized_message)
+
+    def test_normalize_root_path(self):
+        self.assertNormalizesTo(
+            "/home/gha/actions-runner/_work/llvm-project/llvm-project/llvm/test/a.ll",
+            "llvm-project/llvm-project/llvm/test/a.ll",
+        )
+        self.assertNormalizesTo(
+            r"C:\_work\llvm-project\llvm\test\a.ll",
+            r"llvm-project\llvm\test\a.ll",
+        )
+
+    def test_normalize_temporary_paths(self):
+        self.assertNormalizesTo(
+            "cannot open /tmp/lit-tmp-k3j2h1/a.o", "cannot open /tmp/<tmp>/a.o"
+        )
+        self.assertNormalizesTo(
+            r"cannot open C:\Users\gha\AppData\Local\Temp\lit-tmp-k3j2\a.o",
+            r"cannot open C:\Users\gha\AppData\Local\Temp\<tmp>\a.o",
+        )
+
+    def test_normalize_process_ids(self):
+        self.assertNormalizesTo(
+            "==12345==ERROR: AddressSanitizer: heap-use-after-free",
+            "==<pid>==ERROR: AddressSanitizer: heap-use-after-free",
+        )
+        self.assertNormalizesTo("Killed process 4242", "Killed process <pid>")
+
+    def test_normalize_timestamps(self):
+        self.assertNormalizesTo(
+            "2025-10-01T12:34:56.789Z timed out after 60.5s",
+            "<time> timed out after <time>",
+        )
+
+    def test_normalize_addresses(self):
+        self.assertNormalizesTo(
+            "READ of size 4 at 0x602000000010 thread T0",
+            "READ of size 4 at 0x<address> thread T0",
+        )
+
+    def test_normalize_line_numbers(self):
+        self.assertNormalizesTo(
+            "a.ll:12:34: error: CHECK: expected string not found in input",
+            "a.ll:<line>: error: CHECK: expected string not found in input",
+        )
+        self.assertNormalizesTo(
+            "<stdin>:5:1: note: scanning from here",
+            "<stdin>:<line>: note: scanning from here",
+        )
+
+    def test_fingerprint_message(self):
+        self.assertEqual(
+            advisor_lib.fingerprint_message("crash at 0x7ffd12345678"),
+            advisor_lib.fingerprint_message("crash at 0x7ffd87654321"),
+        )
+        self.assertNotEqual(
+            advisor_lib.fingerprint_message("failed in way 1"),
+            advisor_lib.fingerprint_message("failed in way 2"),
+        )
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile()
+        self.pool = advisor_lib.ConnectionPool(
+            self.db_file.name, max_read_connections=2
+        )
+
+    def tearDown(self):
+        self.pool.close()
+        self.db_file.close()
+
+    def test_sets_up_schema(self):
+        with self.pool.read_connection() as connection:
+            self.assertEqual(
+                connection.execute("PRAGMA user_version").fetchone(),
+                (advisor_lib.SCHEMA_VERSION,),
+            )
+
+    def test_reuses_read_connections(self):
+        with self.pool.read_connection() as first_connection:
+            pass
+        with self.pool.read_connection() as second_connection:
+            self.assertIs(first_connection, second_connection)
+
+    def test_limits_read_connections(self):
+        first_connection = self.pool.acquire_read_connection()
+        second_connection = self.pool.acquire_read_connection()
+        self.assertIsNot(first_connection, second_connection)
+        acquired_connections = []
+        waiting_thread = threading.Thread(
+            target=lambda: acquired_connections.append(
+                self.pool.acquire_read_connection()
+            )
+        )
+        waiting_thread.start()
+        waiting_thread.join(timeout=0.1)
+        self.assertListEqual(acquired_connections, [])
+        self.pool.release_read_connection(second_connection)
+        waiting_thread.join()
+        self.assertListEqual(acquired_connections, [second_connection])
+        self.pool.release_read_connection(first_connection)
+        self.pool.release_read_connection(second_connection)
+
+    def test_read_connection_timeout(self):
+        first_connection = self.pool.acquire_read_connection()
+        second_connection = self.pool.acquire_read_connection()
+        with self.assertRaises(TimeoutError):
+            self.pool.acquire_read_connection(timeout_seconds=0.01)
+        self.pool.release_read_connection(first_connection)
+        self.pool.release_read_connection(second_connection)
+
+    def test_write_connection_timeout(self):
+        with self.pool.write_connection():
+            waiting_thread_errors = []
+
+            def take_write_connection():
+                try:
+                    with self.pool.write_connection(timeout_seconds=0.01):
+                        pass
+                except TimeoutError as error:
+                    waiting_thread_errors.append(error)
+
+            waiting_thread = threading.Thread(target=take_write_connection)
+            waiting_thread.start()
+            waiting_thread.join()
+            self.assertEqual(len(waiting_thread_errors), 1)
+        with self.pool.write_connection(timeout_seconds=0.01):
+            pass
+
+    def test_reads_see_committed_writes(self):
+        with self.pool.write_connection() as connection:
+            connection.execute("INSERT INTO commits VALUES(?, ?)", ("abcdef", 1))
+            connection.commit()
+        with self.pool.read_connection() as connection:
+            self.assertListEqual(
+                connection.execute("SELECT * FROM commits").fetchall(),
+                [("abcdef", 1)],
+            )
+
+    def test_rolls_back_uncommitted_writes(self):
+        with self.pool.read_connection() as connection:
+            connection.execute("INSERT INTO commits VALUES(?, ?)", ("abcdef", 1))
+        with self.assertRaises(RuntimeError):
+            with self.pool.write_connection() as connection:
+                connection.execute("INSERT INTO commits VALUES(?, ?)", ("ghijkl", 2))
+                raise RuntimeError()
+        with self.pool.read_connection() as connection:
+            self.assertListEqual(
+                connection.execute("SELECT * FROM commits").fetchall(), []
+            )
+
+
+class ExplanationLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.debug_folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.debug_folder.cleanup()
+
+    def _get_explanation_log(self, base_commit_index: int) -> dict:
+        return {
+            "request": {"failures": [], "platform": "linux-x86_64"},
+            "explanations": [],
+            "base_commit_index": base_commit_index,
+            "failure_evidence": [],
+        }
+
+    def _get_logged_commit_indices(self) -> list[int]:
+        logged_commit_indices = []
+        for log_file_name in os.listdir(self.debug_folder.name):
+            with open(os.path.join(self.debug_folder.name, log_file_name)) as log_file:
+                logged_commit_indices.append(json.load(log_file)["base_commit_index"])
+        return sorted(logged_commit_indices)
+
+    def test_writes_logs(self):
+        explanation_logger = advisor_lib.ExplanationLogger(self.debug_folder.name)
+        explanation_logger.start()
+        for base_commit_index in range(3):
+            explanation_logger.log(self._get_explanation_log(base_commit_index))
+        explanation_logger.flush()
+        self.assertListEqual(self._get_logged_commit_indices(), [0, 1, 2])
+        explanation_logger.stop()
+
+    def test_limits_file_count(self):
+        explanation_logger = advisor_lib.ExplanationLogger(
+            self.debug_folder.name, max_files=2
+        )
+        explanation_logger.start()
+        for base_commit_index in range(5):
+            explanation_logger.log(self._get_explanation_log(base_commit_index))
+        explanation_logger.stop()
+        self.assertListEqual(self._get_logged_commit_indices(), [3, 4])
+
+    def test_limits_total_size(self):
+        log_size = len(json.dumps(self._get_explanation_log(0)))
+        explanation_logger = advisor_lib.ExplanationLogger(
+            self.debug_folder.name, max_total_bytes=log_size * 3
+        )
+        explanation_logger.start()
+        for base_commit_index in range(5):
+            explanation_logger.log(self._get_explanation_log(base_commit_index))
+        explanation_logger.stop()
+        self.assertListEqual(self._get_logged_commit_indices(), [2, 3, 4])
+
+    def test_counts_existing_logs(self):
+        with open(os.path.join(self.debug_folder.name, "old.txt"), "w") as log_file:
+            json.dump(self._get_explanation_log(0), log_file)
+        explanation_logger = advisor_lib.ExplanationLogger(
+            self.debug_folder.name, max_files=1
+        )
+        explanation_logger.start()
+        explanation_logger.log(self._get_explanation_log(1))
+        explanation_logger.stop()
+        self.assertListEqual(self._get_logged_commit_indices(), [1])
+
+    def test_sampling(self):
+        explanation_logger = advisor_lib.ExplanationLogger(
+            self.debug_folder.name, sample_rate=0
+        )
+        explanation_logger.start()
+        explanation_logger.log(self._get_explanation_log(0))
+        explanation_logger.stop()
+        self.assertListEqual(self._get_logged_commit_indices(), [])
+
+    def test_drops_logs_when_queue_is_full(self):
+        explanation_logger = advisor_lib.ExplanationLogger(
+            self.debug_folder.name, max_queued_logs=2
+        )
+        # Queue logs before starting the writer so that none are written yet.
+        for base_commit_index in range(3):
+            explanation_logger.log(self._get_explanation_log(base_commit_index))
+        self.assertEqual(explanation_logger.dropped_logs, 1)
+        explanation_logger.start()
+        explanation_logger.stop()
+        self.assertListEqual(self._get_logged_commit_indices(), [0, 1])
+
+
+class ExplainCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile()
+        self.db_connection = advisor_lib.setup_db(self.db_file.name)
+        self.db_connection.executemany(
+            "INSERT INTO commits VALUES(?, ?)", [("abcdef", 1), ("123456", 2)]
+        )
+        self.explain_cache = advisor_lib.ExplainCache()
+
+    def tearDown(self):
+        self.db_connection.close()
+        self.db_file.close()
+
+    def _upload_failure(self, source_type="postcommit", test_file="a.ll"):
+        advisor_lib.upload_failures(
+            {
+                "source_type": source_type,
+                "base_commit_sha": "abcdef",
+                "source_id": "10000",
+                "failures": [{"name": test_file, "message": "failed"}],
+                "platform": "linux-x86_64",
+            },
+            self.db_connection,
+            1,
+            self.explain_cache,
+        )
+
+    def _is_explained(self, test_file="a.ll") -> bool:
+        return advisor_lib.explain_failures(
+            {
+                "failures": [{"name": test_file, "message": "failed"}],
+                "base_commit_sha": "123456",
+                "platform": "linux-x86_64",
+            },
+            2,
+            self.db_connection,
+            explain_cache=self.explain_cache,
+        )[0]["explained"]
+
+    def _get_cache_key(self, test_file="a.ll") -> tuple:
+        return ("linux-x86_64", 2, test_file, advisor_lib.fingerprint_message("failed"))
+
+    def test_caches_evidence(self):
+        self._upload_failure()
+        self.assertTrue(self._is_explained())
+        self.assertEqual(
+            self.explain_cache.get(self._get_cache_key()), (10 / 200 * (1 - 1 / 10), 1)
+        )
+        # Explanations should come from the cache rather than the database.
+        self.db_connection.execute("DELETE FROM failures")
+        self.assertTrue(self._is_explained())
+
+    def test_postcommit_upload_invalidates(self):
+        self.assertFalse(self._is_explained())
+        self._upload_failure()
+        self.assertIsNone(self.explain_cache.get(self._get_cache_key()))
+        self.assertTrue(self._is_explained())
+
+    def test_upload_invalidates_only_uploaded_tests(self):
+        self.assertFalse(self._is_explained("a.ll"))
+        self.assertFalse(self._is_explained("b.ll"))
+        self._upload_failure(test_file="a.ll")
+        self.assertIsNone(self.explain_cache.get(self._get_cache_key("a.ll")))
+        self.assertIsNotNone(self.explain_cache.get(self._get_cache_key("b.ll")))
+
+    def test_pull_request_upload_does_not_invalidate(self):
+        self.assertFalse(self._is_explained())
+        self._upload_failure(source_type="pull_request")
+        self.assertIsNotNone(self.explain_cache.get(self._get_cache_key()))
+
+    def test_upload_failure_batch_invalidates(self):
+        self.assertFalse(self._is_explained())
+        advisor_lib.upload_failure_batch(
+            [
+                {
+                    "source_type": "postcommit",
+                    "base_commit_sha": "abcdef",
+                    "source_id": "10000",
+                    "failures": [{"name": "a.ll", "message": "failed"}],
+                    "platform": "linux-x86_64",
+                }
+            ],
+            self.db_connection,
+            {"abcdef": 1},
+            self.explain_cache,
+        )
+        self.assertTrue(self._is_explained())
+
+    def test_expires_entries(self):
+        self.explain_cache = advisor_lib.ExplainCache(ttl_seconds=0)
+        self.assertFalse(self._is_explained())
+        self.assertIsNone(self.explain_cache.get(self._get_cache_key()))
+
+    def test_evicts_least_recently_used(self):
+        self.explain_cache = advisor_lib.ExplainCache(max_entries=2)
+        for test_file in ["a.ll", "b.ll", "c.ll"]:
+            self.explain_cache.put(self._get_cache_key(test_file), (None, 0), 0)
+            self.explain_cache.get(self._get_cache_key("a.ll"))
+        self.assertIsNotNone(self.explain_cache.get(self._get_cache_key("a.ll")))
+        self.assertIsNone(self.explain_cache.get(self._get_cache_key("b.ll")))
+        self.assertIsNotNone(self.explain_cache.get(self._get_cache_key("c.ll")))
+
+    def test_does_not_cache_stale_evidence(self):
+        version = self.explain_cache.get_version("linux-x86_64", "a.ll")
+        self.explain_cache.invalidate("linux-x86_64", ["a.ll"])
+        self.explain_cache.put(self._get_cache_key(), (None, 0), version)
+        self.assertIsNone(self.explain_cache.get(self._get_cache_key()))
+        version = self.explain_cache.get_version("linux-x86_64", "a.ll")
+        self.explain_cache.clear()
+        self.explain_cache.put(self._get_cache_key(), (None, 0), version)
+        self.assertIsNone(self.explain_cache.get(self._get_cache_key()))
+
+
 class AdvisorLibTest(unittest.TestCase):
     def setUp(self):
         self.db_file = tempfile.NamedTemporaryFile()
@@ -92,14 +565,13 @@ class AdvisorLibTest(unittest.TestCase):
                 ("6d746c616e676c65796d746c616e676c65796d74", 203),
             ],
         )
-        self.repository_path_dir = tempfile.TemporaryDirectory()
-        self.repository_path = self.repository_path_dir.name
-        os.mkdir(os.path.join(self.repository_path_dir.name, ".git"))
 
     def tearDown(self):
         self.db_connection.close()
         self.db_file.close()
-        self.repository_path_dir.cleanup()
+
+    def _get_commit_index(self, commit_sha: str) -> int | None:
+        return git_utils.get_commit_index(commit_sha, self.db_connection)
 
     def test_upload_failures(self):
         failure_info = {
@@ -113,7 +585,9 @@ class AdvisorLibTest(unittest.TestCase):
             "platform": "linux-x86_64",
         }
         advisor_lib.upload_failures(
-            failure_info, self.db_connection, self.repository_path
+            failure_info,
+            self.db_connection,
+            self._get_commit_index(failure_info["base_commit_sha"]),
         )
         failures = self.db_connection.execute("SELECT * from failures").fetchall()
         self.assertListEqual(
@@ -127,6 +601,7 @@ class AdvisorLibTest(unittest.TestCase):
                     "a.ll",
                     "failed in way 1",
                     "linux-x86_64",
+                    advisor_lib.fingerprint_message("failed in way 1"),
                 ),
                 (
                     "postcommit",
@@ -136,10 +611,187 @@ class AdvisorLibTest(unittest.TestCase):
                     "b.ll",
                     "failed in way 2",
                     "linux-x86_64",
+                    advisor_lib.fingerprint_message("failed in way 2"),
                 ),
             ],
         )
 
+    # Test that failure messages are stored as uploaded, as only their
+    # fingerprints are normalized.
+    def test_upload_failures_keeps_messages(self):
+        message = "/home/gha/llvm-project/a.ll failed, see /home/gha/log"
+        failure_info = {
+            "source_type": "postcommit",
+            "base_commit_sha": "8d29a3bb6f3d92d65bf5811b53bf42bf63685359",
+            "source_id": "10000",
+            "failures": [{"name": "a.ll", "message": message}],
+            "platform": "linux-x86_64",
+        }
+        advisor_lib.upload_failures(
+            failure_info,
+            self.db_connection,
+            self._get_commit_index(failure_info["base_commit_sha"]),
+        )
+        self.assertEqual(failure_info["failures"][0]["message"], message)
+        self.assertListEqual(
+            self.db_connection.execute(
+                "SELECT failure_message, message_fingerprint FROM failures"
+            ).fetchall(),
+            [(message, advisor_lib.fingerprint_message(message))],
+        )
+
+    def test_upload_failure_batch(self):
+        failure_infos = [
+            {
+                "source_type": "postcommit",
+                "base_commit_sha": base_commit_sha,
+                "source_id": source_id,
+                "failures": [{"name": "a.ll", "message": "failed in way 1"}],
+                "platform": "linux-x86_64",
+            }
+            for source_id, base_commit_sha in [
+                ("10000", "8d29a3bb6f3d92d65bf5811b53bf42bf63685359"),
+                ("10001", "8d29a3bb6f3d92d65bf5811b53bf42bf63685359"),
+                ("10002", "6a6f73687561747265656a6f7368756174726565"),
+                ("10003", "f3939dc5093826c05f2a78ce1b0af769cd48fdab"),
+            ]
+        ]
+        base_commit_indices = git_utils.get_commit_indices(
+            [failure_info["base_commit_sha"] for failure_info in failure_infos],
+            self.db_connection,
+        )
+        self.assertDictEqual(
+            base_commit_indices,
+            {
+                "8d29a3bb6f3d92d65bf5811b53bf42bf63685359": 1,
+                "6a6f73687561747265656a6f7368756174726565": 201,
+                "f3939dc5093826c05f2a78ce1b0af769cd48fdab": None,
+            },
+        )
+        self.assertEqual(
+            advisor_lib.upload_failure_batch(
+                failure_infos, self.db_connection, base_commit_indices
+            ),
+            4,
+        )
+        self.assertListEqual(
+            self.db_connection.execute(
+                "SELECT source_id, commit_index FROM failures"
+            ).fetchall(),
+            [("10000", 1), ("10001", 1), ("10002", 201), ("10003", None)],
+        )
+        self.assertListEqual(
+            self.db_connection.execute("SELECT * FROM failure_aggregates").fetchall(),
+            [
+                (
+                    "a.ll",
+                    "linux-x86_64",
+                    advisor_lib.fingerprint_message("failed in way 1"),
+                    4,
+                    1,
+                    201,
+                )
+            ],
+        )
+
+    def test_upload_failure_batch_rolls_back_on_error(self):
+        failure_infos = [
+            {
+                "source_type": "postcommit",
+                "base_commit_sha": "8d29a3bb6f3d92d65bf5811b53bf42bf63685359",
+                "source_id": "10000",
+                "failures": [{"name": "a.ll", "message": "failed in way 1"}],
+                "platform": "linux-x86_64",
+            },
+            {
+                "source_type": "postcommit",
+                "base_commit_sha": "8d29a3bb6f3d92d65bf5811b53bf42bf63685359",
+                "source_id": "10001",
+                "failures": [{"name": "a.ll"}],
+                "platform": "linux-x86_64",
+            },
+        ]
+        with self.assertRaises(KeyError):
+            advisor_lib.upload_failure_batch(
+                failure_infos,
+                self.db_connection,
+                {"8d29a3bb6f3d92d65bf5811b53bf42bf63685359": 1},
+            )
+        self.assertListEqual(
+            self.db_connection.execute("SELECT * FROM failures").fetchall(), []
+        )
+
+    def test_validate_failure_upload(self):
+        failure_info = {
+            "source_type": "postcommit",
+            "base_commit_sha": "8d29a3bb6f3d92d65bf5811b53bf42bf63685359",
+            "source_id": "10000",
+            "failures": [{"name": "a.ll", "message": "failed in way 1"}],
+            "platform": "linux-x86_64",
+        }
+        self.assertIsNone(advisor_lib.validate_failure_upload(failure_info))
+        self.assertEqual(
+            advisor_lib.validate_failure_upload([failure_info]),
+            "Expected a JSON object.",
+        )
+        self.assertEqual(
+            advisor_lib.validate_failure_upload({**failure_info, "platform": None}),
+            "Expected platform to be a string.",
+        )
+        self.assertEqual(
+            advisor_lib.validate_failure_upload({**failure_info, "failures": {}}),
+            "Expected failures to be a list.",
+        )
+        self.assertEqual(
+            advisor_lib.validate_failure_upload(
+                {**failure_info, "failures": [{"name": "a.ll"}]}
+            ),
+            "Expected each failure to have a string name and message.",
+        )
+
+    def test_upload_failures_updates_aggregates(self):
+        for base_commit_sha in [
+            "6a6f73687561747265656a6f7368756174726565",
+            "8d29a3bb6f3d92d65bf5811b53bf42bf63685359",
+            "6b7064686b706f7064656d6f6e68756e74657273",
+        ]:
+            advisor_lib.upload_failures(
+                {
+                    "source_type": "postcommit",
+                    "base_commit_sha": base_commit_sha,
+                    "source_id": "10000",
+                    "failures": [{"name": "a.ll", "message": "failed in way 1"}],
+                    "platform": "linux-x86_64",
+                },
+                self.db_connection,
+                self._get_commit_index(base_commit_sha),
+            )
+        # Failures from pull requests should not be taken into account.
+        advisor_lib.upload_failures(
+            {
+                "source_type": "pull_request",
+                "base_commit_sha": "6d746c616e676c65796d746c616e676c65796d74",
+                "source_id": "10001",
+                "failures": [{"name": "a.ll", "message": "failed in way 1"}],
+                "platform": "linux-x86_64",
+            },
+            self.db_connection,
+            self._get_commit_index("6d746c616e676c65796d746c616e676c65796d74"),
+        )
+        self.assertListEqual(
+            self.db_connection.execute("SELECT * FROM failure_aggregates").fetchall(),
+            [
+                (
+                    "a.ll",
+                    "linux-x86_64",
+                    advisor_lib.fingerprint_message("failed in way 1"),
+                    3,
+                    1,
+                    201,
+                )
+            ],
+        )
+
     def test_explain_failures(self):
         explanation_request = {
             "failures": [{"name": "a.ll", "message": "failed"}],
@@ -149,7 +801,7 @@ class AdvisorLibTest(unittest.TestCase):
         self.assertListEqual(
             advisor_lib.explain_failures(
                 explanation_request,
-                self.repository_path,
+                self._get_commit_index(explanation_request["base_commit_sha"]),
                 self.db_connection,
             ),
             [{"name": "a.ll", "explained": False, "reason": None}],
@@ -166,7 +818,7 @@ class AdvisorLibTest(unittest.TestCase):
         prev_failure_failure_name="a.ll",
         prev_failure_failure_message="failed in way 1",
         prev_failure_platform="linux-x86_64",
-        debug_folder=None,
+        explanation_logger=None,
     ) -> list[advisor_lib.FailureExplanation]:
         """Constructs explanations.
 
@@ -186,7 +838,9 @@ class AdvisorLibTest(unittest.TestCase):
             "platform": prev_failure_platform,
         }
         advisor_lib.upload_failures(
-            failure_info, self.db_connection, self.repository_path
+            failure_info,
+            self.db_connection,
+            self._get_commit_index(failure_info["base_commit_sha"]),
         )
         explanation_request = {
             "failures": [{"name": failure_name, "message": failure_message}],
@@ -194,7 +848,10 @@ class AdvisorLibTest(unittest.TestCase):
             "platform": platform,
         }
         return advisor_lib.explain_failures(
-            explanation_request, self.repository_path, self.db_connection, debug_folder
+            explanation_request,
+            self._get_commit_index(explanation_request["base_commit_sha"]),
+            self.db_connection,
+            explanation_logger,
         )
 
     # Test that we can explain away a failure at head, assuming all of the
@@ -261,6 +918,25 @@ class AdvisorLibTest(unittest.TestCase):
             ],
         )
 
+    # Test that we can explain test failures whose messages only differ in
+    # details that change between runs.
+    def test_explain_different_addresses(self):
+        self.assertListEqual(
+            self._get_explained_failures(
+                failure_message="==123==ERROR: use-after-free on 0x602000000010",
+                prev_failure_failure_message=(
+                    "==456==ERROR: use-after-free on 0x603000000020"
+                ),
+            ),
+            [
+                {
+                    "name": "a.ll",
+                    "explained": True,
+                    "reason": "This test is already failing at the base commit.",
+                }
+            ],
+        )
+
     # Test that we do not explain away a failure at head if the only matching
     # failure information comes from a PR.
     def test_no_explain_different_source_type(self):
@@ -317,7 +993,10 @@ class AdvisorLibTest(unittest.TestCase):
 
     def test_explain_failures_debug_logging(self):
         with tempfile.TemporaryDirectory() as debug_folder:
-            self._get_explained_failures(debug_folder=debug_folder)
+            explanation_logger = advisor_lib.ExplanationLogger(debug_folder)
+            explanation_logger.start()
+            self._get_explained_failures(explanation_logger=explanation_logger)
+            explanation_logger.stop()
             debug_outputs = os.listdir(debug_folder)
             self.assertEqual(len(debug_outputs), 1)
             with open(os.path.join(debug_folder, debug_outputs[0])) as debug_file:
@@ -340,7 +1019,14 @@ class AdvisorLibTest(unittest.TestCase):
                             }
                         ],
                         "base_commit_index": 1,
-                        "relevant_previous_failures": [["failed in way 1", 1, "a.ll"]],
+                        # The single previous failure spans one bucket of 10
+                        # commits, with a failure rate of 1 in 10 commits.
+                        "failure_evidence": [
+                            {
+                                "flaky_confidence": 10 / 200 * (1 - 1 / 10),
+                                "at_head_count": 1,
+                            }
+                        ],
                     },
                 )
 
@@ -373,7 +1059,9 @@ class AdvisorLibTest(unittest.TestCase):
         ]
         for failure_info in failures_info:
             advisor_lib.upload_failures(
-                failure_info, self.db_connection, self.repository_path
+                failure_info,
+                self.db_connection,
+                self._get_commit_index(failure_info["base_commit_sha"]),
             )
 
     def _get_flaky_test_explanations(self):
@@ -383,7 +1071,9 @@ class AdvisorLibTest(unittest.TestCase):
             "platform": "linux-x86_64",
         }
         return advisor_lib.explain_failures(
-            explanation_request, self.repository_path, self.db_connection
+            explanation_request,
+            self._get_commit_index(explanation_request["base_commit_sha"]),
+            self.db_connection,
         )
 
     def test_explain_flaky(self):
@@ -454,6 +1144,53 @@ class AdvisorLibTest(unittest.TestCase):
             ],
         )
 
+    # Test that a request with several failures gets one explanation per
+    # failure, in order, with each failure explained independently.
+    def test_explain_multiple_failures(self):
+        self._setup_flaky_test_info()
+        advisor_lib.upload_failures(
+            {
+                "source_type": "postcommit",
+                "base_commit_sha": "6d746c616e676c65796d746c616e676c65796d74",
+                "source_id": "100002",
+                "failures": [{"name": "b.ll", "message": "failed at head"}],
+                "platform": "linux-x86_64",
+            },
+            self.db_connection,
+            self._get_commit_index("6d746c616e676c65796d746c616e676c65796d74"),
+        )
+        explanation_request = {
+            "failures": [
+                {"name": "c.ll", "message": "failed in way 1"},
+                {"name": "b.ll", "message": "failed at head"},
+                {"name": "a.ll", "message": "failed in way 1"},
+                {"name": "b.ll", "message": "failed in way 1"},
+            ],
+            "base_commit_sha": "6d746c616e676c65796d746c616e676c65796d74",
+            "platform": "linux-x86_64",
+        }
+        self.assertListEqual(
+            advisor_lib.explain_failures(
+                explanation_request,
+                self._get_commit_index(explanation_request["base_commit_sha"]),
+                self.db_connection,
+            ),
+            [
+                {"name": "c.ll", "explained": False, "reason": None},
+                {
+                    "name": "b.ll",
+                    "explained": True,
+                    "reason": "This test is already failing at the base commit.",
+                },
+                {
+                    "name": "a.ll",
+                    "explained": True,
+                    "reason": "This test is flaky in main.",
+                },
+                {"name": "b.ll", "explained": False, "reason": None},
+            ],
+        )
+
     def _setup_flaky_test_identification_info(self):
         failures = []
         # Setup a range of consistently failing tests that happen on sequential
@@ -468,6 +1205,7 @@ class AdvisorLibTest(unittest.TestCase):
                     "consistently_failing.ll",
                     "consistently failing test",
                     "linux-x86_64",
+                    advisor_lib.fingerprint_message("consistently failing test"),
                 )
             )
         # Setup a range of failing tests that are spread out over commits, which
@@ -482,10 +1220,11 @@ class AdvisorLibTest(unittest.TestCase):
                     "flaky_failing.ll",
                     "test that is flaky",
                     "linux-x86_64",
+                    advisor_lib.fingerprint_message("test that is flaky"),
                 )
             )
         self.db_connection.executemany(
-            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?)", failures
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)", failures
         )
         self.db_connection.commit()
 
@@ -496,10 +1235,35 @@ class AdvisorLibTest(unittest.TestCase):
             [
                 {
                     "test_name": "flaky_failing.ll",
+                    "platform": "linux-x86_64",
                     "first_failed_index": 10,
                     "last_failed_index": 140,
                     "failure_range_commit_count": 130,
                     "fail_count": 14,
+                    # The failures span 140 commits, failing on 1 in 10.
+                    "flakiness_score": 140 / 200 * (1 - 14 / 140),
                 }
             ],
         )
+
+    # Test that failures whose base commit has not been indexed yet do not
+    # break flaky test identification.
+    def test_find_flaky_tests_unindexed(self):
+        self.db_connection.executemany(
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    "postcommit",
+                    str(i),
+                    None,
+                    str(i),
+                    "unindexed.ll",
+                    "test that is flaky",
+                    "linux-x86_64",
+                    advisor_lib.fingerprint_message("test that is flaky"),
+                )
+                for i in range(1, 15)
+            ],
+        )
+        self.db_connection.commit()
+        self.assertListEqual(advisor_lib.get_flaky_tests(self.db_connection), [])
@@ -0,0 +1,146 @@
+"""Benchmark the latency of explaining failures against a populated database.
+
+This fills a fresh database with a synthetic failure history of a given size
+and then times advisor_lib.explain_failures for a realistic request size.
+
+Example usage:
+  python3 explain_benchmark.py --stored-failures 10000 100000 1000000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import advisor_lib
+import git_utils
+
+PLATFORMS = ["linux-x86_64", "linux-arm64", "windows-x86_64"]
+BASE_COMMIT_SHA = "6d746c616e676c65796d746c616e676c65796d74"
+
+
+def populate_db(db_connection, stored_failure_count: int, test_file_count: int):
+    max_commit_index = max(stored_failure_count // 50, 1000)
+    db_connection.execute(
+        "INSERT INTO commits VALUES(?, ?)", (BASE_COMMIT_SHA, max_commit_index)
+    )
+    random_generator = random.Random(0)
+    failures = []
+    for failure_index in range(stored_failure_count):
+        test_index = random_generator.randrange(test_file_count)
+        commit_index = random_generator.randrange(1, max_commit_index + 1)
+        failure_message = f"test_{test_index}.ll failed in way {test_index % 3}"
+        failures.append(
+            (
+                "postcommit",
+                str(commit_index),
+                commit_index,
+                str(failure_index),
+                f"test_{test_index}.ll",
+                failure_message,
+                random_generator.choice(PLATFORMS),
+                advisor_lib.fingerprint_message(failure_message),
+            )
+        )
+    db_connection.executemany(
+        "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)", failures
+    )
+    db_connection.commit()
+
+
+def generate_explanation_request(
+    random_generator: random.Random,
+    request_failure_count: int,
+    test_file_count: int,
+) -> advisor_lib.TestExplanationRequest:
+    failures = []
+    for _ in range(request_failure_count):
+        test_index = random_generator.randrange(test_file_count)
+        failures.append(
+            {
+                "name": f"test_{test_index}.ll",
+                "message": f"test_{test_index}.ll failed in way "
+                f"{random_generator.randrange(3)}",
+            }
+        )
+    return {
+        "base_commit_sha": BASE_COMMIT_SHA,
+        "failures": failures,
+        "platform": random_generator.choice(PLATFORMS),
+    }
+
+
+def _run_benchmark(
+    stored_failure_count: int,
+    request_failure_count: int,
+    test_file_count: int,
+    iterations: int,
+):
+    with tempfile.TemporaryDirectory() as working_dir:
+        db_connection = advisor_lib.setup_db(os.path.join(working_dir, "db"))
+        populate_db(db_connection, stored_failure_count, test_file_count)
+
+        random_generator = random.Random(1)
+        latencies = []
+        for _ in range(iterations):
+            explanation_request = generate_explanation_request(
+                random_generator, request_failure_count, test_file_count
+            )
+            start_time = time.perf_counter()
+            advisor_lib.explain_failures(
+                explanation_request,
+                git_utils.get_commit_index(
+                    explanation_request["base_commit_sha"], db_connection
+                ),
+                db_connection,
+            )
+            latencies.append(time.perf_counter() - start_time)
+        db_connection.close()
+
+    latencies.sort()
+    print(
+        f"{stored_failure_count:>10} stored failures: "
+        f"median {statistics.median(latencies) * 1000:.1f}ms, "
+        f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms, "
+        f"max {latencies[-1] * 1000:.1f}ms "
+        f"({request_failure_count} failures per request)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--stored-failures",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="The number of failures to store in the database before timing.",
+    )
+    parser.add_argument(
+        "--request-failures",
+        type=int,
+        default=200,
+        help="The number of failures in each explanation request.",
+    )
+    parser.add_argument(
+        "--test-files",
+        type=int,
+        default=20000,
+        help="The number of distinct test files failures are spread across.",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=20,
+        help="The number of explanation requests to time.",
+    )
+    args = parser.parse_args()
+    for stored_failure_count in args.stored_failures:
+        _run_benchmark(
+            stored_failure_count,
+            args.request_failures,
+            args.test_files,
+            args.iterations,
+        )
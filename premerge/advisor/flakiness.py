@@ -0,0 +1,228 @@
+"""Score how likely tests are to be flaky from their postcommit failure history.
+
+Postcommit failures are counted per test, platform, failure message and bucket
+of BUCKET_COMMITS consecutive commits in the failure_buckets table, which is
+kept up to date by triggers as failures are uploaded. Scores are computed from
+these counts for many tests at once with array operations, so that the whole
+test population can be scored in milliseconds.
+
+A test is scored by two properties of its failures:
+  - Spread: how many commits lie between its first and last failure. Tests
+    that fail over a long span of commits have failed repeatedly rather than
+    once. The spread factor grows linearly up to full_confidence_span_commits.
+  - Intermittency: one minus its failure rate, as failures per commit, in the
+    worst window of window_commits commits within that span. Tests that are
+    broken fail on most commits until they are fixed, while flaky tests fail
+    on a small fraction of them.
+The confidence that a test is flaky is the product of the two, between zero
+and one.
+
+This file can also be run to score the tests in a database, so that the
+thresholds can be tuned against historical data.
+
+Example usage:
+  python3 flakiness.py --db /db/advisor_db.sqlite --min-confidence 0.5
+"""
+
+from typing import TypedDict
+import argparse
+import json
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+# The number of commits each bucket in the failure_buckets table covers. This
+# is fixed by the schema migration that creates the table and cannot be
+# changed without rebuilding it.
+BUCKET_COMMITS = 10
+
+DEFAULT_WINDOW_COMMITS = 200
+DEFAULT_FULL_CONFIDENCE_SPAN_COMMITS = 200
+
+
+class FlakinessScores(TypedDict):
+    """Scores of a number of tests, with one array entry per test."""
+
+    key_ids: np.ndarray
+    failure_count: np.ndarray
+    span_commits: np.ndarray
+    peak_failure_rate: np.ndarray
+    confidence: np.ndarray
+
+
+def score_failure_buckets(
+    key_ids: np.ndarray,
+    bucket_indices: np.ndarray,
+    failure_counts: np.ndarray,
+    window_commits: int = DEFAULT_WINDOW_COMMITS,
+    full_confidence_span_commits: int = DEFAULT_FULL_CONFIDENCE_SPAN_COMMITS,
+) -> FlakinessScores:
+    """Score the flakiness of tests from their failure bucket counts.
+
+    Args:
+      key_ids: The test each bucket count belongs to. Bucket counts must be
+        sorted by key and then by bucket index, with one count per bucket.
+      bucket_indices: The index of the bucket of each count.
+      failure_counts: The number of failures in each bucket.
+      window_commits: The size of the windows to compute failure rates over.
+      full_confidence_span_commits: How many commits failures need to be
+        spread over for the spread not to reduce the confidence.
+
+    Returns:
+      The scores of each distinct key, in the order of key_ids.
+    """
+    key_ids = np.asarray(key_ids, dtype=np.int64)
+    bucket_indices = np.asarray(bucket_indices, dtype=np.int64)
+    failure_counts = np.asarray(failure_counts, dtype=np.int64)
+    if len(key_ids) == 0:
+        return {
+            "key_ids": key_ids,
+            "failure_count": failure_counts,
+            "span_commits": bucket_indices,
+            "peak_failure_rate": np.zeros(0),
+            "confidence": np.zeros(0),
+        }
+    key_starts = np.flatnonzero(np.r_[True, key_ids[1:] != key_ids[:-1]])
+    key_bucket_counts = np.diff(np.r_[key_starts, len(key_ids)])
+    first_buckets = bucket_indices[key_starts]
+    last_buckets = bucket_indices[key_starts + key_bucket_counts - 1]
+    span_buckets = last_buckets - first_buckets + 1
+
+    # Only windows starting at a bucket with failures need to be looked at to
+    # find the worst window, as moving the start of any other window forward
+    # to the next such bucket does not lower its failure rate. Windows are
+    # kept within the span of the failures, and cover all of it for tests
+    # whose failures span less than a window.
+    row_window_buckets = np.repeat(
+        np.minimum(span_buckets, -(-window_commits // BUCKET_COMMITS)),
+        key_bucket_counts,
+    )
+    window_starts = np.minimum(
+        bucket_indices,
+        np.repeat(last_buckets + 1, key_bucket_counts) - row_window_buckets,
+    )
+    # Find the bounds of the windows in the sorted bucket counts, keeping the
+    # buckets of different keys apart by giving each key its own stride.
+    key_ranks = np.repeat(np.arange(len(key_starts)), key_bucket_counts)
+    stride = int(bucket_indices.max() - bucket_indices.min()) + 1
+    row_positions = key_ranks * stride + bucket_indices - bucket_indices.min()
+    window_start_positions = np.searchsorted(
+        row_positions, row_positions - (bucket_indices - window_starts)
+    )
+    window_end_positions = np.searchsorted(
+        row_positions,
+        row_positions - (bucket_indices - window_starts) + row_window_buckets,
+    )
+    cumulative_failures = np.r_[0, np.cumsum(failure_counts)]
+    window_failure_rates = np.minimum(
+        1.0,
+        (
+            cumulative_failures[window_end_positions]
+            - cumulative_failures[window_start_positions]
+        )
+        / (row_window_buckets * BUCKET_COMMITS),
+    )
+    peak_failure_rates = np.maximum.reduceat(window_failure_rates, key_starts)
+
+    span_commits = span_buckets * BUCKET_COMMITS
+    return {
+        "key_ids": key_ids[key_starts],
+        "failure_count": np.add.reduceat(failure_counts, key_starts),
+        "span_commits": span_commits,
+        "peak_failure_rate": peak_failure_rates,
+        "confidence": np.minimum(1.0, span_commits / full_confidence_span_commits)
+        * (1.0 - peak_failure_rates),
+    }
+
+
+def load_test_failure_buckets(
+    db_connection: sqlite3.Connection,
+) -> tuple[list[tuple[str, str]], np.ndarray, np.ndarray, np.ndarray]:
+    """Load the failure bucket counts of every test on every platform.
+
+    Failures with different messages are counted together.
+
+    Returns:
+      The test file and platform of each key, and the key IDs, bucket indices
+      and failure counts to score, as taken by score_failure_buckets. Key IDs
+      index into the list of tests.
+    """
+    tests = db_connection.execute(
+        "SELECT DISTINCT test_file, platform FROM failure_buckets "
+        "ORDER BY test_file, platform"
+    ).fetchall()
+    bucket_rows = np.array(
+        db_connection.execute(
+            "SELECT DENSE_RANK() OVER (ORDER BY test_file, platform) - 1, "
+            "bucket_index, SUM(failure_count) FROM failure_buckets "
+            "GROUP BY test_file, platform, bucket_index "
+            "ORDER BY test_file, platform, bucket_index"
+        ).fetchall(),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    return tests, bucket_rows[:, 0], bucket_rows[:, 1], bucket_rows[:, 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", required=True, help="The advisor database.")
+    parser.add_argument(
+        "--window-commits",
+        type=int,
+        default=DEFAULT_WINDOW_COMMITS,
+        help="The size of the windows to compute failure rates over.",
+    )
+    parser.add_argument(
+        "--full-confidence-span-commits",
+        type=int,
+        default=DEFAULT_FULL_CONFIDENCE_SPAN_COMMITS,
+        help="How many commits failures need to be spread over for the spread "
+        "not to reduce the confidence.",
+    )
+    parser.add_argument(
+        "--min-confidence",
+        type=float,
+        default=0,
+        help="Only print tests with at least this confidence.",
+    )
+    args = parser.parse_args()
+
+    db_connection = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    tests, key_ids, bucket_indices, failure_counts = load_test_failure_buckets(
+        db_connection
+    )
+    db_connection.close()
+    start_time = time.perf_counter()
+    scores = score_failure_buckets(
+        key_ids,
+        bucket_indices,
+        failure_counts,
+        args.window_commits,
+        args.full_confidence_span_commits,
+    )
+    scoring_seconds = time.perf_counter() - start_time
+    for key_index in np.argsort(-scores["confidence"], kind="stable"):
+        if scores["confidence"][key_index] < args.min_confidence:
+            break
+        test_file, platform = tests[scores["key_ids"][key_index]]
+        print(
+            json.dumps(
+                {
+                    "test_file": test_file,
+                    "platform": platform,
+                    "confidence": round(float(scores["confidence"][key_index]), 4),
+                    "failure_count": int(scores["failure_count"][key_index]),
+                    "span_commits": int(scores["span_commits"][key_index]),
+                    "peak_failure_rate": round(
+                        float(scores["peak_failure_rate"][key_index]), 4
+                    ),
+                }
+            )
+        )
+    print(
+        f"Scored {len(tests)} tests from {len(key_ids)} failure buckets in "
+        f"{scoring_seconds * 1000:.1f}ms.",
+        file=sys.stderr,
+    )
@@ -0,0 +1,146 @@
+import random
+import tempfile
+import unittest
+
+import advisor_lib
+import flakiness
+
+
+def _get_peak_failure_rate(
+    failures_by_bucket: dict[int, int], window_commits: int
+) -> float:
+    """Compute the peak failure rate of a single test by trying every window."""
+    first_bucket = min(failures_by_bucket)
+    last_bucket = max(failures_by_bucket)
+    window_buckets = min(
+        last_bucket - first_bucket + 1, window_commits // flakiness.BUCKET_COMMITS
+    )
+    return max(
+        min(
+            1.0,
+            sum(
+                failures_by_bucket.get(bucket_index, 0)
+                for bucket_index in range(window_start, window_start + window_buckets)
+            )
+            / (window_buckets * flakiness.BUCKET_COMMITS),
+        )
+        for window_start in range(first_bucket, last_bucket - window_buckets + 2)
+    )
+
+
+class FlakinessTest(unittest.TestCase):
+    def test_score_flaky_test(self):
+        # One failure every 50 commits over 1000 commits.
+        scores = flakiness.score_failure_buckets(
+            [0] * 20, range(0, 100, 5), [1] * 20, window_commits=200
+        )
+        self.assertListEqual(scores["key_ids"].tolist(), [0])
+        self.assertListEqual(scores["failure_count"].tolist(), [20])
+        self.assertListEqual(scores["span_commits"].tolist(), [960])
+        self.assertAlmostEqual(scores["peak_failure_rate"][0], 4 / 200)
+        self.assertAlmostEqual(scores["confidence"][0], 1 - 4 / 200)
+
+    def test_score_broken_test(self):
+        # Failures on every commit for 300 commits.
+        scores = flakiness.score_failure_buckets(
+            [0] * 30, range(30), [10] * 30, window_commits=200
+        )
+        self.assertEqual(scores["peak_failure_rate"][0], 1)
+        self.assertEqual(scores["confidence"][0], 0)
+
+    def test_score_short_span(self):
+        # Two failures in the same bucket, spanning less than a window.
+        scores = flakiness.score_failure_buckets(
+            [0], [7], [2], full_confidence_span_commits=200
+        )
+        self.assertEqual(scores["span_commits"][0], 10)
+        self.assertAlmostEqual(scores["peak_failure_rate"][0], 0.2)
+        self.assertAlmostEqual(scores["confidence"][0], 10 / 200 * 0.8)
+
+    def test_score_keeps_keys_apart(self):
+        # The windows of the first key must not count the failures of the
+        # second, even though they are in adjacent buckets.
+        scores = flakiness.score_failure_buckets(
+            [3, 3, 8, 8, 8],
+            [0, 20, 21, 22, 23],
+            [1, 1, 10, 10, 10],
+            window_commits=200,
+        )
+        self.assertListEqual(scores["key_ids"].tolist(), [3, 8])
+        self.assertListEqual(scores["failure_count"].tolist(), [2, 30])
+        self.assertAlmostEqual(scores["peak_failure_rate"][0], 1 / 200)
+        self.assertEqual(scores["peak_failure_rate"][1], 1)
+
+    def test_score_matches_brute_force(self):
+        random_generator = random.Random(0)
+        key_ids = []
+        bucket_indices = []
+        failure_counts = []
+        failures_by_key = []
+        for key_id in range(50):
+            failures_by_bucket = {
+                bucket_index: random_generator.randint(1, 12)
+                for bucket_index in random_generator.sample(
+                    range(100), random_generator.randint(1, 30)
+                )
+            }
+            failures_by_key.append(failures_by_bucket)
+            for bucket_index in sorted(failures_by_bucket):
+                key_ids.append(key_id)
+                bucket_indices.append(bucket_index)
+                failure_counts.append(failures_by_bucket[bucket_index])
+        scores = flakiness.score_failure_buckets(
+            key_ids, bucket_indices, failure_counts, window_commits=150
+        )
+        for key_id, failures_by_bucket in enumerate(failures_by_key):
+            self.assertAlmostEqual(
+                scores["peak_failure_rate"][key_id],
+                _get_peak_failure_rate(failures_by_bucket, 150),
+            )
+
+    def test_score_nothing(self):
+        scores = flakiness.score_failure_buckets([], [], [])
+        self.assertEqual(len(scores["key_ids"]), 0)
+        self.assertEqual(len(scores["confidence"]), 0)
+
+    def test_load_test_failure_buckets(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            db_connection = advisor_lib.setup_db(db_file.name)
+            failures = [
+                ("a.ll", "linux-x86_64", "failed", 1),
+                ("a.ll", "linux-x86_64", "failed differently", 5),
+                ("a.ll", "linux-x86_64", "failed", 25),
+                ("a.ll", "windows-x86_64", "failed", 25),
+                ("b.ll", "linux-x86_64", "failed", 5),
+            ]
+            db_connection.executemany(
+                "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        "postcommit",
+                        str(commit_index),
+                        commit_index,
+                        str(commit_index),
+                        test_file,
+                        message,
+                        platform,
+                        advisor_lib.fingerprint_message(message),
+                    )
+                    for test_file, platform, message, commit_index in failures
+                ],
+            )
+            tests, key_ids, bucket_indices, failure_counts = (
+                flakiness.load_test_failure_buckets(db_connection)
+            )
+            db_connection.close()
+        self.assertListEqual(
+            tests,
+            [
+                ("a.ll", "linux-x86_64"),
+                ("a.ll", "windows-x86_64"),
+                ("b.ll", "linux-x86_64"),
+            ],
+        )
+        self.assertListEqual(key_ids.tolist(), [0, 0, 1, 2])
+        self.assertListEqual(bucket_indices.tolist(), [0, 2, 2, 0])
+        self.assertListEqual(failure_counts.tolist(), [2, 1, 1, 1])
@@ -1,10 +1,41 @@
+from collections.abc import Callable, Iterable
+import contextlib
 import sqlite3
 import os
 import subprocess
 import logging
+import threading
+
+import metrics
 
 REPOSITORY_URL = "https://github.com/llvm/llvm-project"
 FIRST_COMMIT_SHA = "f8f7f1b67c8ee5d81847955dc36fab86a6d129ad"
+MAIN_REF = "origin/main"
+
+# How long a request waits for the background indexer to pick up a commit
+# that has not been indexed yet.
+DEFAULT_INDEX_WAIT_TIMEOUT_SECONDS = 10
+
+
+def _run_git(
+    git_arguments: list[str], cwd: str, **kwargs
+) -> subprocess.CompletedProcess:
+    """Run a git command, recording how long it took and whether it failed."""
+    # Skip over configuration options to find the name of the git command.
+    command_index = 0
+    while git_arguments[command_index] == "-c":
+        command_index += 2
+    git_command = git_arguments[command_index]
+    try:
+        with metrics.GIT_COMMAND_SECONDS.labels(git_command).time():
+            git_process = subprocess.run(["git", *git_arguments], cwd=cwd, **kwargs)
+    except subprocess.CalledProcessError:
+        metrics.GIT_COMMANDS.labels(git_command, "failure").inc()
+        raise
+    metrics.GIT_COMMANDS.labels(
+        git_command, "success" if git_process.returncode == 0 else "failure"
+    ).inc()
+    return git_process
 
 
 def clone_repository_if_not_present(
@@ -12,22 +43,29 @@ def clone_repository_if_not_present(
 ):
     if not os.path.exists(os.path.join(repository_path, ".git")):
         logging.info("Cloning git repository.")
-        subprocess.run(
-            ["git", "clone", repository_url, os.path.basename(repository_path)],
+        _run_git(
+            ["clone", repository_url, os.path.basename(repository_path)],
             cwd=os.path.dirname(repository_path),
             check=True,
         )
         logging.info("Finished cloning git repository.")
 
 
-def _get_and_add_commit_index(
-    commit_sha: str,
+def add_commit_indices(
+    commit_ref: str,
     repository_path: str,
     db_connection: sqlite3.Connection,
-    first_commit_sha,
+    first_commit_sha: str = FIRST_COMMIT_SHA,
 ) -> int | None:
-    # Ensure the repository is up to date.
-    subprocess.run(["git", "fetch"], cwd=repository_path, check=True)
+    """Index all commits up to commit_ref that are not yet in the DB.
+
+    This also fills in the commit index of any failures that were uploaded
+    before their base commit was indexed. The caller is responsible for
+    committing the transaction.
+
+    Returns:
+      The index of commit_ref, or None if no new commits were indexed.
+    """
     # Get the highest indexed commit so we can ensure we only add new
     # commits.
     latest_commit_info = db_connection.execute(
@@ -39,8 +77,8 @@ def _get_and_add_commit_index(
     else:
         latest_sha = first_commit_sha
         latest_index = 1
-    log_output = subprocess.run(
-        ["git", "log", "--oneline", "--no-abbrev", f"{latest_sha}..{commit_sha}"],
+    log_output = _run_git(
+        ["log", "--oneline", "--no-abbrev", f"{latest_sha}..{commit_ref}"],
         cwd=repository_path,
         stdout=subprocess.PIPE,
     )
@@ -52,39 +90,345 @@ def _get_and_add_commit_index(
     log_lines = log_output.stdout.decode("utf-8").split("\n")[:-1]
     if len(log_lines) == 0:
         # We did not find any commits. This means that the commit likely
-        # happened before the commit with index 1. Return None in this case.
+        # happened before the commit with index 1, or that there are no new
+        # commits. Return None in this case.
         return None
     commit_index = latest_index + len(log_lines) + 1
     for log_line in log_lines:
         line_commit_sha = log_line.split(" ")[0]
         commit_index -= 1
         commits_to_add.append((line_commit_sha, commit_index))
-    db_connection.executemany("INSERT INTO commits VALUES(?, ?)", commits_to_add)
     if not latest_commit_info:
         commits_to_add.append((first_commit_sha, 1))
+    with metrics.DB_QUERY_SECONDS.labels("index_commits").time():
+        db_connection.executemany(
+            "INSERT OR IGNORE INTO commits VALUES(?, ?)", commits_to_add
+        )
+        db_connection.executemany(
+            "UPDATE failures SET commit_index=? "
+            "WHERE base_commit_sha=? AND commit_index IS NULL",
+            [(commit_index, commit_sha) for commit_sha, commit_index in commits_to_add],
+        )
     return commits_to_add[0][1]
 
 
+def get_merge_base(
+    commit_sha: str, repository_path: str, main_ref: str = MAIN_REF
+) -> str | None:
+    """Find the commit on main that a commit not on main is based on.
+
+    This fetches the commit directly if it is not present in the repository,
+    which is usually the case for the base commits of stacked PRs.
+    """
+    for attempt in range(2):
+        merge_base_output = _run_git(
+            ["merge-base", commit_sha, main_ref],
+            cwd=repository_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        if merge_base_output.returncode == 0:
+            return merge_base_output.stdout.decode("utf-8").strip()
+        if attempt == 0:
+            _run_git(
+                ["fetch", "origin", commit_sha],
+                cwd=repository_path,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+    return None
+
+
+def add_merge_base_indices(
+    merge_bases: dict[str, str], db_connection: sqlite3.Connection
+):
+    """Record the index of the merge base on main of commits not on main.
+
+    This lets stacked PRs use the index of the commit they are based on in
+    main. The caller is responsible for committing the transaction.
+
+    Args:
+      merge_bases: A mapping from commit SHAs to the SHA of their merge base
+        on main.
+      db_connection: The database connection.
+    """
+    merge_base_indices = []
+    for commit_sha, merge_base_sha in merge_bases.items():
+        merge_base_index = _lookup_commit_index(merge_base_sha, db_connection)
+        if merge_base_index is None:
+            logging.warning(
+                "Merge base %s of commit %s is not indexed.",
+                merge_base_sha,
+                commit_sha,
+            )
+            continue
+        merge_base_indices.append((commit_sha, merge_base_index))
+    with metrics.DB_QUERY_SECONDS.labels("index_merge_bases").time():
+        db_connection.executemany(
+            "INSERT OR REPLACE INTO merge_bases VALUES(?, ?)", merge_base_indices
+        )
+        db_connection.executemany(
+            "UPDATE failures SET commit_index=? "
+            "WHERE base_commit_sha=? AND commit_index IS NULL",
+            [
+                (commit_index, commit_sha)
+                for commit_sha, commit_index in merge_base_indices
+            ],
+        )
+
+
+def _count_pending_postcommit_failures(db_connection: sqlite3.Connection) -> int:
+    return db_connection.execute(
+        "SELECT COUNT(*) FROM failures "
+        "WHERE commit_index IS NULL AND source_type='postcommit'"
+    ).fetchone()[0]
+
+
+class CommitIndexer:
+    """Keeps the commits table up to date in the background.
+
+    The indexer periodically fetches the repository and indexes any new
+    commits on main, so that requests only ever need to look commit indices
+    up. Requests for a commit that has not been indexed yet can ask for an
+    early update and wait a bounded amount of time for it to finish.
+
+    Commits that are not on main, like the base commits of stacked PRs, are
+    resolved to their merge base on main during the update that follows the
+    request. The result is cached in the merge_bases table, so each commit
+    only needs to be resolved once.
+
+    after_failures_indexed is called after an update filled in the commit
+    index of postcommit failures uploaded before their base commit was
+    indexed, so that anything derived from them can be dropped.
+    """
+
+    def __init__(
+        self,
+        repository_path: str,
+        write_connection: Callable[
+            [], contextlib.AbstractContextManager[sqlite3.Connection]
+        ],
+        fetch_interval_seconds: float = 60,
+        main_ref: str = MAIN_REF,
+        first_commit_sha: str = FIRST_COMMIT_SHA,
+        after_failures_indexed: Callable[[], None] | None = None,
+    ):
+        self._repository_path = repository_path
+        self._write_connection = write_connection
+        self._fetch_interval_seconds = fetch_interval_seconds
+        self._main_ref = main_ref
+        self._first_commit_sha = first_commit_sha
+        self._after_failures_indexed = after_failures_indexed
+        self._update_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._updates_changed = threading.Condition()
+        self._started_updates = 0
+        self._finished_updates = 0
+        self._successful_updates = 0
+        self._pending_commit_shas: set[str] = set()
+        self._thread = threading.Thread(
+            target=self._run, name="commit-indexer", daemon=True
+        )
+
+    @property
+    def ready(self) -> bool:
+        """Whether the indexer has successfully finished at least one update."""
+        with self._updates_changed:
+            return self._successful_updates > 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._update_requested.set()
+        self._thread.join()
+
+    def update(self, commit_shas_to_resolve: Iterable[str] = ()):
+        """Fetch the repository and index any new commits on main.
+
+        Args:
+          commit_shas_to_resolve: Commits to find the merge base on main for if
+            they are not on main themselves.
+
+        Raises:
+          subprocess.CalledProcessError: If fetching or resolving main failed.
+          RuntimeError: If main could not be indexed.
+        """
+        # Keep the commit-graph up to date so that merge base computations can
+        # use generation numbers rather than walking history.
+        _run_git(
+            ["-c", "fetch.writeCommitGraph=true", "fetch"],
+            cwd=self._repository_path,
+            check=True,
+        )
+        main_sha = (
+            _run_git(
+                ["rev-parse", "--verify", f"{self._main_ref}^{{commit}}"],
+                cwd=self._repository_path,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            .stdout.decode("utf-8")
+            .strip()
+        )
+        merge_bases = {}
+        for commit_sha in commit_shas_to_resolve:
+            merge_base_sha = get_merge_base(
+                commit_sha, self._repository_path, self._main_ref
+            )
+            if merge_base_sha is not None and merge_base_sha != commit_sha:
+                merge_bases[commit_sha] = merge_base_sha
+        with self._write_connection() as db_connection:
+            pending_failures = _count_pending_postcommit_failures(db_connection)
+            add_commit_indices(
+                main_sha,
+                self._repository_path,
+                db_connection,
+                self._first_commit_sha,
+            )
+            # add_commit_indices also returns None if there were no new
+            # commits, so check that main ended up indexed instead.
+            if _lookup_commit_index(main_sha, db_connection) is None:
+                raise RuntimeError(f"Failed to index {self._main_ref} at {main_sha}.")
+            add_merge_base_indices(merge_bases, db_connection)
+            db_connection.commit()
+            failures_indexed = (
+                _count_pending_postcommit_failures(db_connection) < pending_failures
+            )
+        if failures_indexed and self._after_failures_indexed is not None:
+            self._after_failures_indexed()
+
+    def wait_for_update(
+        self, timeout_seconds: float, commit_shas: Iterable[str] = ()
+    ) -> bool:
+        """Request an update and wait for it to finish.
+
+        Args:
+          timeout_seconds: How long to wait for the update to finish.
+          commit_shas: Commits to resolve to their merge base on main during
+            the update if they are not on main themselves.
+
+        Returns:
+          Whether an update that started after this call finished within the
+          timeout.
+        """
+        with self._updates_changed:
+            target_update = self._started_updates + 1
+            self._pending_commit_shas.update(commit_shas)
+            self._update_requested.set()
+            return self._updates_changed.wait_for(
+                lambda: self._finished_updates >= target_update, timeout_seconds
+            )
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._update_requested.clear()
+            with self._updates_changed:
+                self._started_updates += 1
+                commit_shas_to_resolve = self._pending_commit_shas
+                self._pending_commit_shas = set()
+            try:
+                self.update(commit_shas_to_resolve)
+                succeeded = True
+            except Exception:
+                logging.exception("Failed to update the commit index.")
+                succeeded = False
+            with self._updates_changed:
+                self._finished_updates += 1
+                self._successful_updates += succeeded
+                self._updates_changed.notify_all()
+            self._update_requested.wait(self._fetch_interval_seconds)
+
+
 def get_commit_index(
     commit_sha: str,
-    repository_path: str,
     db_connection: sqlite3.Connection,
-    first_commit_sha=FIRST_COMMIT_SHA,
+    commit_indexer: CommitIndexer | None = None,
+    wait_timeout_seconds: float = DEFAULT_INDEX_WAIT_TIMEOUT_SECONDS,
 ) -> int | None:
-    clone_repository_if_not_present(repository_path)
-    # Check to see if we already have the commit in the DB.
-    commit_matches = db_connection.execute(
-        "SELECT commit_index FROM commits WHERE commit_sha=?", (commit_sha,)
-    ).fetchall()
-    if len(commit_matches) > 1:
-        raise ValueError(
-            "Expected only one entry per commit SHA, but got "
-            f"{len(commit_matches)}: {commit_matches}"
+    """Look up the index of a commit.
+
+    Args:
+      commit_sha: The SHA of the commit to look up.
+      db_connection: The database connection.
+      commit_indexer: If set, the indexer to ask for an update if the commit
+        has not been indexed yet.
+      wait_timeout_seconds: How long to wait for the indexer to finish an
+        update before giving up.
+
+    Returns:
+      The index of the commit, or of its merge base on main for commits that
+      are not on main. None if it is not indexed (yet). Failures
+      uploaded with an unknown commit index are filled in by the indexer once
+      their base commit has been indexed.
+    """
+    commit_index = _lookup_commit_index(commit_sha, db_connection)
+    metrics.record_cache_lookup("commit_index", commit_index is not None)
+    if commit_index is not None or commit_indexer is None:
+        return commit_index
+    # We have not seen this commit before. Give the indexer a chance to pick
+    # it up, either on main or through its merge base with main.
+    with metrics.COMMIT_INDEX_WAIT_SECONDS.time():
+        updated = commit_indexer.wait_for_update(wait_timeout_seconds, [commit_sha])
+    if not updated:
+        logging.warning("Timed out waiting for commit %s to be indexed.", commit_sha)
+        return None
+    return _lookup_commit_index(commit_sha, db_connection)
+
+
+def get_commit_indices(
+    commit_shas: Iterable[str],
+    db_connection: sqlite3.Connection,
+    commit_indexer: CommitIndexer | None = None,
+    wait_timeout_seconds: float = DEFAULT_INDEX_WAIT_TIMEOUT_SECONDS,
+) -> dict[str, int | None]:
+    """Look up the indices of several commits at once.
+
+    This behaves like get_commit_index, but waits for at most one indexer
+    update covering all of the commits that have not been indexed yet.
+
+    Returns:
+      A mapping from each distinct commit SHA to its index, or None if it is
+      not indexed (yet).
+    """
+    commit_indices = {
+        commit_sha: _lookup_commit_index(commit_sha, db_connection)
+        for commit_sha in set(commit_shas)
+    }
+    missing_commit_shas = [
+        commit_sha
+        for commit_sha, commit_index in commit_indices.items()
+        if commit_index is None
+    ]
+    for commit_sha in commit_indices:
+        metrics.record_cache_lookup(
+            "commit_index", commit_sha not in missing_commit_shas
         )
-    elif len(commit_matches) == 1:
-        return commit_matches[0][0]
-    # We have not seen this commit before. Count the index and then add it to
-    # the DB.
-    return _get_and_add_commit_index(
-        commit_sha, repository_path, db_connection, first_commit_sha
-    )
+    if not missing_commit_shas or commit_indexer is None:
+        return commit_indices
+    with metrics.COMMIT_INDEX_WAIT_SECONDS.time():
+        updated = commit_indexer.wait_for_update(
+            wait_timeout_seconds, missing_commit_shas
+        )
+    if not updated:
+        logging.warning(
+            "Timed out waiting for %d commits to be indexed.", len(missing_commit_shas)
+        )
+        return commit_indices
+    for commit_sha in missing_commit_shas:
+        commit_indices[commit_sha] = _lookup_commit_index(commit_sha, db_connection)
+    return commit_indices
+
+
+def _lookup_commit_index(
+    commit_sha: str, db_connection: sqlite3.Connection
+) -> int | None:
+    with metrics.DB_QUERY_SECONDS.labels("commit_index").time():
+        commit_match = db_connection.execute(
+            "SELECT commit_index FROM commits WHERE commit_sha=:commit_sha "
+            "UNION ALL "
+            "SELECT commit_index FROM merge_bases WHERE commit_sha=:commit_sha",
+            {"commit_sha": commit_sha},
+        ).fetchone()
+    return commit_match[0] if commit_match else None
@@ -15,44 +15,45 @@ class GitUtilsTest(unittest.TestCase):
         self.repository_path = tempfile.TemporaryDirectory()
 
     def tearDown(self):
+        self.db_connection.close()
         self.db_file.close()
         self.repository_path.cleanup()
 
-    def setup_repository(self, commit_count: int) -> list[str]:
-        subprocess.run(["git", "init"], cwd=self.repository_path.name, check=True)
-        for commit_index in range(commit_count):
-            with open(
-                os.path.join(self.repository_path.name, str(commit_index)), "w"
-            ) as commit_file:
-                commit_file.write("test")
-            subprocess.run(
-                ["git", "add", "--all"], cwd=self.repository_path.name, check=True
-            )
-            subprocess.run(
-                [
-                    "git",
-                    "-c",
-                    "user.name='test'",
-                    "-c",
-                    "user.email='test@example.com",
-                    "commit",
-                    "-m",
-                    "message",
-                ],
-                cwd=self.repository_path.name,
-                check=True,
-            )
-        log_process = subprocess.run(
-            ["git", "log", "--oneline", "--no-abbrev"],
+    def add_commit(self, file_name: str) -> str:
+        with open(
+            os.path.join(self.repository_path.name, file_name), "w"
+        ) as commit_file:
+            commit_file.write("test")
+        subprocess.run(
+            ["git", "add", "--all"], cwd=self.repository_path.name, check=True
+        )
+        subprocess.run(
+            [
+                "git",
+                "-c",
+                "user.name='test'",
+                "-c",
+                "user.email='test@example.com",
+                "commit",
+                "-m",
+                "message",
+            ],
+            cwd=self.repository_path.name,
+            check=True,
+        )
+        rev_parse_process = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
             cwd=self.repository_path.name,
             stdout=subprocess.PIPE,
             check=True,
         )
-        commit_shas = []
-        for log_line in log_process.stdout.decode("utf-8").split("\n")[:-1]:
-            commit_shas.append(log_line.split(" ")[0])
-        commit_shas.reverse()
-        return commit_shas
+        return rev_parse_process.stdout.decode("utf-8").strip()
+
+    def setup_repository(self, commit_count: int) -> list[str]:
+        subprocess.run(["git", "init"], cwd=self.repository_path.name, check=True)
+        return [
+            self.add_commit(str(commit_index)) for commit_index in range(commit_count)
+        ]
 
     def test_clone_repository(self):
         self.setup_repository(5)
@@ -70,7 +71,6 @@ class GitUtilsTest(unittest.TestCase):
         self.assertEqual(len(log_process.stdout.decode("utf-8").split("\n")) - 1, 5)
 
     def test_get_index_from_db(self):
-        self.setup_repository(1)
         self.db_connection.execute(
             "INSERT INTO commits VALUES(?, ?)",
             ("f3939dc5093826c05f2a78ce1b0af769cd48fdab", 5),
@@ -78,16 +78,23 @@ class GitUtilsTest(unittest.TestCase):
         self.assertEqual(
             git_utils.get_commit_index(
                 "f3939dc5093826c05f2a78ce1b0af769cd48fdab",
-                self.repository_path.name,
                 self.db_connection,
             ),
             5,
         )
 
+    def test_get_index_not_indexed(self):
+        self.assertIsNone(
+            git_utils.get_commit_index(
+                "f3939dc5093826c05f2a78ce1b0af769cd48fdab",
+                self.db_connection,
+            )
+        )
+
     def test_get_first_commit_from_git(self):
         commit_shas = self.setup_repository(2)
         self.assertEqual(
-            git_utils.get_commit_index(
+            git_utils.add_commit_indices(
                 commit_shas[1],
                 self.repository_path.name,
                 self.db_connection,
@@ -95,6 +102,9 @@ class GitUtilsTest(unittest.TestCase):
             ),
             2,
         )
+        self.assertEqual(
+            git_utils.get_commit_index(commit_shas[0], self.db_connection), 1
+        )
 
     def test_get_index_from_git(self):
         commit_shas = self.setup_repository(3)
@@ -102,7 +112,7 @@ class GitUtilsTest(unittest.TestCase):
             "INSERT INTO commits VALUES(?, ?)", (commit_shas[1], 3)
         )
         self.assertEqual(
-            git_utils.get_commit_index(
+            git_utils.add_commit_indices(
                 commit_shas[2], self.repository_path.name, self.db_connection
             ),
             4,
@@ -114,22 +124,19 @@ class GitUtilsTest(unittest.TestCase):
             "INSERT INTO commits VALUES(?, ?)", (commit_shas[1], 3)
         )
         self.assertEqual(
-            git_utils.get_commit_index(
+            git_utils.add_commit_indices(
                 commit_shas[3], self.repository_path.name, self.db_connection
             ),
             5,
         )
         self.assertEqual(
-            git_utils.get_commit_index(
-                commit_shas[2], self.repository_path.name, self.db_connection
-            ),
-            4,
+            git_utils.get_commit_index(commit_shas[2], self.db_connection), 4
         )
 
     def test_get_index_error_invalid_sha(self):
         commit_shas = self.setup_repository(3)
         self.assertIsNone(
-            git_utils.get_commit_index(
+            git_utils.add_commit_indices(
                 commit_shas[0],
                 self.repository_path.name,
                 self.db_connection,
@@ -140,7 +147,211 @@ class GitUtilsTest(unittest.TestCase):
     def test_get_index_error_before_first_commit(self):
         commit_shas = self.setup_repository(3)
         self.assertIsNone(
-            git_utils.get_commit_index(
-                "bad_sha", self.repository_path.name, self.db_connection, commit_shas[0]
+            git_utils.add_commit_indices(
+                "bad_sha",
+                self.repository_path.name,
+                self.db_connection,
+                commit_shas[0],
             )
         )
+
+    def test_fill_in_pending_failure_indices(self):
+        commit_shas = self.setup_repository(3)
+        self.db_connection.execute(
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                "postcommit",
+                commit_shas[2],
+                None,
+                "1",
+                "a.ll",
+                "failed",
+                "linux",
+                advisor_lib.fingerprint_message("failed"),
+            ),
+        )
+        git_utils.add_commit_indices(
+            commit_shas[2],
+            self.repository_path.name,
+            self.db_connection,
+            commit_shas[0],
+        )
+        self.assertListEqual(
+            self.db_connection.execute("SELECT commit_index FROM failures").fetchall(),
+            [(3,)],
+        )
+        self.assertListEqual(
+            self.db_connection.execute(
+                "SELECT failure_count, first_commit_index, last_commit_index "
+                "FROM failure_aggregates"
+            ).fetchall(),
+            [(1, 3, 3)],
+        )
+        self.assertListEqual(
+            self.db_connection.execute(
+                "SELECT bucket_index, failure_count FROM failure_buckets"
+            ).fetchall(),
+            [(0, 1)],
+        )
+
+    def add_stacked_commit(self, base_commit_sha: str) -> str:
+        subprocess.run(
+            ["git", "checkout", "-q", "-b", "stacked", base_commit_sha],
+            cwd=self.repository_path.name,
+            check=True,
+        )
+        stacked_commit_sha = self.add_commit("stacked")
+        subprocess.run(
+            ["git", "checkout", "-q", "-"], cwd=self.repository_path.name, check=True
+        )
+        return stacked_commit_sha
+
+    def test_get_merge_base(self):
+        commit_shas = self.setup_repository(3)
+        stacked_commit_sha = self.add_stacked_commit(commit_shas[1])
+        self.assertEqual(
+            git_utils.get_merge_base(
+                stacked_commit_sha, self.repository_path.name, "HEAD"
+            ),
+            commit_shas[1],
+        )
+        self.assertIsNone(
+            git_utils.get_merge_base("bad_sha", self.repository_path.name, "HEAD")
+        )
+
+    def test_get_index_from_merge_base(self):
+        self.db_connection.execute(
+            "INSERT INTO commits VALUES(?, ?)",
+            ("f3939dc5093826c05f2a78ce1b0af769cd48fdab", 5),
+        )
+        self.db_connection.execute(
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                "pull_request",
+                "abcdef",
+                None,
+                "1",
+                "a.ll",
+                "failed",
+                "linux",
+                advisor_lib.fingerprint_message("failed"),
+            ),
+        )
+        git_utils.add_merge_base_indices(
+            {"abcdef": "f3939dc5093826c05f2a78ce1b0af769cd48fdab"},
+            self.db_connection,
+        )
+        self.assertEqual(git_utils.get_commit_index("abcdef", self.db_connection), 5)
+        self.assertListEqual(
+            self.db_connection.execute("SELECT commit_index FROM failures").fetchall(),
+            [(5,)],
+        )
+
+    def test_commit_indexer(self):
+        commit_shas = self.setup_repository(3)
+        db_pool = advisor_lib.ConnectionPool(self.db_file.name)
+        commit_indexer = git_utils.CommitIndexer(
+            self.repository_path.name,
+            db_pool.write_connection,
+            fetch_interval_seconds=3600,
+            main_ref="HEAD",
+            first_commit_sha=commit_shas[0],
+        )
+        self.assertFalse(commit_indexer.ready)
+        commit_indexer.start()
+        with db_pool.read_connection() as db_connection:
+            self.assertEqual(
+                git_utils.get_commit_index(
+                    commit_shas[2], db_connection, commit_indexer
+                ),
+                3,
+            )
+            self.assertTrue(commit_indexer.ready)
+            # Commits that land after the last update should be picked up by
+            # an update triggered by the lookup.
+            new_commit_sha = self.add_commit("3")
+            self.assertEqual(
+                git_utils.get_commit_index(
+                    new_commit_sha, db_connection, commit_indexer
+                ),
+                4,
+            )
+            # Commits that are not on main should resolve to the index of their
+            # merge base with main.
+            stacked_commit_sha = self.add_stacked_commit(commit_shas[1])
+            self.assertEqual(
+                git_utils.get_commit_index(
+                    stacked_commit_sha, db_connection, commit_indexer
+                ),
+                2,
+            )
+            self.assertIsNone(
+                git_utils.get_commit_index("bad_sha", db_connection, commit_indexer)
+            )
+        commit_indexer.stop()
+        db_pool.close()
+
+    # Test that the indexer is not ready until main has actually been indexed.
+    def test_commit_indexer_not_ready_if_main_not_indexed(self):
+        commit_shas = self.setup_repository(3)
+        db_pool = advisor_lib.ConnectionPool(self.db_file.name)
+        commit_indexer = git_utils.CommitIndexer(
+            self.repository_path.name,
+            db_pool.write_connection,
+            fetch_interval_seconds=3600,
+            main_ref="HEAD",
+            first_commit_sha="0" * 40,
+        )
+        with self.assertRaises(RuntimeError):
+            commit_indexer.update()
+        commit_indexer = git_utils.CommitIndexer(
+            self.repository_path.name,
+            db_pool.write_connection,
+            fetch_interval_seconds=3600,
+            main_ref="missing",
+            first_commit_sha=commit_shas[0],
+        )
+        with self.assertRaises(subprocess.CalledProcessError):
+            commit_indexer.update()
+        commit_indexer.start()
+        self.assertTrue(commit_indexer.wait_for_update(10))
+        self.assertFalse(commit_indexer.ready)
+        commit_indexer.stop()
+        with db_pool.read_connection() as db_connection:
+            self.assertListEqual(
+                db_connection.execute("SELECT * FROM commits").fetchall(), []
+            )
+        db_pool.close()
+
+    def test_commit_indexer_after_failures_indexed(self):
+        commit_shas = self.setup_repository(3)
+        self.db_connection.execute(
+            "INSERT INTO failures VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                "postcommit",
+                commit_shas[2],
+                None,
+                "1",
+                "a.ll",
+                "failed",
+                "linux",
+                advisor_lib.fingerprint_message("failed"),
+            ),
+        )
+        self.db_connection.commit()
+        db_pool = advisor_lib.ConnectionPool(self.db_file.name)
+        indexed_updates = []
+        commit_indexer = git_utils.CommitIndexer(
+            self.repository_path.name,
+            db_pool.write_connection,
+            main_ref="HEAD",
+            first_commit_sha=commit_shas[0],
+            after_failures_indexed=lambda: indexed_updates.append(True),
+        )
+        commit_indexer.update()
+        self.assertEqual(len(indexed_updates), 1)
+        # Updates that do not fill in any commit indices should not call it.
+        self.add_commit("3")
+        commit_indexer.update()
+        self.assertEqual(len(indexed_updates), 1)
+        db_pool.close()
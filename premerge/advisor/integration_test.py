@@ -1,3 +1,4 @@
+import json
 import unittest
 import tempfile
 import os
@@ -38,6 +39,28 @@ class AdvisorIntegrationTest(unittest.TestCase):
         result = self.client.post("/upload", json=failure_info)
         self.assertEqual(result.status_code, 204)
 
+    def test_upload_failure_batch(self):
+        failure_info = {
+            "source_type": "buildbot",
+            "base_commit_sha": "e375fbb0917869e940c189ee0c178155b104b28a",
+            "source_id": "10000",
+            "failures": [
+                {"name": "a.ll", "message": "failed in way 1"},
+            ],
+            "platform": "linux-x86_64",
+        }
+        result = self.client.post(
+            "/upload_batch",
+            data="\n".join([json.dumps(failure_info), "{", json.dumps(failure_info)]),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json["uploaded_failures"], 2)
+        self.assertListEqual(
+            [record["status"] for record in result.json["records"]],
+            ["uploaded", "error", "uploaded"],
+        )
+
     def test_explain_failures(self):
         explanation_request = {
             "failures": [{"name": "a.ll", "message": "failed"}],
@@ -49,8 +72,14 @@ class AdvisorIntegrationTest(unittest.TestCase):
         self.assertListEqual(
             result.json, [{"name": "a.ll", "explained": False, "reason": None}]
         )
+        self.app.config["EXPLANATION_LOGGER"].flush()
         self.assertEqual(len(os.listdir(self.debug_folder.name)), 1)
 
+    def test_ready(self):
+        result = self.client.get("/ready")
+        self.assertIn(result.status_code, [200, 503])
+        self.assertEqual(result.json["commit_indexer_ready"], result.status_code == 200)
+
     def test_flaky_tests(self):
         result = self.client.get("/flaky_tests")
         self.assertEqual(result.status_code, 200)
@@ -0,0 +1,211 @@
+"""Load test the advisor server against a local stand-in database.
+
+This starts the advisor with server.py, the way it is served in production,
+on a local port. It is backed by a freshly populated database and a
+placeholder repository, so no network access is needed. The base commit used
+by requests is indexed ahead of time.
+
+The load test sends a mix of /explain and /upload requests from a number of
+concurrent clients and reports the achieved requests per second and latency.
+It then shuts the server down and checks that it exits cleanly.
+
+Example usage:
+  python3 load_test.py --concurrency 32 --duration 30 --server-threads 32
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import advisor_lib
+import explain_benchmark
+
+# How long to wait for the server to start or shut down.
+_SERVER_TIMEOUT_SECONDS = 60
+
+
+def _send_request(url: str, method: str, body: dict):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method=method,
+    )
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def _run_client(
+    server_url: str,
+    client_index: int,
+    args: argparse.Namespace,
+    deadline: float,
+    latencies: list[float],
+    errors: list[Exception],
+):
+    random_generator = random.Random(client_index)
+    while time.monotonic() < deadline:
+        explanation_request = explain_benchmark.generate_explanation_request(
+            random_generator, args.request_failures, args.test_files
+        )
+        start_time = time.perf_counter()
+        try:
+            if random_generator.random() < args.upload_fraction:
+                _send_request(
+                    server_url + "/upload",
+                    "POST",
+                    {
+                        "source_type": "postcommit",
+                        "source_id": str(client_index),
+                        **explanation_request,
+                    },
+                )
+            else:
+                _send_request(server_url + "/explain", "GET", explanation_request)
+        except Exception as request_error:
+            errors.append(request_error)
+            continue
+        latencies.append(time.perf_counter() - start_time)
+
+
+def _get_free_port() -> int:
+    with socket.socket() as port_socket:
+        port_socket.bind(("127.0.0.1", 0))
+        return port_socket.getsockname()[1]
+
+
+def _wait_for_server(server_url: str, server_process: subprocess.Popen):
+    deadline = time.monotonic() + _SERVER_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if server_process.poll() is not None:
+            raise RuntimeError("The server exited before it started serving.")
+        try:
+            with urllib.request.urlopen(server_url + "/ready") as response:
+                response.read()
+            return
+        except urllib.error.HTTPError:
+            # The server is up, but not ready.
+            return
+        except urllib.error.URLError:
+            time.sleep(0.1)
+    raise RuntimeError("Timed out waiting for the server to start.")
+
+
+def _run_load_test(server_url: str, args: argparse.Namespace):
+    deadline = time.monotonic() + args.duration
+    latencies: list[float] = []
+    errors: list[Exception] = []
+    clients = [
+        threading.Thread(
+            target=_run_client,
+            args=(server_url, client_index, args, deadline, latencies, errors),
+        )
+        for client_index in range(args.concurrency)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    if not latencies:
+        print(f"All {len(errors)} requests failed, the first with: {errors[0]}")
+        return
+    latencies.sort()
+    print(
+        f"{len(latencies) / args.duration:.1f} requests/second with "
+        f"{args.concurrency} concurrent clients, "
+        f"median latency {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+        f"p95 latency {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, "
+        f"{len(errors)} errors"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--stored-failures",
+        type=int,
+        default=100000,
+        help="The number of failures to store in the database before starting.",
+    )
+    parser.add_argument(
+        "--test-files",
+        type=int,
+        default=20000,
+        help="The number of distinct test files failures are spread across.",
+    )
+    parser.add_argument(
+        "--request-failures",
+        type=int,
+        default=20,
+        help="The number of failures in each request.",
+    )
+    parser.add_argument(
+        "--upload-fraction",
+        type=float,
+        default=0.1,
+        help="The fraction of requests that are uploads rather than explains.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="The number of clients sending requests concurrently.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=20,
+        help="How long to send requests for, in seconds.",
+    )
+    parser.add_argument(
+        "--server-threads",
+        type=int,
+        default=32,
+        help="The number of threads the server serves requests with.",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        # Use an empty repository so the commit indexer has nothing to do. The
+        # base commit is indexed ahead of time instead.
+        repository_path = os.path.join(working_dir, "llvm-project")
+        subprocess.run(["git", "init", "-q", repository_path], check=True)
+        db_path = os.path.join(working_dir, "db")
+        db_connection = advisor_lib.setup_db(db_path)
+        explain_benchmark.populate_db(
+            db_connection, args.stored_failures, args.test_files
+        )
+        db_connection.close()
+
+        server_port = _get_free_port()
+        server_process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(__file__), "server.py")],
+            env={
+                **os.environ,
+                "ADVISOR_DB_PATH": db_path,
+                "ADVISOR_REPO_PATH": repository_path,
+                "ADVISOR_PORT": str(server_port),
+                "ADVISOR_THREADS": str(args.server_threads),
+                "ADVISOR_DEBUG_FOLDER": os.path.join(working_dir, "debug"),
+                "ADVISOR_DEBUG_SAMPLE_RATE": "0",
+            },
+        )
+        server_url = f"http://127.0.0.1:{server_port}"
+        try:
+            _wait_for_server(server_url, server_process)
+            _run_load_test(server_url, args)
+        finally:
+            server_process.send_signal(signal.SIGTERM)
+            exit_code = server_process.wait(_SERVER_TIMEOUT_SECONDS)
+        print(f"The server shut down with exit code {exit_code}.")
@@ -0,0 +1,132 @@
+"""Prometheus metrics for the premerge advisor.
+
+The metrics are defined here rather than in the app so that advisor_lib and
+git_utils can record them wherever the work happens. They are exported in the
+Prometheus text format by the /metrics endpoint of the advisor.
+"""
+
+from collections.abc import Callable
+import contextlib
+import logging
+import sqlite3
+import threading
+
+import prometheus_client
+
+_DB_QUERY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+_GIT_COMMAND_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUEST_SECONDS = prometheus_client.Histogram(
+    "advisor_request_duration_seconds",
+    "Time spent serving requests, by route.",
+    ["route", "method", "status"],
+)
+DB_QUERY_SECONDS = prometheus_client.Histogram(
+    "advisor_db_query_duration_seconds",
+    "Time spent running database queries, by kind of query.",
+    ["query"],
+    buckets=_DB_QUERY_BUCKETS,
+)
+GIT_COMMAND_SECONDS = prometheus_client.Histogram(
+    "advisor_git_command_duration_seconds",
+    "Time spent running git commands, by git command.",
+    ["command"],
+    buckets=_GIT_COMMAND_BUCKETS,
+)
+GIT_COMMANDS = prometheus_client.Counter(
+    "advisor_git_commands",
+    "Git commands run, by git command and whether they succeeded.",
+    ["command", "outcome"],
+)
+COMMIT_INDEX_WAIT_SECONDS = prometheus_client.Histogram(
+    "advisor_commit_index_wait_duration_seconds",
+    "Time requests spent waiting for the commit indexer to index a commit.",
+    buckets=_GIT_COMMAND_BUCKETS,
+)
+CACHE_LOOKUPS = prometheus_client.Counter(
+    "advisor_cache_lookups",
+    "Lookups in caches, by cache and whether they hit.",
+    ["cache", "result"],
+)
+TABLE_ROWS = prometheus_client.Gauge(
+    "advisor_table_rows",
+    "Rows in database tables, as of the last refresh.",
+    ["table"],
+)
+
+_COUNTED_TABLES = ["failures", "failure_aggregates", "commits", "merge_bases"]
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def update_table_rows(db_connection: sqlite3.Connection):
+    with DB_QUERY_SECONDS.labels("table_rows").time():
+        for table in _COUNTED_TABLES:
+            TABLE_ROWS.labels(table).set(
+                db_connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            )
+
+
+class TableRowsUpdater:
+    """Periodically refreshes the table row counts in the background.
+
+    Counting the rows scans the tables, so it is done on a slow timer rather
+    than on every scrape of the metrics.
+    """
+
+    def __init__(
+        self,
+        read_connection: Callable[
+            [], contextlib.AbstractContextManager[sqlite3.Connection]
+        ],
+        interval_seconds: float = 300,
+    ):
+        self._read_connection = read_connection
+        self._interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="table-rows-updater", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                with self._read_connection() as db_connection:
+                    update_table_rows(db_connection)
+            except Exception:
+                logging.exception("Failed to count the rows in database tables.")
+            if self._stopped.wait(self._interval_seconds):
+                return
+
+
+def render() -> tuple[bytes, str]:
+    """Render all metrics in the Prometheus text format.
+
+    Returns:
+      The rendered metrics and their content type.
+    """
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,123 @@
+import subprocess
+import tempfile
+import unittest
+
+import prometheus_client
+
+import advisor_lib
+import git_utils
+import metrics
+
+
+def _get_sample_value(name: str, labels: dict[str, str]) -> float:
+    return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile()
+        self.db_connection = advisor_lib.setup_db(self.db_file.name)
+
+    def tearDown(self):
+        self.db_connection.close()
+        self.db_file.close()
+
+    def test_update_table_rows(self):
+        self.db_connection.execute("INSERT INTO commits VALUES(?, ?)", ("abcdef", 1))
+        metrics.update_table_rows(self.db_connection)
+        self.assertEqual(
+            _get_sample_value("advisor_table_rows", {"table": "commits"}), 1
+        )
+        self.assertEqual(
+            _get_sample_value("advisor_table_rows", {"table": "failures"}), 0
+        )
+
+    def test_table_rows_updater(self):
+        self.db_connection.executemany(
+            "INSERT INTO commits VALUES(?, ?)", [("abcdef", 1), ("123456", 2)]
+        )
+        self.db_connection.commit()
+        db_pool = advisor_lib.ConnectionPool(self.db_file.name)
+        table_rows_updater = metrics.TableRowsUpdater(
+            db_pool.read_connection, interval_seconds=3600
+        )
+        table_rows_updater.start()
+        table_rows_updater.stop()
+        db_pool.close()
+        self.assertEqual(
+            _get_sample_value("advisor_table_rows", {"table": "commits"}), 2
+        )
+
+    def test_records_db_queries(self):
+        explain_queries = _get_sample_value(
+            "advisor_db_query_duration_seconds_count", {"query": "explain"}
+        )
+        advisor_lib.explain_failures(
+            {
+                "failures": [{"name": "a.ll", "message": "failed"}],
+                "base_commit_sha": "abcdef",
+                "platform": "linux-x86_64",
+            },
+            None,
+            self.db_connection,
+        )
+        self.assertEqual(
+            _get_sample_value(
+                "advisor_db_query_duration_seconds_count", {"query": "explain"}
+            ),
+            explain_queries + 1,
+        )
+
+    def test_records_commit_index_lookups(self):
+        self.db_connection.execute("INSERT INTO commits VALUES(?, ?)", ("abcdef", 1))
+        hits = _get_sample_value(
+            "advisor_cache_lookups_total", {"cache": "commit_index", "result": "hit"}
+        )
+        misses = _get_sample_value(
+            "advisor_cache_lookups_total", {"cache": "commit_index", "result": "miss"}
+        )
+        git_utils.get_commit_indices(["abcdef", "123456"], self.db_connection)
+        self.assertEqual(
+            _get_sample_value(
+                "advisor_cache_lookups_total",
+                {"cache": "commit_index", "result": "hit"},
+            ),
+            hits + 1,
+        )
+        self.assertEqual(
+            _get_sample_value(
+                "advisor_cache_lookups_total",
+                {"cache": "commit_index", "result": "miss"},
+            ),
+            misses + 1,
+        )
+
+    def test_records_git_commands(self):
+        with tempfile.TemporaryDirectory() as repository_path:
+            subprocess.run(["git", "init", "-q"], cwd=repository_path, check=True)
+            failures = _get_sample_value(
+                "advisor_git_commands_total",
+                {"command": "merge-base", "outcome": "failure"},
+            )
+            self.assertIsNone(
+                git_utils.get_merge_base("abcdef", repository_path, "HEAD")
+            )
+        # The merge base is looked up again after trying to fetch the commit.
+        self.assertEqual(
+            _get_sample_value(
+                "advisor_git_commands_total",
+                {"command": "merge-base", "outcome": "failure"},
+            ),
+            failures + 2,
+        )
+        self.assertGreater(
+            _get_sample_value(
+                "advisor_git_command_duration_seconds_count", {"command": "fetch"}
+            ),
+            0,
+        )
+
+    def test_render(self):
+        rendered_metrics, content_type = metrics.render()
+        self.assertIn(b"advisor_request_duration_seconds", rendered_metrics)
+        self.assertTrue(content_type.startswith("text/plain"))
@@ -0,0 +1,105 @@
+"""Benchmark the throughput of failure message normalization.
+
+The corpus is either read from the failures table of an existing advisor
+database, or generated from templates resembling lit and sanitizer output.
+
+Example usage:
+  python3 normalization_benchmark.py --db /path/to/advisor.db
+  python3 normalization_benchmark.py --messages 20000
+"""
+
+import argparse
+import random
+import sqlite3
+import time
+
+import advisor_lib
+
+_MESSAGE_TEMPLATES = [
+    "Exit Code: 1\n\nCommand Output (stderr):\n--\n"
+    "/home/gha/actions-runner/_work/llvm-project/llvm-project/llvm/test/"
+    "CodeGen/X86/test_{index}.ll:{line}:{column}: error: CHECK-NEXT: expected "
+    "string not found in input\n; CHECK-NEXT: movl %edi, %eax\n"
+    "<stdin>:{line}:{column}: note: scanning from here\n",
+    "=={pid}==ERROR: AddressSanitizer: heap-use-after-free on address "
+    "0x{address:012x} at pc 0x{address:012x} bp 0x{address:012x}\n"
+    "READ of size 8 at 0x{address:012x} thread T0\n"
+    "    #0 0x{address:012x} in foo /home/gha/llvm-project/clang/lib/"
+    "Sema/Sema_{index}.cpp:{line}:{column}\n",
+    "error: unable to open '/tmp/lit-tmp-{pid:x}/test_{index}.o': "
+    "No such file or directory\nReached timeout of 60s at "
+    "2025-10-01T12:{column:02d}:{line:02d}Z, killed process {pid}\n",
+]
+
+
+def _generate_corpus(message_count: int, message_size: int) -> list[str]:
+    random_generator = random.Random(0)
+    corpus = []
+    for _ in range(message_count):
+        message_parts = []
+        message_length = 0
+        while message_length < message_size:
+            message_part = random_generator.choice(_MESSAGE_TEMPLATES).format(
+                index=random_generator.randrange(100),
+                line=random_generator.randrange(1, 60),
+                column=random_generator.randrange(1, 60),
+                pid=random_generator.randrange(1, 1 << 22),
+                address=random_generator.randrange(1 << 44, 1 << 47),
+            )
+            message_parts.append(message_part)
+            message_length += len(message_part)
+        corpus.append("".join(message_parts))
+    return corpus
+
+
+def _read_corpus(db_path: str, message_count: int) -> list[str]:
+    connection = sqlite3.connect(db_path)
+    corpus = [
+        failure_message
+        for (failure_message,) in connection.execute(
+            "SELECT failure_message FROM failures LIMIT ?", (message_count,)
+        )
+    ]
+    connection.close()
+    return corpus
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--db",
+        help="An advisor database to read failure messages from. If not set, "
+        "a synthetic corpus is used.",
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=10000,
+        help="The maximum number of messages in the corpus.",
+    )
+    parser.add_argument(
+        "--message-size",
+        type=int,
+        default=2048,
+        help="The approximate size of synthetic messages, in bytes.",
+    )
+    args = parser.parse_args()
+
+    if args.db:
+        corpus = _read_corpus(args.db, args.messages)
+    else:
+        corpus = _generate_corpus(args.messages, args.message_size)
+    corpus_size = sum(len(message.encode("utf-8")) for message in corpus)
+
+    for benchmark_name, benchmark_function in [
+        ("normalize_message", advisor_lib.normalize_message),
+        ("fingerprint_message", advisor_lib.fingerprint_message),
+    ]:
+        start_time = time.perf_counter()
+        fingerprints = {benchmark_function(message) for message in corpus}
+        elapsed_time = time.perf_counter() - start_time
+        print(
+            f"{benchmark_name}: {len(corpus) / elapsed_time:.0f} messages/second, "
+            f"{corpus_size / elapsed_time / (1 << 20):.1f} MiB/second, "
+            f"{len(corpus)} messages normalized to {len(fingerprints)} distinct"
+        )
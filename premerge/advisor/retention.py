@@ -0,0 +1,315 @@
+"""Age out old failures and compact the advisor database.
+
+Only the failures close to the head of main are needed to explain failures at
+head. Older history is only used to find flaky tests, which is answered from
+the failure_aggregates table that is updated as failures are uploaded. Aging
+out failures older than a retention window therefore keeps the failures table,
+and with it the cost of explaining failures, bounded without losing any flaky
+test history. Aged out failures can optionally be moved to a separate archive
+database instead of being deleted.
+
+The server runs retention periodically when configured to do so. This file can
+also be run by operators. Explanations cached by a running server are not
+invalidated by failures aged out from here, and can be used until they expire.
+
+Example usage:
+  python3 retention.py --db /db/advisor_db.sqlite stats
+  python3 retention.py --db /db/advisor_db.sqlite age-out \\
+      --retention-commits 50000 --archive /db/advisor_archive.sqlite
+  python3 retention.py --db /db/advisor_db.sqlite compact --full
+"""
+
+from collections.abc import Callable
+import argparse
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+
+import advisor_lib
+import metrics
+
+# How many rows of the failures table to look at per transaction when aging
+# out failures, so that uploads are not blocked for long.
+DEFAULT_BATCH_SIZE = 10000
+
+# Only give free pages back to the file system once there is at least this
+# much free space in the database.
+DEFAULT_MIN_FREE_BYTES = 64 << 20
+
+# The value of the auto_vacuum pragma for incremental vacuuming.
+_AUTO_VACUUM_INCREMENTAL = 2
+
+WriteConnection = Callable[[], contextlib.AbstractContextManager[sqlite3.Connection]]
+
+
+def get_head_commit_index(db_connection: sqlite3.Connection) -> int | None:
+    return db_connection.execute("SELECT MAX(commit_index) FROM commits").fetchone()[0]
+
+
+def age_out_failures(
+    write_connection: WriteConnection,
+    min_commit_index: int,
+    archive_db_path: str | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    """Remove failures from before a commit from the failures table.
+
+    The failures have already been counted in the failure aggregates when they
+    were uploaded, so removing them does not change which tests are flaky.
+    Failures whose base commit has not been indexed are kept.
+
+    Args:
+      write_connection: Returns a context manager holding the database
+        connection to write to. It is entered once per batch, so that other
+        writers can make progress in between.
+      min_commit_index: Failures with a lower commit index are aged out.
+      archive_db_path: If set, a database to move aged out failures to rather
+        than deleting them.
+      batch_size: How many rows to look at per transaction.
+
+    Returns:
+      The number of failures that were aged out.
+    """
+    if archive_db_path is not None:
+        with write_connection() as db_connection:
+            db_connection.execute("ATTACH DATABASE ? AS archive", (archive_db_path,))
+            db_connection.execute(
+                "CREATE TABLE IF NOT EXISTS archive.failures AS "
+                "SELECT * FROM main.failures WHERE 0"
+            )
+            db_connection.commit()
+    aged_out_failures = 0
+    last_rowid = 0
+    try:
+        while True:
+            with write_connection() as db_connection:
+                batch_end_rowid = db_connection.execute(
+                    "SELECT MAX(rowid) FROM (SELECT rowid FROM main.failures "
+                    "WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                    (last_rowid, batch_size),
+                ).fetchone()[0]
+                if batch_end_rowid is None:
+                    return aged_out_failures
+                batch_condition = "rowid > ? AND rowid <= ? AND commit_index < ?"
+                batch_params = (last_rowid, batch_end_rowid, min_commit_index)
+                if archive_db_path is not None:
+                    db_connection.execute(
+                        "INSERT INTO archive.failures SELECT * FROM main.failures "
+                        f"WHERE {batch_condition}",
+                        batch_params,
+                    )
+                aged_out_failures += db_connection.execute(
+                    f"DELETE FROM main.failures WHERE {batch_condition}",
+                    batch_params,
+                ).rowcount
+                db_connection.commit()
+                last_rowid = batch_end_rowid
+    finally:
+        if archive_db_path is not None:
+            with write_connection() as db_connection:
+                db_connection.execute("DETACH DATABASE archive")
+
+
+def compact_db(
+    write_connection: WriteConnection,
+    min_free_bytes: int = DEFAULT_MIN_FREE_BYTES,
+    full: bool = False,
+) -> bool:
+    """Give space freed by aging out failures back to the file system.
+
+    Databases created before incremental vacuuming was enabled need a single
+    full compaction to enable it. A full compaction rewrites the whole database
+    and blocks all other access to it while it runs, so it is only done when
+    requested.
+
+    Args:
+      write_connection: Returns a context manager holding the database
+        connection to write to.
+      min_free_bytes: Only compact the database if at least this much space is
+        free in it.
+      full: Whether to rewrite the whole database rather than only releasing
+        free pages.
+
+    Returns:
+      Whether the database was compacted.
+    """
+    with write_connection() as db_connection:
+        compacted = False
+        if full:
+            db_connection.execute(
+                f"PRAGMA auto_vacuum={_AUTO_VACUUM_INCREMENTAL}"
+            ).fetchall()
+            db_connection.execute("VACUUM")
+            compacted = True
+        elif (
+            db_connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+            != _AUTO_VACUUM_INCREMENTAL
+        ):
+            logging.warning(
+                "Incremental vacuuming is not enabled for the database. Run a "
+                "full compaction once to enable it."
+            )
+        elif get_db_stats(db_connection)["free_bytes"] >= min_free_bytes:
+            # Each step of the statement frees a single page. Unlike execute,
+            # executescript steps it until all free pages are released.
+            db_connection.executescript("PRAGMA incremental_vacuum;")
+            compacted = True
+        # Keep the write-ahead log from holding on to the space as well.
+        db_connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return compacted
+
+
+def get_db_stats(db_connection: sqlite3.Connection) -> dict[str, int | None]:
+    page_size = db_connection.execute("PRAGMA page_size").fetchone()[0]
+    page_count = db_connection.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = db_connection.execute("PRAGMA freelist_count").fetchone()[0]
+    failure_count, min_commit_index, max_commit_index = db_connection.execute(
+        "SELECT COUNT(*), MIN(commit_index), MAX(commit_index) FROM failures"
+    ).fetchone()
+    return {
+        "size_bytes": page_count * page_size,
+        "free_bytes": freelist_count * page_size,
+        "failures": failure_count,
+        "failure_aggregates": db_connection.execute(
+            "SELECT COUNT(*) FROM failure_aggregates"
+        ).fetchone()[0],
+        "min_failure_commit_index": min_commit_index,
+        "max_failure_commit_index": max_commit_index,
+        "head_commit_index": get_head_commit_index(db_connection),
+    }
+
+
+def run_retention(
+    write_connection: WriteConnection,
+    retention_commits: int,
+    archive_db_path: str | None = None,
+    min_free_bytes: int = DEFAULT_MIN_FREE_BYTES,
+) -> int:
+    """Age out failures outside of the retention window and compact the db.
+
+    Args:
+      write_connection: Returns a context manager holding the database
+        connection to write to.
+      retention_commits: How many commits before the head of main to keep
+        failures for.
+      archive_db_path: If set, a database to move aged out failures to.
+      min_free_bytes: Only compact the database if at least this much space is
+        free in it.
+
+    Returns:
+      The number of failures that were aged out.
+    """
+    if retention_commits <= advisor_lib.EXPLAINED_HEAD_MAX_COMMIT_INDEX_DIFFERENCE:
+        raise ValueError(
+            "The retention window needs to cover the commits used to explain "
+            "failures at head."
+        )
+    with write_connection() as db_connection:
+        head_commit_index = get_head_commit_index(db_connection)
+    if head_commit_index is None:
+        return 0
+    with metrics.DB_QUERY_SECONDS.labels("age_out").time():
+        aged_out_failures = age_out_failures(
+            write_connection, head_commit_index - retention_commits, archive_db_path
+        )
+    logging.info(
+        "Aged out %d failures from before commit index %d.",
+        aged_out_failures,
+        head_commit_index - retention_commits,
+    )
+    with metrics.DB_QUERY_SECONDS.labels("compact").time():
+        compact_db(write_connection, min_free_bytes)
+    return aged_out_failures
+
+
+class RetentionScheduler:
+    """Periodically runs retention on the database in the background.
+
+    after_age_out is called after failures were aged out, so that anything
+    derived from them, like cached explanations, can be dropped.
+    """
+
+    def __init__(
+        self,
+        write_connection: WriteConnection,
+        retention_commits: int,
+        interval_seconds: float = 3600,
+        archive_db_path: str | None = None,
+        min_free_bytes: int = DEFAULT_MIN_FREE_BYTES,
+        after_age_out: Callable[[], None] | None = None,
+    ):
+        self._write_connection = write_connection
+        self._retention_commits = retention_commits
+        self._interval_seconds = interval_seconds
+        self._archive_db_path = archive_db_path
+        self._min_free_bytes = min_free_bytes
+        self._after_age_out = after_age_out
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="retention-scheduler", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval_seconds):
+            try:
+                aged_out_failures = run_retention(
+                    self._write_connection,
+                    self._retention_commits,
+                    self._archive_db_path,
+                    self._min_free_bytes,
+                )
+                if aged_out_failures and self._after_age_out is not None:
+                    self._after_age_out()
+            except Exception:
+                logging.exception("Failed to run retention on the database.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", required=True, help="The advisor database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Print statistics about the database.")
+    age_out_parser = subparsers.add_parser(
+        "age-out",
+        help="Age out failures outside of the retention window and compact the "
+        "database.",
+    )
+    age_out_parser.add_argument(
+        "--retention-commits",
+        type=int,
+        required=True,
+        help="How many commits before the head of main to keep failures for.",
+    )
+    age_out_parser.add_argument(
+        "--archive", help="A database to move aged out failures to."
+    )
+    compact_parser = subparsers.add_parser(
+        "compact", help="Give free space in the database back to the file system."
+    )
+    compact_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Rewrite the whole database. This enables incremental compaction "
+        "for databases created before it was supported. The server should be "
+        "stopped while this runs.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db_connection = advisor_lib.setup_db(args.db)
+    write_connection = lambda: contextlib.nullcontext(db_connection)
+    if args.command == "age-out":
+        run_retention(write_connection, args.retention_commits, args.archive, 0)
+    elif args.command == "compact":
+        compact_db(write_connection, 0, args.full)
+    print(json.dumps(get_db_stats(db_connection), indent=2))
+    db_connection.close()
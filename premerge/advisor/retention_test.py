@@ -0,0 +1,135 @@
+import contextlib
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import advisor_lib
+import retention
+
+
+class RetentionTest(unittest.TestCase):
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile()
+        self.db_connection = advisor_lib.setup_db(self.db_file.name)
+        self.db_connection.executemany(
+            "INSERT INTO commits VALUES(?, ?)",
+            [(f"commit_{commit_index}", commit_index) for commit_index in range(100)],
+        )
+        self.db_connection.commit()
+
+    def tearDown(self):
+        self.db_connection.close()
+        self.db_file.close()
+
+    def write_connection(self):
+        return contextlib.nullcontext(self.db_connection)
+
+    def upload_failures(self, commit_indices: list[int | None], message="failed"):
+        for source_id, commit_index in enumerate(commit_indices):
+            advisor_lib.upload_failures(
+                {
+                    "source_type": "postcommit",
+                    "base_commit_sha": f"commit_{commit_index}",
+                    "source_id": str(source_id),
+                    "failures": [{"name": "a.ll", "message": message}],
+                    "platform": "linux-x86_64",
+                },
+                self.db_connection,
+                commit_index,
+            )
+
+    def get_failure_commit_indices(self) -> list[int | None]:
+        return [
+            commit_index
+            for (commit_index,) in self.db_connection.execute(
+                "SELECT commit_index FROM failures ORDER BY rowid"
+            )
+        ]
+
+    def test_age_out_failures(self):
+        self.upload_failures([10, 50, None, 20, 90])
+        self.assertEqual(
+            retention.age_out_failures(self.write_connection, 50, batch_size=2), 2
+        )
+        self.assertListEqual(self.get_failure_commit_indices(), [50, None, 90])
+        # Aged out failures should still count towards finding flaky tests.
+        self.assertListEqual(
+            self.db_connection.execute(
+                "SELECT failure_count, first_commit_index, last_commit_index "
+                "FROM failure_aggregates"
+            ).fetchall(),
+            [(5, 10, 90)],
+        )
+
+    def test_age_out_failures_to_archive(self):
+        self.upload_failures([10, 50, 20])
+        with tempfile.TemporaryDirectory() as archive_folder:
+            archive_db_path = os.path.join(archive_folder, "archive.db")
+            retention.age_out_failures(self.write_connection, 50, archive_db_path)
+            self.upload_failures([30])
+            retention.age_out_failures(self.write_connection, 50, archive_db_path)
+            archive_connection = sqlite3.connect(archive_db_path)
+            self.assertListEqual(
+                archive_connection.execute(
+                    "SELECT commit_index, message_fingerprint FROM failures"
+                ).fetchall(),
+                [
+                    (commit_index, advisor_lib.fingerprint_message("failed"))
+                    for commit_index in [10, 20, 30]
+                ],
+            )
+            archive_connection.close()
+        self.assertListEqual(self.get_failure_commit_indices(), [50])
+        self.assertNotIn(
+            "archive",
+            [
+                database_name
+                for _, database_name, _ in self.db_connection.execute(
+                    "PRAGMA database_list"
+                )
+            ],
+        )
+
+    def test_run_retention(self):
+        self.upload_failures([10, 50, 89, 90, 99])
+        self.assertEqual(retention.run_retention(self.write_connection, 10), 2)
+        self.assertListEqual(self.get_failure_commit_indices(), [89, 90, 99])
+
+    def test_run_retention_window_too_small(self):
+        with self.assertRaises(ValueError):
+            retention.run_retention(
+                self.write_connection,
+                advisor_lib.EXPLAINED_HEAD_MAX_COMMIT_INDEX_DIFFERENCE,
+            )
+
+    def test_compact_db(self):
+        self.upload_failures(range(50), message="failed" * 1000)
+        retention.age_out_failures(self.write_connection, 100)
+        free_bytes = retention.get_db_stats(self.db_connection)["free_bytes"]
+        self.assertGreater(free_bytes, 0)
+        self.assertFalse(
+            retention.compact_db(self.write_connection, min_free_bytes=free_bytes + 1)
+        )
+        self.assertTrue(
+            retention.compact_db(self.write_connection, min_free_bytes=free_bytes)
+        )
+        self.assertEqual(retention.get_db_stats(self.db_connection)["free_bytes"], 0)
+
+    def test_compact_db_enables_incremental_vacuum(self):
+        self.db_connection.execute("PRAGMA auto_vacuum=NONE")
+        self.db_connection.execute("VACUUM")
+        self.assertFalse(retention.compact_db(self.write_connection, 0))
+        self.assertTrue(retention.compact_db(self.write_connection, full=True))
+        self.assertEqual(
+            self.db_connection.execute("PRAGMA auto_vacuum").fetchone(), (2,)
+        )
+
+    def test_get_db_stats(self):
+        self.upload_failures([10, 50])
+        db_stats = retention.get_db_stats(self.db_connection)
+        self.assertEqual(db_stats["failures"], 2)
+        self.assertEqual(db_stats["failure_aggregates"], 1)
+        self.assertEqual(db_stats["min_failure_commit_index"], 10)
+        self.assertEqual(db_stats["max_failure_commit_index"], 50)
+        self.assertEqual(db_stats["head_commit_index"], 99)
@@ -1,15 +1,105 @@
+"""Serve the premerge advisor.
+
+The advisor is served by gunicorn using a single worker process with a pool of
+threads. All writes to the database go through a single connection and the
+commit indexer runs in the background of the serving process, so requests are
+served concurrently by threads within one process rather than by multiple
+processes. On SIGTERM, gunicorn stops accepting connections and gives in flight
+requests time to finish before the background work of the advisor is stopped.
+
+The server is configured through the following environment variables:
+  ADVISOR_DB_PATH: The path to the advisor database.
+  ADVISOR_REPO_PATH: The path to the llvm-project checkout used for indexing.
+  ADVISOR_PORT: The port to listen on. Defaults to 5000.
+  ADVISOR_THREADS: How many requests to serve concurrently. Defaults to 32.
+  ADVISOR_REQUEST_TIMEOUT_SECONDS: How long requests can take before they are
+    answered with a 503. Defaults to 30.
+  ADVISOR_GRACEFUL_SHUTDOWN_SECONDS: How long in flight requests get to finish
+    on shutdown. Defaults to 30.
+  ADVISOR_DEBUG_FOLDER: Where to write debug logs of explanation requests.
+    Defaults to /tmp/premerge_advisor_debug.
+  ADVISOR_DEBUG_SAMPLE_RATE: The fraction of explanation requests to write
+    debug logs for. Defaults to 1.
+  ADVISOR_RETENTION_COMMITS: If set, how many commits of failure history to
+    keep. See retention.py.
+  ADVISOR_RETENTION_ARCHIVE_PATH: If set, a database to move failures outside
+    of the retention window to.
+  ADVISOR_EXPLAIN_CACHE_ENTRIES: How many failures to cache the evidence used
+    to explain them for. 0 disables the cache. Defaults to 100000.
+  ADVISOR_EXPLAIN_CACHE_TTL_SECONDS: How long to cache the evidence for a
+    failure for. Defaults to 300.
+"""
+
 import os
 
+from gunicorn.app import base
+
 import advisor
 
 DEBUG_FOLDER_PATH = "/tmp/premerge_advisor_debug"
 
 
+class AdvisorServer(base.BaseApplication):
+    def __init__(self, options: dict, request_timeout_seconds: int):
+        self._options = options
+        self._request_timeout_seconds = request_timeout_seconds
+        super().__init__()
+
+    def load_config(self):
+        for option_name, option_value in self._options.items():
+            self.cfg.set(option_name, option_value)
+
+    def load(self):
+        # Old debug logs are kept across restarts and count towards the limits
+        # on the size of the debug folder.
+        debug_folder = os.environ.get("ADVISOR_DEBUG_FOLDER", DEBUG_FOLDER_PATH)
+        os.makedirs(debug_folder, exist_ok=True)
+        return advisor.create_app(
+            os.environ["ADVISOR_DB_PATH"],
+            os.environ["ADVISOR_REPO_PATH"],
+            debug_folder,
+            max_read_connections=int(os.environ.get("ADVISOR_THREADS", "32")),
+            debug_sample_rate=float(os.environ.get("ADVISOR_DEBUG_SAMPLE_RATE", "1")),
+            retention_commits=(
+                int(os.environ["ADVISOR_RETENTION_COMMITS"])
+                if "ADVISOR_RETENTION_COMMITS" in os.environ
+                else None
+            ),
+            retention_archive_path=os.environ.get("ADVISOR_RETENTION_ARCHIVE_PATH"),
+            request_timeout_seconds=self._request_timeout_seconds,
+            explain_cache_max_entries=int(
+                os.environ.get("ADVISOR_EXPLAIN_CACHE_ENTRIES", "100000")
+            ),
+            explain_cache_ttl_seconds=float(
+                os.environ.get("ADVISOR_EXPLAIN_CACHE_TTL_SECONDS", "300")
+            ),
+        )
+
+
+def _shutdown_worker(server, worker):
+    # Workers that failed to start do not have an app to shut down.
+    if hasattr(worker, "wsgi"):
+        advisor.shutdown_app(worker.wsgi)
+
+
 if __name__ == "__main__":
-    os.mkdir(DEBUG_FOLDER_PATH)
-    app = advisor.create_app(
-        os.environ["ADVISOR_DB_PATH"],
-        os.environ["ADVISOR_REPO_PATH"],
-        DEBUG_FOLDER_PATH,
+    request_timeout_seconds = int(
+        os.environ.get("ADVISOR_REQUEST_TIMEOUT_SECONDS", "30")
     )
-    app.run(host="0.0.0.0", port=5000)
+    AdvisorServer(
+        {
+            "bind": f"0.0.0.0:{os.environ.get('ADVISOR_PORT', '5000')}",
+            "workers": 1,
+            "worker_class": "gthread",
+            "threads": int(os.environ.get("ADVISOR_THREADS", "32")),
+            # Requests time out within the app. The worker timeout only
+            # restarts workers that stop responding altogether, like when
+            # stuck holding the GIL.
+            "timeout": request_timeout_seconds * 2,
+            "graceful_timeout": int(
+                os.environ.get("ADVISOR_GRACEFUL_SHUTDOWN_SECONDS", "30")
+            ),
+            "worker_exit": _shutdown_worker,
+        },
+        request_timeout_seconds,
+    ).run()
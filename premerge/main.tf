@@ -323,6 +323,13 @@ resource "kubernetes_secret" "operational_metrics_secrets" {
   depends_on = [kubernetes_namespace.operational_metrics]
 }
 
+resource "kubernetes_manifest" "operational_metrics_repository_pvc" {
+  manifest = yamldecode(file("./cronjobs/operational_metrics_repository_pvc.yaml"))
+  provider = kubernetes.llvm-premerge-us-central
+
+  depends_on = [kubernetes_namespace.operational_metrics]
+}
+
 resource "kubernetes_manifest" "process_llvm_commits_cronjob" {
   manifest = yamldecode(file("./cronjobs/process_llvm_commits_cronjob.yaml"))
   provider = kubernetes.llvm-premerge-us-central
@@ -331,6 +338,7 @@ resource "kubernetes_manifest" "process_llvm_commits_cronjob" {
     kubernetes_namespace.operational_metrics,
     kubernetes_secret.operational_metrics_secrets,
     kubernetes_service_account.operational_metrics_ksa,
+    kubernetes_manifest.operational_metrics_repository_pvc,
   ]
 }
 
@@ -391,6 +399,16 @@ resource "google_bigquery_table" "llvm_repository_snapshots_table" {
   depends_on = [google_bigquery_dataset.operational_metrics_dataset]
 }
 
+resource "google_bigquery_table" "llvm_sync_state_table" {
+  dataset_id  = google_bigquery_dataset.operational_metrics_dataset.dataset_id
+  table_id    = "llvm_sync_state"
+  description = "Progress of incremental syncs of LLVM data from GitHub"
+
+  schema = file("./bigquery_schema/llvm_sync_state_table_schema.json")
+
+  depends_on = [google_bigquery_dataset.operational_metrics_dataset]
+}
+
 resource "google_bigquery_dataset_iam_binding" "operational_metrics_dataset_editor_binding" {
   dataset_id = google_bigquery_dataset.operational_metrics_dataset.dataset_id
   role       = "roles/bigquery.dataEditor"
@@ -1,3 +1,4 @@
+import argparse
 import datetime
 import logging
 import os
@@ -13,11 +14,23 @@ LOOKBACK_HOURS = 4
 # when to stop checking for post-commit reviews.
 CUTOFF_AGE_DAYS = 30
 
+# The number of days after which pull requests are no longer tracked at all.
+MAXIMUM_AGE_DAYS = 180  # Six months
+
+# How far before the high-water mark to look for updates in incremental syncs.
+# Pull requests are not always searchable as soon as they are updated, and an
+# update at the high-water mark itself may not have been searchable yet either.
+SYNC_OVERLAP_MINUTES = 30
+
+# The name of the incremental sync in the sync state table.
+SYNC_NAME = "amend_pull_request_data"
+
 # BigQuery dataset and tables to write metrics to.
 OPERATIONAL_METRICS_DATASET = "operational_metrics"
 LLVM_PULL_REQUESTS_TABLE = "llvm_pull_requests"
 LLVM_REVIEWS_TABLE = "llvm_reviews"
 LLVM_REPOSITORY_SNAPSHOT_TABLE = "llvm_repository_snapshots"
+LLVM_SYNC_STATE_TABLE = "llvm_sync_state"
 
 OPEN_PULL_REQUEST_PREDICATE = (
     "LLVMPull.pull_request_state = 'OPEN' AND NOT LLVMPull.is_stale_data"
@@ -36,24 +49,25 @@ AND NOT EXISTS(
 """
 
 
-def fetch_open_pull_requests_from_github(
+def _search_pull_requests(
     github_token: str,
-    cutoff_timestamp: datetime.datetime,
-) -> list[dict[str, Any]]:
-  """Fetch open pull requests from the GitHub GraphQL API.
+    search_filter: str,
+) -> tuple[list[dict[str, Any]], int]:
+  """Search pull requests through the GitHub GraphQL API.
 
   Args:
     github_token: The GitHub API token to use for authentication.
-    cutoff_timestamp: The cutoff timestamp to use for the query.
+    search_filter: The GitHub search query to filter pull requests with.
 
   Returns:
-    A list of open pull requests from the GitHub GraphQL API.
+    All pages of pull requests the search returned, and the total number of
+    pull requests matching it. The search API returns at most 1000 results, so
+    the latter can be greater than the number of pull requests returned.
   """
-
   search_query = """
-  query($cursor: String) {{
+  query($searchFilter: String!, $cursor: String) {{
     search(
-      query: "repo:llvm/llvm-project is:pr is:open base:main created:>{cutoff_timestamp}",
+      query: $searchFilter,
       type: ISSUE,
       first: 100,
       after: $cursor
@@ -71,15 +85,16 @@ def fetch_open_pull_requests_from_github(
     }}
   }}
   """.format(
-      cutoff_timestamp=cutoff_timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
       requested_pull_request_data=operational_metrics_lib.PULL_REQUEST_GRAPHQL_DATA,
   )
 
   has_next_page = True
   cursor = None
   pull_requests = []
+  issue_count = 0
   while has_next_page:
     variables = {
+        "searchFilter": search_filter,
         "cursor": cursor,
     }
     response = operational_metrics_lib.query_github_graphql_api(
@@ -90,12 +105,86 @@ def fetch_open_pull_requests_from_github(
 
     response_data = response.json()["data"]["search"]
     pull_requests.extend(response_data["nodes"])
+    issue_count = response_data.get("issueCount", len(pull_requests))
     has_next_page = response_data["pageInfo"]["hasNextPage"]
     cursor = response_data["pageInfo"]["endCursor"]
 
+  return pull_requests, issue_count
+
+
+def fetch_open_pull_requests_from_github(
+    github_token: str,
+    cutoff_timestamp: datetime.datetime,
+) -> list[dict[str, Any]]:
+  """Fetch open pull requests from the GitHub GraphQL API.
+
+  Args:
+    github_token: The GitHub API token to use for authentication.
+    cutoff_timestamp: The cutoff timestamp to use for the query.
+
+  Returns:
+    A list of open pull requests from the GitHub GraphQL API.
+  """
+  pull_requests, _ = _search_pull_requests(
+      github_token,
+      "repo:llvm/llvm-project is:pr is:open base:main "
+      f"created:>{cutoff_timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')}",
+  )
   return pull_requests
 
 
+def fetch_updated_pull_requests_from_github(
+    github_token: str,
+    updated_since: datetime.datetime,
+    created_after: datetime.datetime,
+) -> list[dict[str, Any]]:
+  """Fetch pull requests updated since a timestamp from the GitHub GraphQL API.
+
+  Pull requests are searched for in the order they were last updated in. When
+  more pull requests were updated than a single search can return, searching
+  continues from the update time of the last pull request returned.
+
+  Args:
+    github_token: The GitHub API token to use for authentication.
+    updated_since: Only pull requests updated at or after this time are
+      fetched.
+    created_after: Only pull requests created at or after this time are
+      fetched.
+
+  Returns:
+    A list of updated pull requests from the GitHub GraphQL API, each of them
+    fetched once.
+  """
+  pull_requests_by_number = {}
+  while True:
+    pull_requests, issue_count = _search_pull_requests(
+        github_token,
+        "repo:llvm/llvm-project is:pr base:main "
+        f"created:>={created_after.strftime('%Y-%m-%dT%H:%M:%SZ')} "
+        f"updated:>={updated_since.strftime('%Y-%m-%dT%H:%M:%SZ')} "
+        "sort:updated-asc",
+    )
+    for pull_request in pull_requests:
+      pull_requests_by_number[pull_request["number"]] = pull_request
+    if not pull_requests or issue_count <= len(pull_requests):
+      break
+    last_updated_at = datetime.datetime.fromisoformat(
+        pull_requests[-1]["updatedAt"]
+    )
+    # Searching again would return the same pull requests if all of them were
+    # updated within the same second.
+    if last_updated_at <= updated_since:
+      logging.warning(
+          "More than %d pull requests were updated at %s, some may be missed.",
+          len(pull_requests),
+          updated_since,
+      )
+      break
+    updated_since = last_updated_at
+
+  return list(pull_requests_by_number.values())
+
+
 def get_pull_requests_by_age_from_bigquery(
     bq_client: bigquery.Client,
     predicate: str,
@@ -148,6 +237,37 @@ def get_pull_requests_by_age_from_bigquery(
   }
 
 
+def get_recorded_pull_requests_from_bigquery(
+    bq_client: bigquery.Client,
+    pull_request_numbers: list[int],
+) -> set[int]:
+  """Get which of the given pull requests are recorded in BigQuery.
+
+  Args:
+    bq_client: The BigQuery client to use for querying.
+    pull_request_numbers: The numbers of the pull requests to look for.
+
+  Returns:
+    The numbers of the pull requests that are recorded.
+  """
+  query = f"""
+  SELECT DISTINCT pull_request_number
+  FROM {OPERATIONAL_METRICS_DATASET}.{LLVM_PULL_REQUESTS_TABLE}
+  WHERE pull_request_number IN UNNEST(@pull_request_numbers)
+  """
+  job_config = bigquery.QueryJobConfig(
+      query_parameters=[
+          bigquery.ArrayQueryParameter(
+              "pull_request_numbers", "INT64", pull_request_numbers
+          ),
+      ],
+  )
+  return {
+      row.pull_request_number
+      for row in bq_client.query(query, job_config=job_config).result()
+  }
+
+
 def mark_stale_pull_request_data_in_bigquery(
     bq_client: bigquery.Client,
     cutoff_age_days: int,
@@ -314,7 +434,7 @@ def update_open_pull_requests_in_bigquery(
       predicate=OPEN_PULL_REQUEST_PREDICATE,
       timestamp_column="pull_request_timestamp_seconds",
       minimum_age_days=0,
-      maximum_age_days=180,  # Six months
+      maximum_age_days=MAXIMUM_AGE_DAYS,
   )
   recorded_open_pull_requests = []
   for _, pull_request_numbers in open_pull_requests_by_age.items():
@@ -372,6 +492,170 @@ def update_post_commit_reviews_in_bigquery(
   )
 
 
+def get_sync_high_water_mark(
+    bq_client: bigquery.Client,
+) -> datetime.datetime | None:
+  """Get the high-water mark of the incremental pull request sync.
+
+  Args:
+    bq_client: The BigQuery client to use for querying.
+
+  Returns:
+    The time up to which pull request updates have been synced, or None if
+    they have never been synced.
+  """
+  query = f"""
+  SELECT high_water_mark_timestamp_seconds
+  FROM {OPERATIONAL_METRICS_DATASET}.{LLVM_SYNC_STATE_TABLE}
+  WHERE sync_name = @sync_name
+  """
+  job_config = bigquery.QueryJobConfig(
+      query_parameters=[
+          bigquery.ScalarQueryParameter("sync_name", "STRING", SYNC_NAME),
+      ],
+  )
+  for row in bq_client.query(query, job_config=job_config).result():
+    return datetime.datetime.fromtimestamp(
+        row.high_water_mark_timestamp_seconds, datetime.timezone.utc
+    )
+  return None
+
+
+def record_sync_high_water_mark_in_bigquery(
+    bq_client: bigquery.Client,
+    high_water_mark: datetime.datetime,
+) -> None:
+  """Record the high-water mark of the incremental pull request sync.
+
+  Args:
+    bq_client: The BigQuery client to use for querying.
+    high_water_mark: The time up to which pull request updates have been
+      synced.
+  """
+  operational_metrics_lib.upload_to_bigquery(
+      bq_client,
+      OPERATIONAL_METRICS_DATASET,
+      LLVM_SYNC_STATE_TABLE,
+      [
+          operational_metrics_lib.LLVMSyncState(
+              sync_name=SYNC_NAME,
+              high_water_mark_timestamp_seconds=int(
+                  high_water_mark.timestamp()
+              ),
+              synced_at_timestamp_seconds=int(
+                  datetime.datetime.now(datetime.timezone.utc).timestamp()
+              ),
+          )
+      ],
+      "sync_name",
+  )
+
+
+def sync_updated_pull_requests_to_bigquery(
+    bq_client: bigquery.Client,
+    github_token: str,
+    high_water_mark: datetime.datetime,
+) -> datetime.datetime:
+  """Sync pull requests updated since the last sync with BigQuery.
+
+  This covers the pull requests that a full sync would fetch and upload:
+  recorded pull requests that are still being amended, and open pull requests
+  created within CUTOFF_AGE_DAYS that are not recorded yet. Pull requests that
+  have been marked as stale are left alone. Pull requests that have not been
+  updated since the last sync are not fetched again.
+
+  Args:
+    bq_client: The BigQuery client to use for querying.
+    github_token: The GitHub API token to use for authentication.
+    high_water_mark: The time up to which pull request updates have been
+      synced.
+
+  Returns:
+    The new high-water mark.
+  """
+  time_now = datetime.datetime.now(datetime.timezone.utc)
+  updated_since = high_water_mark - datetime.timedelta(
+      minutes=SYNC_OVERLAP_MINUTES
+  )
+  logging.info("Fetching pull requests updated since %s", updated_since)
+  updated_pull_requests = fetch_updated_pull_requests_from_github(
+      github_token=github_token,
+      updated_since=updated_since,
+      created_after=time_now - datetime.timedelta(days=MAXIMUM_AGE_DAYS),
+  )
+  if not updated_pull_requests:
+    logging.info("No pull requests were updated since %s.", updated_since)
+    return high_water_mark
+
+  # Pull requests only need to be amended if they are recorded as open and not
+  # stale, or are still waiting for a post-commit review.
+  tracked_pull_requests = set()
+  for predicate, timestamp_column, maximum_age_days in (
+      (
+          OPEN_PULL_REQUEST_PREDICATE,
+          "pull_request_timestamp_seconds",
+          MAXIMUM_AGE_DAYS,
+      ),
+      (
+          UNAPPROVED_PULL_REQUEST_PREDICATE,
+          "merged_at_timestamp_seconds",
+          CUTOFF_AGE_DAYS,
+      ),
+  ):
+    pull_requests_by_age = get_pull_requests_by_age_from_bigquery(
+        bq_client,
+        predicate=predicate,
+        timestamp_column=timestamp_column,
+        minimum_age_days=0,
+        maximum_age_days=maximum_age_days,
+    )
+    for _, pull_request_numbers in pull_requests_by_age.items():
+      tracked_pull_requests.update(pull_request_numbers)
+  # Open pull requests that are not tracked yet are only new if they are not
+  # recorded at all, rather than recorded as stale.
+  cutoff_timestamp = time_now - datetime.timedelta(days=CUTOFF_AGE_DAYS)
+  new_pull_request_candidates = [
+      pull_request["number"]
+      for pull_request in updated_pull_requests
+      if pull_request["state"] == "OPEN"
+      and pull_request["number"] not in tracked_pull_requests
+      and datetime.datetime.fromisoformat(pull_request["createdAt"])
+      > cutoff_timestamp
+  ]
+  new_pull_requests = set()
+  if new_pull_request_candidates:
+    recorded_pull_requests = get_recorded_pull_requests_from_bigquery(
+        bq_client, new_pull_request_candidates
+    )
+    new_pull_requests = set(new_pull_request_candidates).difference(
+        recorded_pull_requests
+    )
+  pull_request_data = [
+      pull_request
+      for pull_request in updated_pull_requests
+      if pull_request["number"] in tracked_pull_requests
+      or pull_request["number"] in new_pull_requests
+  ]
+
+  logging.info(
+      "Uploading %d of %d updated pull requests to BigQuery.",
+      len(pull_request_data),
+      len(updated_pull_requests),
+  )
+  if pull_request_data:
+    upload_github_data_to_bigquery(
+        bq_client,
+        pull_request_data,
+    )
+  return max(
+      high_water_mark,
+      *(
+          datetime.datetime.fromisoformat(pull_request["updatedAt"])
+          for pull_request in updated_pull_requests
+      ),
+  )
+
+
 def record_repository_snapshot_in_bigquery(
     bq_client: bigquery.Client,
 ) -> None:
@@ -388,7 +672,7 @@ def record_repository_snapshot_in_bigquery(
       predicate=OPEN_PULL_REQUEST_PREDICATE,
       timestamp_column="pull_request_timestamp_seconds",
       minimum_age_days=0,
-      maximum_age_days=180,  # Six months
+      maximum_age_days=MAXIMUM_AGE_DAYS,
   )
   open_pull_request_count_by_age = [
       {"age_in_days": age, "pull_request_count": len(pull_request_numbers)}
@@ -399,7 +683,7 @@ def record_repository_snapshot_in_bigquery(
       predicate=UNAPPROVED_PULL_REQUEST_PREDICATE,
       timestamp_column="merged_at_timestamp_seconds",
       minimum_age_days=0,
-      maximum_age_days=180,  # Six months
+      maximum_age_days=MAXIMUM_AGE_DAYS,
   )
   unapproved_pull_request_count_by_age = [
       {"age_in_days": age, "pull_request_count": len(pull_request_numbers)}
@@ -421,13 +705,10 @@ def record_repository_snapshot_in_bigquery(
   )
 
 
-def main():
+def main(full_resync: bool = False):
   github_token = os.environ["GITHUB_TOKEN"]
   bq_client = bigquery.Client()
 
-  logging.info("Syncing recent pull requests to BigQuery.")
-  sync_recent_pull_requests_to_bigquery(bq_client, github_token)
-
   # We don't want to amend data for pull requests that have been open for more
   # than CUTOFF_AGE_DAYS.
   logging.info("Marking stale pull requests in BigQuery.")
@@ -436,11 +717,25 @@ def main():
       cutoff_age_days=CUTOFF_AGE_DAYS,
   )
 
-  logging.info("Updating open pull requests in BigQuery.")
-  update_open_pull_requests_in_bigquery(bq_client, github_token)
+  high_water_mark = None if full_resync else get_sync_high_water_mark(bq_client)
+  if high_water_mark is None:
+    # Everything updated before the full sync starts is covered by it.
+    high_water_mark = datetime.datetime.now(datetime.timezone.utc)
 
-  logging.info("Updating post-commit reviews in BigQuery.")
-  update_post_commit_reviews_in_bigquery(bq_client, github_token)
+    logging.info("Syncing recent pull requests to BigQuery.")
+    sync_recent_pull_requests_to_bigquery(bq_client, github_token)
+
+    logging.info("Updating open pull requests in BigQuery.")
+    update_open_pull_requests_in_bigquery(bq_client, github_token)
+
+    logging.info("Updating post-commit reviews in BigQuery.")
+    update_post_commit_reviews_in_bigquery(bq_client, github_token)
+  else:
+    logging.info("Syncing updated pull requests to BigQuery.")
+    high_water_mark = sync_updated_pull_requests_to_bigquery(
+        bq_client, github_token, high_water_mark
+    )
+  record_sync_high_water_mark_in_bigquery(bq_client, high_water_mark)
 
   logging.info("Recording repository snapshot in BigQuery.")
   record_repository_snapshot_in_bigquery(bq_client)
@@ -450,4 +745,14 @@ def main():
 
 if __name__ == "__main__":
   logging.basicConfig(level=logging.INFO)
-  main()
+  parser = argparse.ArgumentParser(
+      description="Amend pull request data recorded in BigQuery."
+  )
+  parser.add_argument(
+      "--full-resync",
+      action="store_true",
+      help="Amend all tracked pull requests rather than only those updated "
+      "since the last sync.",
+  )
+  args = parser.parse_args()
+  main(args.full_resync)
@@ -66,6 +66,202 @@ class TestAmendPullRequestData(unittest.TestCase):
     self.assertEqual(pull_requests, [{"number": 1234}, {"number": 5678}])
     self.assertEqual(mock_query_github_graphql_api.call_count, 2)
 
+  @unittest.mock.patch.object(
+      operational_metrics_lib, "query_github_graphql_api"
+  )
+  def test_fetch_updated_pull_requests_from_github(
+      self, mock_query_github_graphql_api
+  ):
+    """Test fetching updated pull requests beyond the search result limit."""
+    first_search_response = self._create_mock_graphql_response(
+        nodes=[
+            {"number": 1234, "updatedAt": "2025-01-01T10:00:00Z"},
+            {"number": 5678, "updatedAt": "2025-01-01T11:00:00Z"},
+        ]
+    )
+    first_search_response.json.return_value["data"]["search"][
+        "issueCount"
+    ] = 3
+    second_search_response = self._create_mock_graphql_response(
+        nodes=[
+            {"number": 5678, "updatedAt": "2025-01-01T11:00:00Z"},
+            {"number": 9012, "updatedAt": "2025-01-01T12:00:00Z"},
+        ]
+    )
+    mock_query_github_graphql_api.side_effect = [
+        first_search_response,
+        second_search_response,
+    ]
+
+    pull_requests = (
+        amend_pull_request_data.fetch_updated_pull_requests_from_github(
+            github_token="dummy_token",
+            updated_since=datetime.datetime(
+                2025, 1, 1, 9, tzinfo=datetime.timezone.utc
+            ),
+            created_after=datetime.datetime(
+                2024, 7, 1, tzinfo=datetime.timezone.utc
+            ),
+        )
+    )
+    self.assertEqual(
+        [pull_request["number"] for pull_request in pull_requests],
+        [1234, 5678, 9012],
+    )
+    search_filters = [
+        call.kwargs["variables"]["searchFilter"]
+        for call in mock_query_github_graphql_api.call_args_list
+    ]
+    self.assertIn("updated:>=2025-01-01T09:00:00Z", search_filters[0])
+    self.assertIn("created:>=2024-07-01T00:00:00Z", search_filters[0])
+    self.assertIn("sort:updated-asc", search_filters[0])
+    self.assertIn("updated:>=2025-01-01T11:00:00Z", search_filters[1])
+
+  def test_get_sync_high_water_mark(self):
+    """Test getting the high-water mark of the incremental sync."""
+    mock_bq_client = unittest.mock.MagicMock()
+    mock_row = unittest.mock.MagicMock()
+    mock_row.high_water_mark_timestamp_seconds = 1735725600
+    mock_bq_client.query.return_value.result.return_value = [mock_row]
+    self.assertEqual(
+        amend_pull_request_data.get_sync_high_water_mark(mock_bq_client),
+        datetime.datetime(2025, 1, 1, 10, tzinfo=datetime.timezone.utc),
+    )
+
+    mock_bq_client.query.return_value.result.return_value = []
+    self.assertIsNone(
+        amend_pull_request_data.get_sync_high_water_mark(mock_bq_client)
+    )
+
+  @unittest.mock.patch.object(
+      amend_pull_request_data, "upload_github_data_to_bigquery"
+  )
+  @unittest.mock.patch.object(
+      amend_pull_request_data, "get_recorded_pull_requests_from_bigquery"
+  )
+  @unittest.mock.patch.object(
+      amend_pull_request_data, "get_pull_requests_by_age_from_bigquery"
+  )
+  @unittest.mock.patch.object(
+      amend_pull_request_data, "fetch_updated_pull_requests_from_github"
+  )
+  def test_sync_updated_pull_requests_to_bigquery(
+      self,
+      mock_fetch_updated_pull_requests_from_github,
+      mock_get_pull_requests_by_age_from_bigquery,
+      mock_get_recorded_pull_requests_from_bigquery,
+      mock_upload_github_data_to_bigquery,
+  ):
+    """Test syncing only updated pull requests that are tracked or new."""
+    mock_bq_client = unittest.mock.MagicMock()
+    time_now = datetime.datetime.now(datetime.timezone.utc)
+    recent_created_at = (time_now - datetime.timedelta(days=2)).isoformat()
+    old_created_at = (time_now - datetime.timedelta(days=60)).isoformat()
+    open_pull_request = {
+        "number": 1,
+        "state": "OPEN",
+        "createdAt": old_created_at,
+        "updatedAt": "2025-01-01T10:30:00Z",
+    }
+    tracked_pull_request = {
+        "number": 2,
+        "state": "MERGED",
+        "createdAt": old_created_at,
+        "updatedAt": "2025-01-01T11:00:00Z",
+    }
+    untracked_pull_request = {
+        "number": 3,
+        "state": "CLOSED",
+        "createdAt": old_created_at,
+        "updatedAt": "2025-01-01T12:00:00Z",
+    }
+    # Recorded, but marked as stale, so not tracked anymore.
+    stale_pull_request = {
+        "number": 5,
+        "state": "OPEN",
+        "createdAt": recent_created_at,
+        "updatedAt": "2025-01-01T10:45:00Z",
+    }
+    new_pull_request = {
+        "number": 6,
+        "state": "OPEN",
+        "createdAt": recent_created_at,
+        "updatedAt": "2025-01-01T11:30:00Z",
+    }
+    old_untracked_pull_request = {
+        "number": 7,
+        "state": "OPEN",
+        "createdAt": old_created_at,
+        "updatedAt": "2025-01-01T11:45:00Z",
+    }
+    mock_fetch_updated_pull_requests_from_github.return_value = [
+        open_pull_request,
+        tracked_pull_request,
+        untracked_pull_request,
+        stale_pull_request,
+        new_pull_request,
+        old_untracked_pull_request,
+    ]
+    mock_get_pull_requests_by_age_from_bigquery.side_effect = [
+        {3: [1, 4]},
+        {10: [2]},
+    ]
+    mock_get_recorded_pull_requests_from_bigquery.return_value = {5}
+
+    high_water_mark = datetime.datetime(
+        2025, 1, 1, 10, tzinfo=datetime.timezone.utc
+    )
+    new_high_water_mark = (
+        amend_pull_request_data.sync_updated_pull_requests_to_bigquery(
+            mock_bq_client, "dummy_token", high_water_mark
+        )
+    )
+
+    self.assertEqual(
+        mock_fetch_updated_pull_requests_from_github.call_args.kwargs[
+            "updated_since"
+        ],
+        high_water_mark
+        - datetime.timedelta(
+            minutes=amend_pull_request_data.SYNC_OVERLAP_MINUTES
+        ),
+    )
+    mock_get_recorded_pull_requests_from_bigquery.assert_called_once_with(
+        mock_bq_client, [5, 6]
+    )
+    mock_upload_github_data_to_bigquery.assert_called_once_with(
+        mock_bq_client,
+        [open_pull_request, tracked_pull_request, new_pull_request],
+    )
+    self.assertEqual(
+        new_high_water_mark,
+        datetime.datetime(2025, 1, 1, 12, tzinfo=datetime.timezone.utc),
+    )
+
+  @unittest.mock.patch.object(
+      amend_pull_request_data, "upload_github_data_to_bigquery"
+  )
+  @unittest.mock.patch.object(
+      amend_pull_request_data, "fetch_updated_pull_requests_from_github"
+  )
+  def test_sync_no_updated_pull_requests_to_bigquery(
+      self,
+      mock_fetch_updated_pull_requests_from_github,
+      mock_upload_github_data_to_bigquery,
+  ):
+    """Test that the high-water mark is kept when nothing was updated."""
+    mock_fetch_updated_pull_requests_from_github.return_value = []
+    high_water_mark = datetime.datetime(
+        2025, 1, 1, 10, tzinfo=datetime.timezone.utc
+    )
+    self.assertEqual(
+        amend_pull_request_data.sync_updated_pull_requests_to_bigquery(
+            unittest.mock.MagicMock(), "dummy_token", high_water_mark
+        ),
+        high_water_mark,
+    )
+    mock_upload_github_data_to_bigquery.assert_not_called()
+
   def test_mark_stale_pull_request_data_in_bigquery(self):
     """Test marking stale pull request data in BigQuery."""
     mock_bq_client = unittest.mock.MagicMock()
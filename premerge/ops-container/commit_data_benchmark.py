@@ -0,0 +1,138 @@
+"""Benchmark extracting commit data from the repository.
+
+This compares extracting the diffstats and revert information of a day's worth
+of commits from a single git log against running a git diff per commit through
+GitPython. The commits are either taken from an existing clone of
+llvm-project, or from a synthetic repository of a similar shape.
+
+Example usage:
+  python3 commit_data_benchmark.py --repository ./llvm-project --date 2025-10-01
+  python3 commit_data_benchmark.py --commits 150
+"""
+
+import argparse
+import datetime
+import random
+import subprocess
+import tempfile
+import time
+
+import git
+import process_llvm_commits
+
+
+def _generate_repository(
+    repository_path: str, commit_count: int, files_per_commit: int
+) -> git.Repo:
+  """Generate a repository with commits changing random files.
+
+  The repository is written with a single git fast-import rather than a
+  commit at a time, so that large repositories can be generated quickly. All
+  generated text is ASCII, so string lengths are byte lengths.
+  """
+  random_generator = random.Random(0)
+  repo = git.Repo.init(repository_path)
+  file_lines = {}
+  commands = []
+  commit_timestamp = 1700000000
+  for commit_index in range(commit_count):
+    commit_timestamp += random_generator.randrange(60, 600)
+    message = f"Change {commit_index}\n"
+    if commit_index % 20 == 0:
+      message = (
+          f'Revert "Change {commit_index - 1}" (#{commit_index})\n\n'
+          f"Reverts llvm/llvm-project#{commit_index}\n"
+      )
+    commands.append(
+        f"commit refs/heads/main\n"
+        f"committer Bench <bench@example.com> {commit_timestamp} +0000\n"
+        f"data {len(message)}\n{message}"
+    )
+    for _ in range(files_per_commit):
+      file_name = (
+          f"llvm/lib/dir_{random_generator.randrange(50)}/"
+          f"file_{random_generator.randrange(500)}.cpp"
+      )
+      lines = file_lines.setdefault(file_name, [])
+      lines[random_generator.randrange(len(lines) + 1) :] = [
+          f"line {random_generator.random()}"
+          for _ in range(random_generator.randrange(1, 40))
+      ]
+      content = "".join(f"{line}\n" for line in lines)
+      commands.append(
+          f"M 100644 inline {file_name}\ndata {len(content)}\n{content}"
+      )
+    commands.append("\n")
+  subprocess.run(
+      ["git", "fast-import", "--quiet"],
+      cwd=repository_path,
+      input="".join(commands),
+      text=True,
+      check=True,
+  )
+  return repo
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      "--repository",
+      help="A clone of llvm-project to take commits from. If not set, a "
+      "synthetic repository is used.",
+  )
+  parser.add_argument(
+      "--date",
+      type=datetime.date.fromisoformat,
+      default=datetime.date.today()
+      - datetime.timedelta(days=process_llvm_commits.LOOKBACK_DAYS),
+      help="The day to take commits from in the given repository.",
+  )
+  parser.add_argument(
+      "--commits",
+      type=int,
+      default=150,
+      help="The number of commits in the synthetic repository.",
+  )
+  parser.add_argument(
+      "--files-per-commit",
+      type=int,
+      default=4,
+      help="The number of files changed by each synthetic commit.",
+  )
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as synthetic_repository_path:
+    if args.repository:
+      repo = git.Repo(args.repository)
+      commits = process_llvm_commits.scrape_commits_by_date(
+          repo,
+          datetime.datetime.combine(
+              args.date, datetime.time(), tzinfo=datetime.timezone.utc
+          ),
+      )
+    else:
+      repo = _generate_repository(
+          synthetic_repository_path, args.commits, args.files_per_commit
+      )
+      commits = list(repo.iter_commits("main"))
+    commit_shas = [commit.hexsha for commit in commits]
+
+    start_time = time.perf_counter()
+    for commit_sha in commit_shas:
+      repo.commit(commit_sha).stats.files
+    per_commit_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    commit_data = list(
+        process_llvm_commits.extract_initial_commit_data(repo, commit_shas)
+    )
+    single_pass_seconds = time.perf_counter() - start_time
+
+  changed_files = sum(len(commit.diff) for commit in commit_data)
+  print(
+      f"{len(commit_shas)} commits changing {changed_files} files:\n"
+      f"  git diff per commit: {per_commit_seconds:.3f}s "
+      f"({len(commit_shas) / per_commit_seconds:.0f} commits/second)\n"
+      f"  single git log: {single_pass_seconds:.3f}s "
+      f"({len(commit_shas) / single_pass_seconds:.0f} commits/second)"
+  )
@@ -1,18 +1,68 @@
+import collections
+import concurrent.futures
 import dataclasses
 import datetime
+import hashlib
+import json
 import logging
-import math
-from typing import Any, TypeAlias
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Iterable, Iterator, TypeAlias
 import uuid
 from google.cloud import bigquery
+import git
 import requests
 import retry
 
 GITHUB_GRAPHQL_API_URL = "https://api.github.com/graphql"
 
-# How many subqueries to query the GitHub GraphQL API for at a time.
-# Querying too many subqueries at once often leads to the call failing.
+# Git modes of tree entries that are files, as opposed to directories and
+# submodules.
+_GIT_BLOB_MODES = ("100644", "100755", "120000")
+
+# How many subqueries to query the GitHub GraphQL API for at a time, to start
+# with. Querying too many subqueries at once often leads to the call failing, so
+# the batch size is adapted to how the API responds, see AdaptiveBatchSize.
 DEFAULT_GITHUB_API_BATCH_SIZE = 35
+DEFAULT_GITHUB_API_MAX_BATCH_SIZE = 200
+
+# Batches are kept below these limits per query. GitHub gives up on queries
+# that take more than 10 seconds.
+DEFAULT_GITHUB_API_TARGET_QUERY_SECONDS = 5
+DEFAULT_GITHUB_API_MAX_RESPONSE_BYTES = 8 << 20
+DEFAULT_GITHUB_API_MAX_QUERY_COST = 100
+
+# How many batches of subqueries to query the GitHub GraphQL API for
+# concurrently. GitHub enforces secondary rate limits on concurrent requests,
+# so this should be kept small.
+DEFAULT_GITHUB_API_WORKERS = 4
+
+# How many tables to upload concurrently, and the size of the chunks of
+# newline delimited JSON the data of each table is loaded in.
+DEFAULT_UPLOAD_WORKERS = 3
+DEFAULT_UPLOAD_CHUNK_BYTES = 64 << 20
+
+# How long responses to subqueries are cached for, and how large the cache can
+# grow before the least recently used responses are evicted from it.
+DEFAULT_GITHUB_API_CACHE_TTL_SECONDS = 2 * 24 * 60 * 60
+DEFAULT_GITHUB_API_CACHE_MAX_BYTES = 512 << 20
+
+# How many points of the GitHub GraphQL API rate limit to leave unused, for
+# other jobs sharing the same token.
+DEFAULT_GITHUB_API_MIN_REMAINING_POINTS = 100
+
+GITHUB_GRAPHQL_RATE_LIMIT_DATA = """
+rateLimit {
+  cost
+  remaining
+  resetAt
+}
+"""
 
 PULL_REQUEST_GRAPHQL_DATA = """
 author {
@@ -56,7 +106,7 @@ reviews(last: 100) {
 """
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class LLVMCommitData:
   commit_sha: str
   commit_timestamp_seconds: int
@@ -70,7 +120,7 @@ class LLVMCommitData:
   commit_reverted: str | None = None
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class LLVMPullRequestData:
   pull_request_number: int
   pull_request_author: str
@@ -85,7 +135,7 @@ class LLVMPullRequestData:
   is_stale_data: bool = False  # Used to avoid amending outdated data (>14 days)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class LLVMReviewData:
   review_id: str
   review_author: str
@@ -94,21 +144,336 @@ class LLVMReviewData:
   associated_pull_request: int
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class LLVMRepositorySnapshot:
   snapshot_timestamp_seconds: int
   open_pull_request_count_by_age: list[dict[str, int]]
   unapproved_pull_request_count_by_age: list[dict[str, int]]
 
 
+@dataclasses.dataclass(slots=True)
+class LLVMSyncState:
+  sync_name: str
+  # Everything updated before this time has been synced.
+  high_water_mark_timestamp_seconds: int
+  synced_at_timestamp_seconds: int
+
+
 LLVMData: TypeAlias = (
     LLVMCommitData
     | LLVMPullRequestData
     | LLVMReviewData
     | LLVMRepositorySnapshot
+    | LLVMSyncState
 )
 
 
+class GitHubGraphQLError(Exception):
+  """The GitHub GraphQL API answered a query with errors instead of data."""
+
+
+class GitHubRateLimitError(requests.exceptions.HTTPError):
+  """The GitHub API rejected a query for hitting a rate limit.
+
+  The query was not run, and can be sent again unchanged once the rate limit
+  allows it.
+  """
+
+
+class AdaptiveBatchSize:
+  """Picks how many subqueries to send per GitHub GraphQL API query.
+
+  The batch size grows by a quarter after queries that stayed well within the
+  targets for their duration, response size and cost in rate limit points.
+  Queries over a target scale the batch size down to what would have met it,
+  and failed queries halve it.
+  """
+
+  def __init__(
+      self,
+      initial_size: int = DEFAULT_GITHUB_API_BATCH_SIZE,
+      max_size: int = DEFAULT_GITHUB_API_MAX_BATCH_SIZE,
+      target_seconds: float = DEFAULT_GITHUB_API_TARGET_QUERY_SECONDS,
+      max_response_bytes: int = DEFAULT_GITHUB_API_MAX_RESPONSE_BYTES,
+      max_cost: int = DEFAULT_GITHUB_API_MAX_QUERY_COST,
+  ):
+    self.size = max(min(initial_size, max_size), 1)
+    self._max_size = max_size
+    self._target_seconds = target_seconds
+    self._max_response_bytes = max_response_bytes
+    self._max_cost = max_cost
+
+  def record_success(
+      self,
+      batch_size: int,
+      response_seconds: float,
+      response_bytes: int,
+      cost: int | None,
+  ) -> None:
+    # How much of each target the query used, relative to the target.
+    usage = max(
+        response_seconds / self._target_seconds,
+        response_bytes / self._max_response_bytes,
+        (cost or 0) / self._max_cost,
+    )
+    if usage > 1:
+      self._set_size(int(batch_size / usage), "over target")
+    elif usage < 0.5 and batch_size >= self.size:
+      self._set_size(self.size + max(self.size // 4, 1), "within target")
+
+  def record_failure(self, batch_size: int) -> None:
+    self._set_size(min(self.size, batch_size // 2), "failed query")
+
+  def _set_size(self, size: int, reason: str) -> None:
+    size = max(min(size, self._max_size), 1)
+    if size != self.size:
+      logging.info(
+          "Changing GitHub API batch size from %d to %d after %s",
+          self.size,
+          size,
+          reason,
+      )
+      self.size = size
+
+
+class GitHubRateLimiter:
+  """Schedules GitHub GraphQL API requests around the API rate limit.
+
+  Queries report the rate limit left after them through their rateLimit field.
+  Requests are held back once the points remaining, minus the expected cost of
+  the requests in flight, would drop below a reserve, until the rate limit
+  resets. This lets concurrent requests use the quota as fast as it allows
+  without running out of it.
+  """
+
+  def __init__(
+      self, min_remaining: int = DEFAULT_GITHUB_API_MIN_REMAINING_POINTS
+  ):
+    self._min_remaining = min_remaining
+    self._condition = threading.Condition()
+    self._remaining: int | None = None
+    self._reset_at: datetime.datetime | None = None
+    self._in_flight_cost = 0
+    # The cost of a query is only known once it has been made. Expect the
+    # same cost as the last query.
+    self._expected_cost = 1
+
+  def acquire(self) -> int:
+    """Wait until the rate limit allows sending another request.
+
+    Returns:
+      The cost reserved for the request, to be passed to release.
+    """
+    with self._condition:
+      while True:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self._reset_at is not None and now >= self._reset_at:
+          self._remaining = None
+          self._reset_at = None
+        if (
+            self._remaining is None
+            or self._remaining - self._in_flight_cost - self._expected_cost
+            >= self._min_remaining
+        ):
+          break
+        logging.info(
+            "Waiting for the GitHub API rate limit to reset at %s",
+            self._reset_at,
+        )
+        self._condition.wait((self._reset_at - now).total_seconds())
+      self._in_flight_cost += self._expected_cost
+      return self._expected_cost
+
+  def release(
+      self, reserved_cost: int, rate_limit: dict[str, Any] | None
+  ) -> None:
+    """Record the rate limit reported by a finished request.
+
+    Args:
+      reserved_cost: The cost returned by acquire for the request.
+      rate_limit: The rateLimit field of the response, or None if the request
+        failed.
+    """
+    with self._condition:
+      self._in_flight_cost -= reserved_cost
+      if rate_limit is not None:
+        self._expected_cost = max(rate_limit["cost"], 1)
+        reset_at = datetime.datetime.fromisoformat(rate_limit["resetAt"])
+        # Responses can arrive out of order, so only take the lowest remaining
+        # points reported for the current rate limit window.
+        if self._reset_at is None or reset_at > self._reset_at:
+          self._remaining = rate_limit["remaining"]
+          self._reset_at = reset_at
+        elif reset_at == self._reset_at:
+          self._remaining = min(self._remaining, rate_limit["remaining"])
+      self._condition.notify_all()
+
+
+class GraphQLResponseCache:
+  """Caches responses to GitHub GraphQL API subqueries on disk.
+
+  Responses are addressed by a hash of the subquery text, so a subquery is
+  only answered from the cache if it asks for exactly the same data. Each
+  response expires ttl_seconds after it was fetched. Once the cache grows past
+  max_bytes, the least recently used responses are evicted. Only responses
+  with data are cached, as missing objects may only not have been pushed yet.
+
+  The cache is not safe to use from several threads or processes at once.
+  """
+
+  def __init__(
+      self,
+      cache_path: str,
+      ttl_seconds: float = DEFAULT_GITHUB_API_CACHE_TTL_SECONDS,
+      max_bytes: int = DEFAULT_GITHUB_API_CACHE_MAX_BYTES,
+  ):
+    self._cache_path = cache_path
+    self._ttl_seconds = ttl_seconds
+    self._max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    os.makedirs(cache_path, exist_ok=True)
+    # Responses are only read again when looked up, but the last use of an
+    # entry is never before it was fetched, so entries not used for longer
+    # than the TTL have expired.
+    self._total_bytes = 0
+    expired_before = time.time() - ttl_seconds
+    for entry_path, entry_stat in self._list_entries():
+      if entry_stat.st_mtime < expired_before:
+        os.remove(entry_path)
+      else:
+        self._total_bytes += entry_stat.st_size
+
+  def _get_entry_path(self, subquery: str) -> str:
+    key = hashlib.sha256(subquery.encode()).hexdigest()
+    return os.path.join(self._cache_path, key[:2], f"{key}.json")
+
+  def _list_entries(self) -> list[tuple[str, os.stat_result]]:
+    entries = []
+    for directory_path, _, file_names in os.walk(self._cache_path):
+      for file_name in file_names:
+        entry_path = os.path.join(directory_path, file_name)
+        entries.append((entry_path, os.stat(entry_path)))
+    return entries
+
+  def get(self, subquery: str) -> Any | None:
+    """Get the cached response to a subquery.
+
+    Returns:
+      The response to the subquery, or None if it is not cached or expired.
+    """
+    entry_path = self._get_entry_path(subquery)
+    try:
+      with open(entry_path) as entry_file:
+        entry = json.load(entry_file)
+    except (OSError, ValueError):
+      self.misses += 1
+      return None
+    if entry["fetched_at"] + self._ttl_seconds <= time.time():
+      self._total_bytes -= os.path.getsize(entry_path)
+      os.remove(entry_path)
+      self.misses += 1
+      return None
+    # Mark the entry as recently used, for eviction.
+    os.utime(entry_path)
+    self.hits += 1
+    return entry["response"]
+
+  def put(self, subquery: str, response: Any | None) -> None:
+    """Cache the response to a subquery, unless it is empty."""
+    if response is None:
+      return
+    entry_path = self._get_entry_path(subquery)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    if os.path.exists(entry_path):
+      self._total_bytes -= os.path.getsize(entry_path)
+    # Write entries atomically, so that jobs killed halfway through writing
+    # one do not leave it corrupt.
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(entry_path), delete=False
+    ) as entry_file:
+      json.dump({"fetched_at": time.time(), "response": response}, entry_file)
+    os.replace(entry_file.name, entry_path)
+    self._total_bytes += os.path.getsize(entry_path)
+    if self._total_bytes > self._max_bytes:
+      self._evict()
+
+  def _evict(self) -> None:
+    # Evict down to three quarters of the maximum size, so that the cache is
+    # not listed again on every following put.
+    entries = sorted(
+        self._list_entries(), key=lambda entry: entry[1].st_mtime
+    )
+    self._total_bytes = sum(entry_stat.st_size for _, entry_stat in entries)
+    for entry_path, entry_stat in entries:
+      if self._total_bytes <= self._max_bytes * 3 // 4:
+        break
+      os.remove(entry_path)
+      self._total_bytes -= entry_stat.st_size
+      self.evictions += 1
+
+  def log_stats(self) -> None:
+    lookups = self.hits + self.misses
+    logging.info(
+        "GitHub API response cache: %d hits, %d misses (%.1f%% hit rate), %d"
+        " evictions, %d bytes cached",
+        self.hits,
+        self.misses,
+        100 * self.hits / lookups if lookups else 0,
+        self.evictions,
+        self._total_bytes,
+    )
+
+
+def _get_subquery_alias(subquery: str) -> str:
+  return subquery.split(":", 1)[0].strip()
+
+
+def _post_github_graphql_query(
+    query: str,
+    github_token: str,
+    variables: dict[str, str] | None,
+    session: requests.Session | None,
+    api_url: str,
+) -> requests.Response:
+  variables = variables or {}
+  response = (session or requests).post(
+      url=api_url,
+      headers={
+          "Authorization": f"bearer {github_token}",
+      },
+      json={"query": query, "variables": variables},
+  )
+  # When hitting a rate limit, GitHub says how long to wait before retrying.
+  if response.status_code in (403, 429):
+    if "Retry-After" in response.headers:
+      wait_seconds = int(response.headers["Retry-After"])
+    elif response.headers.get("X-RateLimit-Remaining") == "0":
+      wait_seconds = max(
+          int(response.headers["X-RateLimit-Reset"]) - time.time(), 0
+      )
+    else:
+      wait_seconds = None
+    if wait_seconds is not None:
+      logging.warning(
+          "Hit a GitHub API rate limit, waiting %d seconds before retrying.",
+          wait_seconds,
+      )
+      time.sleep(wait_seconds)
+      raise GitHubRateLimitError(
+          f"{response.status_code} rate limited for url: {response.url}",
+          response=response,
+      )
+  # Exit if API call fails
+  # A failed API call means a large batch of data is missing and will not be
+  # reflected in the dashboard. The dashboard will silently misrepresent
+  # commit data if we continue execution, so it's better to fail loudly.
+  response.raise_for_status()
+
+  return response
+
+
 @retry.retry(
     exceptions=(
         requests.exceptions.HTTPError,
@@ -122,6 +487,8 @@ def query_github_graphql_api(
     query: str,
     github_token: str,
     variables: dict[str, str] | None = None,
+    session: requests.Session | None = None,
+    api_url: str = GITHUB_GRAPHQL_API_URL,
 ) -> requests.Response:
   """Query GitHub GraphQL API, retrying on failure.
 
@@ -129,68 +496,359 @@ def query_github_graphql_api(
     query: The GraphQL query to send to the GitHub API.
     github_token: The access token to use with the GitHub GraphQL API.
     variables: The variables to use with the GraphQL query.
+    session: The session to send the query with, to reuse connections across
+      queries.
+    api_url: The URL of the GitHub GraphQL API.
 
   Returns:
     The response from the GitHub GraphQL API.
   """
-  variables = variables or {}
-  response = requests.post(
-      url=GITHUB_GRAPHQL_API_URL,
-      headers={
-          "Authorization": f"bearer {github_token}",
-      },
-      json={"query": query, "variables": variables},
+  return _post_github_graphql_query(
+      query, github_token, variables, session, api_url
   )
-  # Exit if API call fails
-  # A failed API call means a large batch of data is missing and will not be
-  # reflected in the dashboard. The dashboard will silently misrepresent
-  # commit data if we continue execution, so it's better to fail loudly.
-  response.raise_for_status()
 
-  return response
+
+@dataclasses.dataclass
+class _BatchResult:
+  repository_data: dict[str, Any]
+  response_seconds: float
+  response_bytes: int
+  cost: int | None
 
 
-def fetch_repository_data_from_github(
+def _fetch_repository_data_batch(
+    subquery_batch: list[str],
+    github_token: str,
+    session: requests.Session,
+    api_url: str,
+    rate_limiter: GitHubRateLimiter,
+) -> _BatchResult:
+  query = """
+    query {
+      %s
+      repository(owner:"llvm", name:"llvm-project"){
+          %s
+      }
+    }
+  """ % (GITHUB_GRAPHQL_RATE_LIMIT_DATA, "".join(subquery_batch))
+  reserved_cost = rate_limiter.acquire()
+  rate_limit = None
+  try:
+    # Failed batches of several subqueries are split rather than retried
+    # whole, so only retry single subqueries.
+    if len(subquery_batch) == 1:
+      response = query_github_graphql_api(
+          query, github_token, session=session, api_url=api_url
+      )
+    else:
+      response = _post_github_graphql_query(
+          query, github_token, None, session, api_url
+      )
+    response_json = response.json()
+    response_data = response_json.get("data") or {}
+    rate_limit = response_data.get("rateLimit")
+    if response_data.get("repository") is None:
+      raise GitHubGraphQLError(response_json.get("errors"))
+    return _BatchResult(
+        repository_data=response_data["repository"],
+        response_seconds=response.elapsed.total_seconds(),
+        response_bytes=len(response.content),
+        cost=rate_limit["cost"] if rate_limit else None,
+    )
+  finally:
+    rate_limiter.release(reserved_cost, rate_limit)
+
+
+def iter_repository_data_from_github(
     github_token: str,
     subqueries: list[str],
     batch_size: int = DEFAULT_GITHUB_API_BATCH_SIZE,
-) -> dict[str, dict[str, Any]]:
+    max_workers: int = DEFAULT_GITHUB_API_WORKERS,
+    rate_limiter: GitHubRateLimiter | None = None,
+    api_url: str = GITHUB_GRAPHQL_API_URL,
+    max_batch_size: int = DEFAULT_GITHUB_API_MAX_BATCH_SIZE,
+    cache: GraphQLResponseCache | None = None,
+) -> Iterator[dict[str, Any]]:
   """Fetch repository data from the GitHub API using provided subqueries.
 
+  Batches of subqueries are queried concurrently over a shared session, and
+  scheduled around the GitHub API rate limit. The size of the batches adapts
+  to how the API responds, and failed batches are split in half and queried
+  again until single subqueries fail. Batches that hit a rate limit are
+  queried again whole once it allows.
+
+  The data is yielded batch by batch, in the order of the subqueries, as soon
+  as all earlier batches have been fetched as well. Only a few batches are
+  held in memory at a time.
+
   Args:
     github_token: The access token to use with the GitHub GraphQL API.
     subqueries: List of GraphQL subqueries to fetch data for.
-    batch_size: The number of commits to query the GitHub GraphQL API for at a
-      time.
+    batch_size: The number of subqueries to query the GitHub GraphQL API for
+      at a time, to start with.
+    max_workers: The number of batches to query concurrently.
+    rate_limiter: The rate limiter to schedule queries with. Jobs fetching
+      data several times can share one across calls.
+    api_url: The URL of the GitHub GraphQL API.
+    max_batch_size: The maximum number of subqueries to query at a time.
+    cache: If set, the cache to answer subqueries from. Only the subqueries it
+      has no response to are queried, and their responses are added to it.
+      Subqueries need to start with their alias to be cached.
+
+  Yields:
+    Dictionaries of subquery alias to data from the GitHub GraphQL API, for
+    consecutive subqueries.
+  """
+  cached_results = {}
+  if cache is not None:
+    for subquery_index, subquery in enumerate(subqueries):
+      cached_result = cache.get(subquery)
+      if cached_result is not None:
+        cached_results[subquery_index] = cached_result
+    logging.info(
+        "Answered %d of %d subqueries from the cache",
+        len(cached_results),
+        len(subqueries),
+    )
+  # The indices of the subqueries to query, into the subqueries.
+  query_indices = [
+      subquery_index
+      for subquery_index in range(len(subqueries))
+      if subquery_index not in cached_results
+  ]
+  rate_limiter = rate_limiter or GitHubRateLimiter()
+  adaptive_batch_size = AdaptiveBatchSize(batch_size, max_batch_size)
+  logging.info(
+      "Querying GitHub GraphQL API for %d subqueries with %d workers",
+      len(query_indices),
+      max_workers,
+  )
+  start_time = time.monotonic()
+  # Batches are identified by the index of their first subquery into
+  # query_indices, so that the results can be yielded in order.
+  next_query_index = 0
+  split_batches = collections.deque()
+  # Batches that were fetched, but not yielded yet.
+  batch_results = {}
+  next_yielded_query_index = 0
+  next_yielded_subquery_index = 0
+  batch_sizes = []
+  with requests.Session() as session, concurrent.futures.ThreadPoolExecutor(
+      max_workers
+  ) as executor:
+    # Keep a connection open for every worker.
+    session.mount(
+        "https://", requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+    )
+    running_batches = {}
+    try:
+      while (
+          running_batches
+          or split_batches
+          or next_query_index < len(query_indices)
+      ):
+        # Split batches come before any batch that was not started yet, so
+        # only hold back new batches while later batches wait to be yielded.
+        while len(running_batches) < max_workers and (
+            split_batches
+            or (
+                next_query_index < len(query_indices)
+                and len(batch_results) < max_workers
+            )
+        ):
+          if split_batches:
+            first_query_index, subquery_batch = split_batches.popleft()
+          else:
+            first_query_index = next_query_index
+            next_query_index += adaptive_batch_size.size
+            subquery_batch = [
+                subqueries[subquery_index]
+                for subquery_index in query_indices[
+                    first_query_index:next_query_index
+                ]
+            ]
+          batch_sizes.append(len(subquery_batch))
+          batch_future = executor.submit(
+              _fetch_repository_data_batch,
+              subquery_batch,
+              github_token,
+              session,
+              api_url,
+              rate_limiter,
+          )
+          running_batches[batch_future] = (first_query_index, subquery_batch)
+        finished_batches, _ = concurrent.futures.wait(
+            running_batches, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for batch_future in finished_batches:
+          first_query_index, subquery_batch = running_batches.pop(
+              batch_future
+          )
+          try:
+            batch_result = batch_future.result()
+          except GitHubRateLimitError:
+            # The rate limit was already waited for, and says nothing about
+            # the batch itself, so query the same batch again.
+            split_batches.appendleft((first_query_index, subquery_batch))
+            continue
+          except (requests.exceptions.RequestException, GitHubGraphQLError):
+            if len(subquery_batch) == 1:
+              raise
+            logging.warning(
+                "Query of %d subqueries failed, splitting it in half",
+                len(subquery_batch),
+                exc_info=True,
+            )
+            adaptive_batch_size.record_failure(len(subquery_batch))
+            half_size = len(subquery_batch) // 2
+            split_batches.append(
+                (first_query_index, subquery_batch[:half_size])
+            )
+            split_batches.append((
+                first_query_index + half_size,
+                subquery_batch[half_size:],
+            ))
+            continue
+          adaptive_batch_size.record_success(
+              len(subquery_batch),
+              batch_result.response_seconds,
+              batch_result.response_bytes,
+              batch_result.cost,
+          )
+          if cache is not None:
+            for subquery in subquery_batch:
+              cache.put(
+                  subquery,
+                  batch_result.repository_data.get(
+                      _get_subquery_alias(subquery)
+                  ),
+              )
+          batch_results[first_query_index] = (
+              len(subquery_batch),
+              batch_result.repository_data,
+          )
+
+        # Yield the batches that all earlier batches have been yielded for,
+        # along with the cached results in between them.
+        while next_yielded_query_index in batch_results:
+          subquery_count, repository_data = batch_results.pop(
+              next_yielded_query_index
+          )
+          next_yielded_query_index += subquery_count
+          end_subquery_index = (
+              query_indices[next_yielded_query_index - 1] + 1
+          )
+          yield _order_subquery_results(
+              subqueries,
+              range(next_yielded_subquery_index, end_subquery_index),
+              cached_results,
+              repository_data,
+          )
+          next_yielded_subquery_index = end_subquery_index
+    except BaseException:
+      # Fail fast rather than querying the remaining batches.
+      executor.shutdown(cancel_futures=True)
+      raise
+
+  if next_yielded_subquery_index < len(subqueries):
+    yield _order_subquery_results(
+        subqueries,
+        range(next_yielded_subquery_index, len(subqueries)),
+        cached_results,
+        {},
+    )
+  elapsed_seconds = time.monotonic() - start_time
+  logging.info(
+      "Fetched %d subqueries in %d queries of %d to %d subqueries in %.1f"
+      " seconds (%.1f subqueries per second)",
+      len(query_indices),
+      len(batch_sizes),
+      min(batch_sizes, default=0),
+      max(batch_sizes, default=0),
+      elapsed_seconds,
+      len(query_indices) / elapsed_seconds if elapsed_seconds else 0,
+  )
+
+
+def _order_subquery_results(
+    subqueries: list[str],
+    subquery_indices: range,
+    cached_results: dict[int, Any],
+    repository_data: dict[str, Any],
+) -> dict[str, Any]:
+  if not cached_results:
+    return repository_data
+  return {
+      _get_subquery_alias(subqueries[subquery_index]): cached_results[
+          subquery_index
+      ]
+      if subquery_index in cached_results
+      else repository_data[_get_subquery_alias(subqueries[subquery_index])]
+      for subquery_index in subquery_indices
+  }
+
+
+def fetch_repository_data_from_github(
+    github_token: str,
+    subqueries: list[str],
+    batch_size: int = DEFAULT_GITHUB_API_BATCH_SIZE,
+    max_workers: int = DEFAULT_GITHUB_API_WORKERS,
+    rate_limiter: GitHubRateLimiter | None = None,
+    api_url: str = GITHUB_GRAPHQL_API_URL,
+    max_batch_size: int = DEFAULT_GITHUB_API_MAX_BATCH_SIZE,
+    cache: GraphQLResponseCache | None = None,
+) -> dict[str, dict[str, Any]]:
+  """Fetch repository data from the GitHub API using provided subqueries.
+
+  This collects all of the data yielded by iter_repository_data_from_github,
+  see there for the arguments.
 
   Returns:
-    A dictionary of commit hash to commit data from the GitHub GraphQL API.
+    A dictionary of subquery alias to data from the GitHub GraphQL API.
   """
   api_subquery_results = {}
-  query_template = """
-    query {
-      repository(owner:"llvm", name:"llvm-project"){
-          %s
-      }
-    }
+  for repository_data in iter_repository_data_from_github(
+      github_token,
+      subqueries,
+      batch_size,
+      max_workers,
+      rate_limiter,
+      api_url,
+      max_batch_size,
+      cache,
+  ):
+    api_subquery_results.update(repository_data)
+  return api_subquery_results
+
+
+class RepositoryDataSpool:
+  """Repository data from the GitHub GraphQL API, spooled to a file.
+
+  Batches of data, as yielded by iter_repository_data_from_github, are
+  written to the file as they arrive. The data can then be iterated over
+  through items() as often as needed, like the dictionary returned by
+  fetch_repository_data_from_github, while only a single batch is held in
+  memory.
   """
-  num_batches = math.ceil(len(subqueries) / batch_size)
-  logging.info("Querying GitHub GraphQL API in %d batches", num_batches)
-  for i in range(num_batches):
-    subquery_batch = subqueries[i * batch_size : (i + 1) * batch_size]
-    query = query_template % "".join(subquery_batch)
 
-    logging.info(
-        "Querying batch %d of %d (%d subqueries)",
-        i + 1,
-        num_batches,
-        len(subquery_batch),
-    )
-    response = query_github_graphql_api(query, github_token)
+  def __init__(self, spool_path: str):
+    self._spool_path = spool_path
+    self._length = 0
+    open(spool_path, "w").close()
 
-    api_subquery_results.update(response.json()["data"]["repository"])
+  def __len__(self) -> int:
+    return self._length
 
-  return api_subquery_results
+  def extend(self, batches: Iterable[dict[str, Any]]) -> None:
+    with open(self._spool_path, "a", encoding="utf-8") as spool_file:
+      for batch in batches:
+        spool_file.write(json.dumps(batch) + "\n")
+        self._length += len(batch)
+
+  def items(self) -> Iterator[tuple[str, Any]]:
+    with open(self._spool_path, encoding="utf-8") as spool_file:
+      for line in spool_file:
+        yield from json.loads(line).items()
 
 
 def parse_pull_request_data(
@@ -320,11 +978,305 @@ def parse_review_data(
   return review_data
 
 
+@dataclasses.dataclass
+class TableUpload:
+  """LLVM data to upload to a table, merged with existing rows by primary key.
+
+  The data can be a generator, in which case it is only consumed while it is
+  uploaded.
+  """
+
+  table: str
+  llvm_data: Iterable[LLVMData]
+  primary_key: str
+
+
+class BigQuerySink:
+  """Uploads LLVM data to tables of a BigQuery dataset.
+
+  Data is loaded into a staging table with a unique name, to avoid conflicts
+  with concurrently running scripts, and then merged into the table.
+  """
+
+  def __init__(self, bq_client: bigquery.Client, bq_dataset: str):
+    self._bq_client = bq_client
+    self._bq_dataset = bq_dataset
+
+  def stage(self, table: str, fields: list[str], chunk_paths: list[str]) -> str:
+    """Load files of newline delimited JSON rows into a new staging table.
+
+    Returns:
+      The ID of the staging table.
+    """
+    target_table_id = f"{self._bq_dataset}.{table}"
+    staging_table_id = f"{target_table_id}_staging_{uuid.uuid4().hex}"
+    try:
+      schema = self._bq_client.get_table(target_table_id).schema
+      for chunk_index, chunk_path in enumerate(chunk_paths):
+        with open(chunk_path, "rb") as chunk_file:
+          self._bq_client.load_table_from_file(
+              chunk_file,
+              destination=staging_table_id,
+              job_config=bigquery.LoadJobConfig(
+                  schema=schema,
+                  source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                  write_disposition=(
+                      "WRITE_TRUNCATE" if chunk_index == 0 else "WRITE_APPEND"
+                  ),
+              ),
+          ).result()
+    except Exception:
+      self.discard(staging_table_id)
+      raise
+    return staging_table_id
+
+  def merge(
+      self, table: str, staging: str, fields: list[str], primary_key: str
+  ) -> None:
+    update_values = ", ".join(
+        [f"dest.{field} = src.{field}" for field in fields]
+    )
+    insert_values = ", ".join([f"src.{field}" for field in fields])
+    query = f"""
+    MERGE {self._bq_dataset}.{table} AS dest
+    USING {staging} AS src
+    ON dest.{primary_key} = src.{primary_key}
+    WHEN MATCHED THEN
+      UPDATE SET {update_values}
+    WHEN NOT MATCHED THEN
+      INSERT ({", ".join(fields)}) VALUES ({insert_values})
+    """
+    self._bq_client.query(query).result()
+
+  def discard(self, staging: str) -> None:
+    self._bq_client.delete_table(staging, not_found_ok=True)
+
+
+class SQLiteSink:
+  """Uploads LLVM data to tables of a local SQLite database.
+
+  This stands in for BigQuery to run and benchmark the pipelines offline.
+  Tables are created as needed, and fields holding lists or records are stored
+  as JSON text.
+  """
+
+  def __init__(self, db_path: str):
+    self._db_path = db_path
+
+  def _connect(self) -> sqlite3.Connection:
+    # Uploads to different tables run concurrently, so wait for each other's
+    # write transactions.
+    return sqlite3.connect(self._db_path, timeout=60)
+
+  def stage(self, table: str, fields: list[str], chunk_paths: list[str]) -> str:
+    staging_table = f"{table}_staging_{uuid.uuid4().hex}"
+    db_connection = self._connect()
+    try:
+      with db_connection:
+        db_connection.execute(
+            f"CREATE TABLE {staging_table} ({', '.join(fields)})"
+        )
+        for chunk_path in chunk_paths:
+          with open(chunk_path, encoding="utf-8") as chunk_file:
+            db_connection.executemany(
+                f"INSERT INTO {staging_table} VALUES"
+                f" ({', '.join('?' * len(fields))})",
+                (
+                    _to_sqlite_row(json.loads(line), fields)
+                    for line in chunk_file
+                ),
+            )
+    finally:
+      db_connection.close()
+    return staging_table
+
+  def merge(
+      self, table: str, staging: str, fields: list[str], primary_key: str
+  ) -> None:
+    columns = ", ".join(fields)
+    update_values = ", ".join(
+        f"{field} = excluded.{field}"
+        for field in fields
+        if field != primary_key
+    )
+    db_connection = self._connect()
+    try:
+      with db_connection:
+        db_connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ({columns},"
+            f" PRIMARY KEY ({primary_key}))"
+        )
+        # The WHERE clause keeps the upsert from being parsed as a join.
+        db_connection.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}"
+            f" WHERE true ON CONFLICT ({primary_key}) DO UPDATE SET"
+            f" {update_values}"
+        )
+    finally:
+      db_connection.close()
+
+  def discard(self, staging: str) -> None:
+    db_connection = self._connect()
+    try:
+      with db_connection:
+        db_connection.execute(f"DROP TABLE IF EXISTS {staging}")
+    finally:
+      db_connection.close()
+
+
+UploadSink: TypeAlias = BigQuerySink | SQLiteSink
+
+
+def _to_sqlite_row(row: dict[str, Any], fields: list[str]) -> list[Any]:
+  return [
+      json.dumps(row[field])
+      if isinstance(row[field], (list, dict))
+      else row[field]
+      for field in fields
+  ]
+
+
+def _write_json_chunks(
+    llvm_data: Iterable[LLVMData],
+    chunk_path_prefix: str,
+    max_chunk_bytes: int,
+) -> tuple[list[str], list[str], int]:
+  """Write LLVM data to files of newline delimited JSON rows.
+
+  Records are serialized one at a time as they are read, so that only the
+  current record is held in memory.
+
+  Returns:
+    The fields of the records, the paths of the files and the number of rows.
+  """
+  fields = []
+  chunk_paths = []
+  row_count = 0
+  chunk_file = None
+  chunk_bytes = 0
+  try:
+    for record in llvm_data:
+      if not fields:
+        fields = [field.name for field in dataclasses.fields(record)]
+      if chunk_file is None or chunk_bytes >= max_chunk_bytes:
+        if chunk_file is not None:
+          chunk_file.close()
+        chunk_paths.append(f"{chunk_path_prefix}_{len(chunk_paths)}.json")
+        chunk_file = open(chunk_paths[-1], "wb")
+        chunk_bytes = 0
+      # Records only hold JSON values, so they can be serialized without the
+      # deep copy that dataclasses.asdict makes.
+      row = json.dumps({field: getattr(record, field) for field in fields})
+      row = row.encode("utf-8") + b"\n"
+      chunk_file.write(row)
+      chunk_bytes += len(row)
+      row_count += 1
+  finally:
+    if chunk_file is not None:
+      chunk_file.close()
+  return fields, chunk_paths, row_count
+
+
+def _stage_table_upload(
+    sink: UploadSink,
+    table_upload: TableUpload,
+    directory: str,
+    max_chunk_bytes: int,
+) -> tuple[list[str], str] | None:
+  start_time = time.monotonic()
+  fields, chunk_paths, row_count = _write_json_chunks(
+      table_upload.llvm_data,
+      os.path.join(directory, table_upload.table),
+      max_chunk_bytes,
+  )
+  if not row_count:
+    logging.info("No data to upload to %s.", table_upload.table)
+    return None
+  staging = sink.stage(table_upload.table, fields, chunk_paths)
+  logging.info(
+      "Staged %d rows for %s in %d chunks in %.1f seconds",
+      row_count,
+      table_upload.table,
+      len(chunk_paths),
+      time.monotonic() - start_time,
+  )
+  return fields, staging
+
+
+def upload_tables(
+    sink: UploadSink,
+    table_upload_groups: list[list[TableUpload]],
+    max_workers: int = DEFAULT_UPLOAD_WORKERS,
+    max_chunk_bytes: int = DEFAULT_UPLOAD_CHUNK_BYTES,
+) -> None:
+  """Upload LLVM data to several tables concurrently.
+
+  The data of every table is serialized to disk in chunks and staged
+  concurrently. Staged data is then merged into the tables one group of
+  tables at a time, with the tables of a group merged concurrently, so that a
+  later group is only updated once the earlier ones have been.
+
+  Args:
+    sink: Where to upload the data to.
+    table_upload_groups: The data to upload, in groups of tables to merge
+      together.
+    max_workers: How many tables to upload concurrently.
+    max_chunk_bytes: The size of the chunks to serialize data to, at which
+      point a new chunk is started.
+  """
+  with tempfile.TemporaryDirectory() as directory, (
+      concurrent.futures.ThreadPoolExecutor(max_workers)
+  ) as executor:
+    staged_upload_groups = [
+        [
+            (
+                table_upload,
+                executor.submit(
+                    _stage_table_upload,
+                    sink,
+                    table_upload,
+                    directory,
+                    max_chunk_bytes,
+                ),
+            )
+            for table_upload in table_upload_group
+        ]
+        for table_upload_group in table_upload_groups
+    ]
+    try:
+      for staged_upload_group in staged_upload_groups:
+        merge_futures = []
+        for table_upload, stage_future in staged_upload_group:
+          staged_upload = stage_future.result()
+          if staged_upload is None:
+            continue
+          fields, staging = staged_upload
+          merge_futures.append(
+              executor.submit(
+                  sink.merge,
+                  table_upload.table,
+                  staging,
+                  fields,
+                  table_upload.primary_key,
+              )
+          )
+        for merge_future in merge_futures:
+          merge_future.result()
+    except Exception as e:
+      logging.error("Failed to upload LLVM data: %s", e)
+      exit(1)
+    finally:
+      for staged_upload_group in staged_upload_groups:
+        for _, stage_future in staged_upload_group:
+          if stage_future.exception() is None and stage_future.result():
+            sink.discard(stage_future.result()[1])
+
+
 def upload_to_bigquery(
     bq_client: bigquery.Client,
     bq_dataset: str,
     bq_table: str,
-    llvm_data: list[LLVMData],
+    llvm_data: Iterable[LLVMData],
     primary_key: str,
 ) -> None:
   """Upload processed LLVM metrics to a BigQuery dataset.
@@ -333,50 +1285,154 @@ def upload_to_bigquery(
     bq_client: The BigQuery client to use.
     bq_dataset: The name of the BigQuery dataset to upload to.
     bq_table: The name of the BigQuery table to upload to.
-    llvm_data: List of LLVM data to process & upload to BigQuery.
+    llvm_data: LLVM data to process & upload to BigQuery.
     primary_key: The name of the field to use as a primary key when merging
       pending data with existing records.
   """
+  upload_tables(
+      BigQuerySink(bq_client, bq_dataset),
+      [[TableUpload(bq_table, llvm_data, primary_key)]],
+  )
+
+
+def open_repository_cache(
+    repository_path: str,
+    repository_url: str,
+    branch: str = "main",
+) -> git.Repo:
+  """Open a cached clone of a repository, cloning or updating it as needed.
+
+  The clone is bare and blobless: it has the full commit and tree history of
+  the branch, but file contents are only fetched when they are needed, which
+  keeps the initial clone small. Updating the cache only fetches new commits.
+  Use prefetch_diff_blobs to fetch the contents needed for diffs up front.
+
+  Args:
+    repository_path: Where to keep the clone, normally on a persistent volume.
+    repository_url: The URL of the repository to clone.
+    branch: The branch to keep up to date. HEAD of the clone points to it.
+
+  Returns:
+    The up to date clone.
+  """
+  if os.path.isdir(repository_path):
+    try:
+      repo = git.Repo(repository_path)
+      start_time = time.monotonic()
+      repo.git.fetch(
+          "origin", f"+refs/heads/{branch}:refs/heads/{branch}", no_tags=True
+      )
+      logging.info(
+          "Updated cached clone of %s in %.1f seconds",
+          repository_url,
+          time.monotonic() - start_time,
+      )
+      return repo
+    except (git.InvalidGitRepositoryError, git.GitCommandError):
+      logging.warning(
+          "Failed to update cached clone at %s, cloning it again",
+          repository_path,
+          exc_info=True,
+      )
+      shutil.rmtree(repository_path)
 
-  if not llvm_data:
-    logging.info("No data to upload to BigQuery.")
-    return
+  # Clone next to the final path and move the clone into place once it is
+  # complete, so that an interrupted clone is not mistaken for a cache.
+  partial_clone_path = f"{repository_path}.partial"
+  shutil.rmtree(partial_clone_path, ignore_errors=True)
+  start_time = time.monotonic()
+  git.Repo.clone_from(
+      url=repository_url,
+      to_path=partial_clone_path,
+      bare=True,
+      filter="blob:none",
+      single_branch=True,
+      branch=branch,
+      no_tags=True,
+  )
+  os.rename(partial_clone_path, repository_path)
+  logging.info(
+      "Cloned %s in %.1f seconds",
+      repository_url,
+      time.monotonic() - start_time,
+  )
+  return git.Repo(repository_path)
 
-  target_table_id = f"{bq_dataset}.{bq_table}"
 
-  # Create a unique staging table ID to avoid conflict with concurrently running
-  # scripts.
-  staging_table_id = f"{target_table_id}_staging_{uuid.uuid4().hex}"
+def prefetch_diff_blobs(repo: git.Repo, commit_shas: list[str]) -> int:
+  """Fetch the file contents needed to diff commits in a blobless clone.
 
-  records = [dataclasses.asdict(record) for record in llvm_data]
-  fields = [field for field in records[0].keys()]
+  Git fetches missing file contents of a blobless clone on demand, which takes
+  a round trip to the remote for every commit whose changes are looked at.
+  This fetches the contents of every file changed by the commits in a single
+  request instead. Changed files are found from the trees of the commits,
+  which are already in the clone.
 
-  update_values = ", ".join([f"dest.{field} = src.{field}" for field in fields])
-  insert_values = ", ".join([f"src.{field}" for field in fields])
+  Args:
+    repo: A blobless clone, as returned by open_repository_cache.
+    commit_shas: The commits to fetch the changed file contents of. Each is
+      compared against its first parent.
 
-  query = f"""
-  MERGE {target_table_id} AS dest
-  USING {staging_table_id} AS src
-  ON dest.{primary_key} = src.{primary_key}
-  WHEN MATCHED THEN
-    UPDATE SET {update_values}
-  WHEN NOT MATCHED THEN
-    INSERT ({", ".join(fields)}) VALUES ({insert_values})
+  Returns:
+    The number of file contents requested.
   """
+  if not commit_shas:
+    return 0
+  # Rename detection needs file contents, so leave it off like the diffs that
+  # the contents are fetched for.
+  raw_diff = subprocess.run(
+      [
+          "git",
+          "log",
+          "--stdin",
+          "--no-walk=unsorted",
+          "--first-parent",
+          "--format=",
+          "--raw",
+          "--no-abbrev",
+          "--no-renames",
+      ],
+      cwd=repo.git_dir,
+      input="\n".join(commit_shas),
+      capture_output=True,
+      text=True,
+      check=True,
+  ).stdout
+  blob_shas = set()
+  for line in raw_diff.splitlines():
+    if not line.startswith(":"):
+      continue
+    old_mode, new_mode, old_sha, new_sha = line[1:].split(maxsplit=4)[:4]
+    if old_mode in _GIT_BLOB_MODES:
+      blob_shas.add(old_sha)
+    if new_mode in _GIT_BLOB_MODES:
+      blob_shas.add(new_sha)
+  if not blob_shas:
+    return 0
 
-  try:
-    bq_client.load_table_from_json(
-        json_rows=records,
-        destination=staging_table_id,
-        job_config=bigquery.LoadJobConfig(
-            schema=bq_client.get_table(target_table_id).schema,
-            write_disposition="WRITE_TRUNCATE",
-        ),
-    ).result()
-
-    bq_client.query(query).result()
-  except Exception as e:
-    logging.error("Failed to upload LLVM data to BigQuery: %s", e)
-    exit(1)
-  finally:
-    bq_client.delete_table(staging_table_id, not_found_ok=True)
+  start_time = time.monotonic()
+  subprocess.run(
+      [
+          "git",
+          "-c",
+          "fetch.negotiationAlgorithm=noop",
+          "fetch",
+          "--stdin",
+          "--no-tags",
+          "--no-write-fetch-head",
+          "--filter=blob:none",
+          "origin",
+      ],
+      cwd=repo.git_dir,
+      input="\n".join(sorted(blob_shas)),
+      capture_output=True,
+      text=True,
+      check=True,
+  )
+  logging.info(
+      "Fetched %d files changed by %d commits in %.1f seconds",
+      len(blob_shas),
+      len(commit_shas),
+      time.monotonic() - start_time,
+  )
+  return len(blob_shas)
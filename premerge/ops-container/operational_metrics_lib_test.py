@@ -1,12 +1,117 @@
 import dataclasses
+import datetime
+import http.server
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 from typing import Any
 import unittest
 import unittest.mock
 
+import git
 import operational_metrics_lib
 import requests
 
 
+class _StandInGraphQLServer(http.server.ThreadingHTTPServer):
+  """A local stand-in for the GitHub GraphQL API.
+
+  Every subquery aliased commit_<n> in a query is answered with an empty
+  object, along with the rate limit after the query. Queries with more than
+  max_subqueries_per_request subqueries fail like queries that time out.
+  """
+
+  def __init__(
+      self,
+      remaining_points: int = 5000,
+      reset_after_seconds: float = 3600,
+      response_delay_seconds: float = 0,
+      rate_limited_requests: int = 0,
+      rate_limited_status: int = 429,
+      max_subqueries_per_request: int | None = None,
+  ):
+    super().__init__(('localhost', 0), _StandInGraphQLHandler)
+    self.remaining_points = remaining_points
+    self.reset_at = datetime.datetime.now(
+        datetime.timezone.utc
+    ) + datetime.timedelta(seconds=reset_after_seconds)
+    self.response_delay_seconds = response_delay_seconds
+    self.rate_limited_requests = rate_limited_requests
+    self.rate_limited_status = rate_limited_status
+    self.max_subqueries_per_request = max_subqueries_per_request
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.concurrent_requests = 0
+    self.max_concurrent_requests = 0
+    self.request_subquery_counts = []
+
+  @property
+  def url(self) -> str:
+    return f'http://localhost:{self.server_address[1]}/graphql'
+
+
+class _StandInGraphQLHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_POST(self):
+    server = self.server
+    query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))[
+        'query'
+    ]
+    aliases = re.findall(r'(commit_\d+):', query)
+    with server.lock:
+      server.requests += 1
+      server.request_subquery_counts.append(len(aliases))
+      server.concurrent_requests += 1
+      server.max_concurrent_requests = max(
+          server.max_concurrent_requests, server.concurrent_requests
+      )
+      rate_limited = server.requests <= server.rate_limited_requests
+      if not rate_limited:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if now >= server.reset_at:
+          server.remaining_points = 5000
+          server.reset_at = now + datetime.timedelta(hours=1)
+        server.remaining_points -= 1
+        rate_limit = {
+            'cost': 1,
+            'remaining': server.remaining_points,
+            'resetAt': server.reset_at.isoformat(),
+        }
+    time.sleep(server.response_delay_seconds)
+    with server.lock:
+      server.concurrent_requests -= 1
+    if rate_limited:
+      self.send_response(server.rate_limited_status)
+      self.send_header('Retry-After', '0')
+      self.end_headers()
+      return
+    if (
+        server.max_subqueries_per_request is not None
+        and len(aliases) > server.max_subqueries_per_request
+    ):
+      self.send_response(502)
+      self.end_headers()
+      return
+    body = json.dumps({
+        'data': {
+            'rateLimit': rate_limit,
+            'repository': {alias: {} for alias in aliases},
+        }
+    }).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
 class TestOperationalMetricsLib(unittest.TestCase):
 
   def _create_llvm_commit_data(
@@ -25,6 +130,7 @@ class TestOperationalMetricsLib(unittest.TestCase):
     """Creates a mock API response."""
     response = requests.Response()
     response.status_code = status_code
+    response._content = json.dumps(payload if payload else {}).encode('utf-8')
     response.json = unittest.mock.MagicMock(
         return_value=payload if payload else {}
     )
@@ -63,7 +169,7 @@ class TestOperationalMetricsLib(unittest.TestCase):
     # Assert that the post was retried at least once
     self.assertGreater(mock_post.call_count, 1)
 
-  @unittest.mock.patch.object(requests, 'post', autospec=True)
+  @unittest.mock.patch.object(requests.Session, 'post', autospec=True)
   def test_fetch_repository_data_from_github(self, mock_post):
     """Test fetching GitHub API data for a list of commits."""
     response_payload = {
@@ -86,7 +192,7 @@ class TestOperationalMetricsLib(unittest.TestCase):
     self.assertIn('commit_abcdef', mock_kwargs['json']['query'])
     self.assertIn('commit_ghijkl', mock_kwargs['json']['query'])
 
-  @unittest.mock.patch.object(requests, 'post', autospec=True)
+  @unittest.mock.patch.object(requests.Session, 'post', autospec=True)
   def test_fetch_repository_data_from_github_batching(self, mock_post):
     """Test fetching GitHub API data in batches at a time."""
     response_payload = {'data': {'repository': {}}}
@@ -106,6 +212,265 @@ class TestOperationalMetricsLib(unittest.TestCase):
 
     self.assertEqual(mock_post.call_count, 3)
 
+  def _fetch_from_stand_in_server(
+      self,
+      server: _StandInGraphQLServer,
+      subquery_count: int,
+      **kwargs,
+  ) -> dict[str, dict[str, Any]]:
+    """Fetches subqueries from a stand-in server, by default one per batch."""
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    try:
+      return operational_metrics_lib.fetch_repository_data_from_github(
+          github_token='dummy_token',
+          subqueries=[f'commit_{i}: ...' for i in range(subquery_count)],
+          api_url=server.url,
+          **{'batch_size': 1, 'max_batch_size': 1, **kwargs},
+      )
+    finally:
+      server.shutdown()
+      server_thread.join()
+      server.server_close()
+
+  def test_fetch_repository_data_from_github_concurrently(self):
+    """Test fetching batches concurrently from a stand-in GraphQL API."""
+    server = _StandInGraphQLServer(response_delay_seconds=0.1)
+
+    api_data = self._fetch_from_stand_in_server(server, 12, max_workers=4)
+
+    self.assertEqual(set(api_data), {f'commit_{i}' for i in range(12)})
+    self.assertEqual(server.requests, 12)
+    self.assertGreater(server.max_concurrent_requests, 1)
+    self.assertLessEqual(server.max_concurrent_requests, 4)
+
+  def test_fetch_repository_data_from_github_waits_for_rate_limit(self):
+    """Test holding back batches until the rate limit resets."""
+    # Only one query can be made before the rate limit reaches the reserve.
+    server = _StandInGraphQLServer(
+        remaining_points=101, reset_after_seconds=0.5
+    )
+
+    start_time = time.monotonic()
+    api_data = self._fetch_from_stand_in_server(
+        server,
+        3,
+        max_workers=1,
+        rate_limiter=operational_metrics_lib.GitHubRateLimiter(
+            min_remaining=100
+        ),
+    )
+
+    self.assertEqual(len(api_data), 3)
+    self.assertGreaterEqual(time.monotonic() - start_time, 0.4)
+    self.assertEqual(server.remaining_points, 4998)
+
+  def test_fetch_repository_data_from_github_retries_rate_limited(self):
+    """Test retrying batches that hit a secondary rate limit."""
+    server = _StandInGraphQLServer(rate_limited_requests=1)
+
+    with self.assertLogs(level='WARNING'):
+      with unittest.mock.patch('time.sleep'):  # Avoid sleep in unit test
+        api_data = self._fetch_from_stand_in_server(server, 2, max_workers=1)
+
+    self.assertEqual(len(api_data), 2)
+    self.assertEqual(server.requests, 3)
+
+  def test_fetch_repository_data_from_github_resends_rate_limited_batches(
+      self,
+  ):
+    """Test sending batches that hit a rate limit again without splitting."""
+    server = _StandInGraphQLServer(
+        rate_limited_requests=1, rate_limited_status=403
+    )
+
+    with self.assertLogs(level='WARNING'):
+      api_data = self._fetch_from_stand_in_server(
+          server, 35, batch_size=35, max_batch_size=35, max_workers=1
+      )
+
+    self.assertEqual(list(api_data), [f'commit_{i}' for i in range(35)])
+    self.assertEqual(server.request_subquery_counts, [35, 35])
+
+  def test_fetch_repository_data_from_github_splits_failed_batches(self):
+    """Test splitting batches that fail until their halves succeed."""
+    server = _StandInGraphQLServer(max_subqueries_per_request=3)
+
+    api_data = self._fetch_from_stand_in_server(
+        server, 16, batch_size=16, max_batch_size=16, max_workers=1
+    )
+
+    self.assertEqual(list(api_data), [f'commit_{i}' for i in range(16)])
+    self.assertEqual(
+        server.request_subquery_counts[:7], [16, 8, 8, 4, 4, 4, 4]
+    )
+    # Every subquery is only fetched once successfully.
+    self.assertEqual(
+        sum(
+            count
+            for count in server.request_subquery_counts
+            if count <= server.max_subqueries_per_request
+        ),
+        16,
+    )
+
+  def test_fetch_repository_data_from_github_fails_single_subquery(self):
+    """Test that a subquery that fails on its own fails the whole fetch."""
+    server = _StandInGraphQLServer(max_subqueries_per_request=0)
+
+    with unittest.mock.patch('time.sleep'):  # Avoid sleep in unit test
+      with self.assertRaises(requests.exceptions.HTTPError):
+        self._fetch_from_stand_in_server(
+            server, 2, batch_size=2, max_batch_size=2, max_workers=1
+        )
+
+  def test_fetch_repository_data_from_github_grows_batches(self):
+    """Test growing batches while queries are fast and cheap."""
+    server = _StandInGraphQLServer()
+
+    api_data = self._fetch_from_stand_in_server(
+        server, 60, batch_size=2, max_batch_size=10, max_workers=1
+    )
+
+    self.assertEqual(len(api_data), 60)
+    self.assertEqual(server.request_subquery_counts[0], 2)
+    self.assertEqual(max(server.request_subquery_counts), 10)
+
+  def test_fetch_repository_data_from_github_with_cache(self):
+    """Test only querying subqueries that are not cached."""
+    with tempfile.TemporaryDirectory() as cache_path:
+      cache = operational_metrics_lib.GraphQLResponseCache(cache_path)
+      first_server = _StandInGraphQLServer()
+      self._fetch_from_stand_in_server(first_server, 5, cache=cache)
+      second_server = _StandInGraphQLServer()
+      api_data = self._fetch_from_stand_in_server(
+          second_server, 8, cache=cache
+      )
+
+    self.assertEqual(first_server.requests, 5)
+    self.assertEqual(second_server.requests, 3)
+    self.assertEqual(list(api_data), [f'commit_{i}' for i in range(8)])
+    self.assertEqual(cache.hits, 5)
+    self.assertEqual(cache.misses, 8)
+
+  def test_iter_repository_data_from_github_in_order(self):
+    """Test yielding batches and cached responses in subquery order."""
+    with tempfile.TemporaryDirectory() as cache_path:
+      cache = operational_metrics_lib.GraphQLResponseCache(cache_path)
+      cache.put('commit_1: ...', {'cached': True})
+      cache.put('commit_4: ...', {'cached': True})
+      server = _StandInGraphQLServer(response_delay_seconds=0.05)
+      server_thread = threading.Thread(target=server.serve_forever)
+      server_thread.start()
+      try:
+        batches = list(
+            operational_metrics_lib.iter_repository_data_from_github(
+                github_token='dummy_token',
+                subqueries=[f'commit_{i}: ...' for i in range(8)],
+                batch_size=2,
+                max_batch_size=2,
+                api_url=server.url,
+                cache=cache,
+            )
+        )
+      finally:
+        server.shutdown()
+        server_thread.join()
+        server.server_close()
+
+    self.assertEqual(
+        [list(batch) for batch in batches],
+        [
+            ['commit_0', 'commit_1', 'commit_2'],
+            ['commit_3', 'commit_4', 'commit_5'],
+            ['commit_6', 'commit_7'],
+        ],
+    )
+    self.assertEqual(batches[0]['commit_1'], {'cached': True})
+    self.assertEqual(server.requests, 3)
+
+  def test_repository_data_spool(self):
+    with tempfile.TemporaryDirectory() as spool_directory:
+      spool = operational_metrics_lib.RepositoryDataSpool(
+          os.path.join(spool_directory, 'api_data.json')
+      )
+      spool.extend([{'commit_a': {'number': 1}}, {'commit_b': None}])
+
+      self.assertEqual(len(spool), 2)
+      # The data can be read several times.
+      for _ in range(2):
+        self.assertEqual(
+            list(spool.items()),
+            [('commit_a', {'number': 1}), ('commit_b', None)],
+        )
+
+  def test_records_are_slotted(self):
+    commit_data = self._create_llvm_commit_data()
+    self.assertFalse(hasattr(commit_data, '__dict__'))
+
+  def test_adaptive_batch_size(self):
+    """Test how the batch size follows the duration, size and cost."""
+    batch_size = operational_metrics_lib.AdaptiveBatchSize(
+        initial_size=40,
+        max_size=100,
+        target_seconds=5,
+        max_response_bytes=1000,
+        max_cost=10,
+    )
+    batch_size.record_success(40, 10, 0, 1)
+    self.assertEqual(batch_size.size, 20)
+    batch_size.record_success(20, 1, 2000, 1)
+    self.assertEqual(batch_size.size, 10)
+    batch_size.record_success(10, 1, 100, 20)
+    self.assertEqual(batch_size.size, 5)
+    batch_size.record_success(5, 3, 100, 1)
+    self.assertEqual(batch_size.size, 5)
+    batch_size.record_success(5, 1, 100, 1)
+    self.assertEqual(batch_size.size, 6)
+    # Results of batches picked before the last change do not grow it.
+    batch_size.record_success(5, 1, 100, 1)
+    self.assertEqual(batch_size.size, 6)
+    batch_size.record_failure(6)
+    self.assertEqual(batch_size.size, 3)
+    batch_size.record_failure(1)
+    self.assertEqual(batch_size.size, 1)
+
+  def test_rate_limiter_ignores_outdated_responses(self):
+    """Test that out of order responses do not raise the remaining points."""
+    rate_limiter = operational_metrics_lib.GitHubRateLimiter(min_remaining=10)
+    reset_at = (
+        datetime.datetime.now(datetime.timezone.utc)
+        + datetime.timedelta(hours=1)
+    ).isoformat()
+    first_cost = rate_limiter.acquire()
+    second_cost = rate_limiter.acquire()
+    rate_limiter.release(
+        second_cost, {'cost': 1, 'remaining': 10, 'resetAt': reset_at}
+    )
+    rate_limiter.release(
+        first_cost, {'cost': 1, 'remaining': 11, 'resetAt': reset_at}
+    )
+
+    acquired = threading.Event()
+    threading.Thread(
+        target=lambda: (rate_limiter.acquire(), acquired.set()), daemon=True
+    ).start()
+    self.assertFalse(acquired.wait(0.2))
+
+    # A response from the next rate limit window should let it continue.
+    rate_limiter.release(
+        0,
+        {
+            'cost': 1,
+            'remaining': 5000,
+            'resetAt': (
+                datetime.datetime.now(datetime.timezone.utc)
+                + datetime.timedelta(hours=2)
+            ).isoformat(),
+        },
+    )
+    self.assertTrue(acquired.wait(1))
+
   @unittest.mock.patch('uuid.uuid4')
   def test_upload_to_bigquery(self, mock_uuid4):
     """Test uploading commit data to BigQuery."""
@@ -121,6 +486,15 @@ class TestOperationalMetricsLib(unittest.TestCase):
 
     commit_data = self._create_llvm_commit_data(commit_sha='abcdef')
     expected_commit_record = dataclasses.asdict(commit_data)
+    # The staged files are removed after the upload, so read them while they
+    # are loaded.
+    loaded_rows = []
+
+    def load_table_from_file(chunk_file, **kwargs):
+      loaded_rows.extend(json.loads(line) for line in chunk_file)
+      return unittest.mock.MagicMock()
+
+    mock_bq_client.load_table_from_file.side_effect = load_table_from_file
 
     operational_metrics_lib.upload_to_bigquery(
         bq_client=mock_bq_client,
@@ -131,12 +505,12 @@ class TestOperationalMetricsLib(unittest.TestCase):
     )
 
     # Staging table
-    mock_bq_client.load_table_from_json.assert_called_once()
-    mock_bq_client.load_table_from_json.assert_called_once_with(
-        json_rows=[expected_commit_record],
+    mock_bq_client.load_table_from_file.assert_called_once_with(
+        unittest.mock.ANY,
         destination='mock_dataset.mock_table_staging_abc123',
         job_config=unittest.mock.ANY,
     )
+    self.assertEqual(loaded_rows, [expected_commit_record])
 
     # Merging
     mock_bq_client.query.assert_called_once()
@@ -156,7 +530,7 @@ class TestOperationalMetricsLib(unittest.TestCase):
   def test_upload_to_bigquery_exits_on_error(self):
     """Test uploading commit data to BigQuery resulting in errors."""
     mock_bq_client = unittest.mock.MagicMock()
-    mock_bq_client.load_table_from_json.side_effect = Exception('Mock BQ Error')
+    mock_bq_client.load_table_from_file.side_effect = Exception('Mock BQ Error')
 
     with self.assertLogs(level='ERROR'):
       with self.assertRaises(SystemExit):
@@ -168,6 +542,289 @@ class TestOperationalMetricsLib(unittest.TestCase):
             primary_key='commit_sha',
         )
 
+    # The staging table is removed even though it could not be loaded.
+    mock_bq_client.delete_table.assert_called_once()
+
+  def test_upload_tables_to_sqlite(self):
+    """Test uploading data in chunks to a local SQLite database."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+      sink = operational_metrics_lib.SQLiteSink(
+          os.path.join(temp_dir, 'metrics.sqlite')
+      )
+      commit_data = [
+          self._create_llvm_commit_data(commit_sha=f'commit_{i}')
+          for i in range(10)
+      ]
+      commit_data[0].diff = [
+          {'file': 'foo.c', 'additions': 1, 'deletions': 2, 'total': 3}
+      ]
+      operational_metrics_lib.upload_tables(
+          sink,
+          [[
+              operational_metrics_lib.TableUpload(
+                  'llvm_commits', iter(commit_data), 'commit_sha'
+              )
+          ]],
+          # Start a new chunk after every row.
+          max_chunk_bytes=1,
+      )
+
+      # Existing rows are updated rather than duplicated.
+      commit_data[1].commit_author = 'commit_author'
+      operational_metrics_lib.upload_tables(
+          sink,
+          [[
+              operational_metrics_lib.TableUpload(
+                  'llvm_commits', commit_data[:2], 'commit_sha'
+              ),
+              operational_metrics_lib.TableUpload(
+                  'llvm_reviews', [], 'review_id'
+              ),
+          ]],
+      )
+
+      db_connection = sqlite3.connect(os.path.join(temp_dir, 'metrics.sqlite'))
+      rows = db_connection.execute(
+          'SELECT commit_sha, commit_author, diff FROM llvm_commits'
+          ' ORDER BY commit_sha'
+      ).fetchall()
+      tables = db_connection.execute(
+          "SELECT name FROM sqlite_master WHERE type = 'table'"
+      ).fetchall()
+      db_connection.close()
+
+    self.assertEqual(len(rows), 10)
+    self.assertEqual(
+        json.loads(rows[0][2]),
+        [{'file': 'foo.c', 'additions': 1, 'deletions': 2, 'total': 3}],
+    )
+    self.assertEqual(rows[1][1], 'commit_author')
+    # Staging tables are removed.
+    self.assertEqual(tables, [('llvm_commits',)])
+
+  def test_upload_tables_merges_groups_in_order(self):
+    """Test that tables are only merged after the tables of earlier groups."""
+    mock_sink = unittest.mock.MagicMock()
+    mock_sink.stage.side_effect = lambda table, *_: f'{table}_staging'
+    merged_tables = []
+    mock_sink.merge.side_effect = lambda table, *_: merged_tables.append(table)
+
+    operational_metrics_lib.upload_tables(
+        mock_sink,
+        [
+            [
+                operational_metrics_lib.TableUpload(
+                    'llvm_pull_requests',
+                    [self._create_llvm_commit_data()],
+                    'commit_sha',
+                ),
+                operational_metrics_lib.TableUpload(
+                    'llvm_reviews',
+                    [self._create_llvm_commit_data()],
+                    'commit_sha',
+                ),
+            ],
+            [
+                operational_metrics_lib.TableUpload(
+                    'llvm_commits',
+                    [self._create_llvm_commit_data()],
+                    'commit_sha',
+                )
+            ],
+        ],
+    )
+
+    self.assertCountEqual(
+        merged_tables[:2], ['llvm_pull_requests', 'llvm_reviews']
+    )
+    self.assertEqual(merged_tables[2], 'llvm_commits')
+    self.assertCountEqual(
+        [call.args[0] for call in mock_sink.discard.call_args_list],
+        [
+            'llvm_pull_requests_staging',
+            'llvm_reviews_staging',
+            'llvm_commits_staging',
+        ],
+    )
+
+  def test_upload_tables_does_not_merge_after_failure(self):
+    """Test that later groups are not merged when an earlier one fails."""
+    mock_sink = unittest.mock.MagicMock()
+    mock_sink.stage.side_effect = lambda table, *_: f'{table}_staging'
+    mock_sink.merge.side_effect = Exception('Mock merge error')
+
+    with self.assertLogs(level='ERROR'):
+      with self.assertRaises(SystemExit):
+        operational_metrics_lib.upload_tables(
+            mock_sink,
+            [
+                [
+                    operational_metrics_lib.TableUpload(
+                        'llvm_reviews',
+                        [self._create_llvm_commit_data()],
+                        'commit_sha',
+                    )
+                ],
+                [
+                    operational_metrics_lib.TableUpload(
+                        'llvm_commits',
+                        [self._create_llvm_commit_data()],
+                        'commit_sha',
+                    )
+                ],
+            ],
+        )
+
+    mock_sink.merge.assert_called_once()
+    self.assertEqual(mock_sink.discard.call_count, 2)
+
+
+
+class TestGraphQLResponseCache(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def test_get_cached_response(self):
+    cache = operational_metrics_lib.GraphQLResponseCache(self.temp_dir.name)
+    cache.put('commit_a: ...', {'author': 'a'})
+    cache.put('commit_b: ...', None)
+
+    self.assertEqual(cache.get('commit_a: ...'), {'author': 'a'})
+    self.assertIsNone(cache.get('commit_a: { other fields }'))
+    self.assertIsNone(cache.get('commit_b: ...'))
+    self.assertEqual((cache.hits, cache.misses), (1, 2))
+    # Responses are kept across runs.
+    cache = operational_metrics_lib.GraphQLResponseCache(self.temp_dir.name)
+    self.assertEqual(cache.get('commit_a: ...'), {'author': 'a'})
+
+  def test_cached_responses_expire(self):
+    cache = operational_metrics_lib.GraphQLResponseCache(
+        self.temp_dir.name, ttl_seconds=60
+    )
+    cache.put('commit_a: ...', {'author': 'a'})
+
+    with unittest.mock.patch.object(
+        operational_metrics_lib.time, 'time', return_value=time.time() + 61
+    ):
+      self.assertIsNone(cache.get('commit_a: ...'))
+    self.assertIsNone(cache.get('commit_a: ...'))
+
+  def test_cache_evicts_least_recently_used_responses(self):
+    cache = operational_metrics_lib.GraphQLResponseCache(
+        self.temp_dir.name, max_bytes=1000
+    )
+    for i in range(4):
+      cache.put(f'commit_{i}: ...', {'author': 'a' * 100})
+    # Entries are ordered by modification time, which can have a coarse
+    # resolution, so age them explicitly.
+    for i in range(4):
+      entry_path = cache._get_entry_path(f'commit_{i}: ...')
+      os.utime(entry_path, (1000 + i, 1000 + i))
+    cache = operational_metrics_lib.GraphQLResponseCache(
+        self.temp_dir.name, ttl_seconds=float('inf'), max_bytes=1000
+    )
+    self.assertIsNotNone(cache.get('commit_0: ...'))
+    for i in range(4, 8):
+      cache.put(f'commit_{i}: ...', {'author': 'a' * 100})
+
+    self.assertGreater(cache.evictions, 0)
+    self.assertIsNotNone(cache.get('commit_0: ...'))
+    self.assertIsNone(cache.get('commit_1: ...'))
+    self.assertIsNotNone(cache.get('commit_7: ...'))
+
+
+class TestRepositoryCache(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.upstream_path = os.path.join(self.temp_dir.name, 'upstream')
+    self.upstream_repo = git.Repo.init(
+        self.upstream_path, initial_branch='main'
+    )
+    # Allow partial clones and fetching objects by hash, as GitHub does.
+    with self.upstream_repo.config_writer() as config:
+      config.set_value('uploadpack', 'allowFilter', 'true')
+      config.set_value('uploadpack', 'allowAnySHA1InWant', 'true')
+    self.upstream_url = f'file://{self.upstream_path}'
+    self.cache_path = os.path.join(self.temp_dir.name, 'cache')
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _commit_file(self, file_name: str, content: str) -> str:
+    with open(os.path.join(self.upstream_path, file_name), 'w') as file:
+      file.write(content)
+    self.upstream_repo.index.add([file_name])
+    return self.upstream_repo.index.commit(f'Change {file_name}').hexsha
+
+  def _get_missing_objects(self, repo: git.Repo, commit_sha: str) -> set[str]:
+    return {
+        line.removeprefix('?')
+        for line in repo.git.rev_list(
+            '--objects', '--missing=print', commit_sha
+        ).splitlines()
+        if line.startswith('?')
+    }
+
+  def test_open_repository_cache(self):
+    """Test cloning a blobless repository cache and updating it."""
+    first_commit_sha = self._commit_file('foo.c', 'foo\n')
+
+    repo = operational_metrics_lib.open_repository_cache(
+        self.cache_path, self.upstream_url
+    )
+
+    self.assertTrue(repo.bare)
+    self.assertEqual(repo.head.commit.hexsha, first_commit_sha)
+    self.assertEqual(
+        self._get_missing_objects(repo, first_commit_sha),
+        {self.upstream_repo.head.commit.tree['foo.c'].hexsha},
+    )
+
+    second_commit_sha = self._commit_file('foo.c', 'foo\nbar\n')
+    repo = operational_metrics_lib.open_repository_cache(
+        self.cache_path, self.upstream_url
+    )
+
+    self.assertEqual(repo.head.commit.hexsha, second_commit_sha)
+
+  def test_open_repository_cache_replaces_broken_cache(self):
+    """Test that a cache that cannot be updated is cloned again."""
+    commit_sha = self._commit_file('foo.c', 'foo\n')
+    os.makedirs(self.cache_path)
+    os.makedirs(f'{self.cache_path}.partial')
+
+    with self.assertLogs(level='WARNING'):
+      repo = operational_metrics_lib.open_repository_cache(
+          self.cache_path, self.upstream_url
+      )
+
+    self.assertEqual(repo.head.commit.hexsha, commit_sha)
+    self.assertFalse(os.path.exists(f'{self.cache_path}.partial'))
+
+  def test_prefetch_diff_blobs(self):
+    """Test fetching the contents of the files changed by commits."""
+    self._commit_file('foo.c', 'foo\n')
+    self._commit_file('bar.c', 'bar\n')
+    commit_sha = self._commit_file('foo.c', 'foo\nbar\n')
+    repo = operational_metrics_lib.open_repository_cache(
+        self.cache_path, self.upstream_url
+    )
+
+    # The old and new contents of foo.c.
+    self.assertEqual(
+        operational_metrics_lib.prefetch_diff_blobs(repo, [commit_sha]), 2
+    )
+    self.assertEqual(
+        self._get_missing_objects(repo, commit_sha),
+        {self.upstream_repo.head.commit.tree['bar.c'].hexsha},
+    )
+    self.assertEqual(repo.commit(commit_sha).stats.files['foo.c']['lines'], 1)
+
 
 if __name__ == '__main__':
   unittest.main()
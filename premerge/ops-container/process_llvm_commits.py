@@ -1,14 +1,39 @@
+import argparse
 import datetime
+import json
 import logging
 import os
 import re
-from typing import Any, Optional
+import subprocess
+import tempfile
+import time
+from typing import Any, Iterable, Iterator, Optional
 import git
 from google.cloud import bigquery
 import operational_metrics_lib
 
 REPOSITORY_URL = "https://github.com/llvm/llvm-project.git"
 
+# Where to keep the cached clone of the repository. The cronjob mounts a
+# persistent volume here so the clone is kept across runs.
+DEFAULT_REPOSITORY_PATH = "./llvm-project"
+
+# Where to cache GitHub API responses to commit subqueries, if not set through
+# the GITHUB_API_CACHE_PATH environment variable. Runs whose commits overlap
+# with earlier runs, like retries, only query the API for new commits.
+DEFAULT_GITHUB_API_CACHE_PATH = "./github-api-cache"
+
+# Where backfills keep track of their progress, so that interrupted backfills
+# can be resumed.
+DEFAULT_BACKFILL_STATE_PATH = "./backfill_state.json"
+
+# How many commits backfills upload at a time. Progress is saved after every
+# chunk of commits.
+BACKFILL_CHUNK_COMMITS = 2000
+
+# How many queries to the GitHub API to make concurrently by default.
+DEFAULT_GITHUB_API_WORKERS = operational_metrics_lib.DEFAULT_GITHUB_API_WORKERS
+
 # BigQuery dataset and tables to write metrics to.
 OPERATIONAL_METRICS_DATASET = "operational_metrics"
 LLVM_COMMITS_TABLE = "llvm_commits"
@@ -22,8 +47,22 @@ GITHUB_API_BATCH_SIZE = 35
 # Number of days to look back for new commits
 # We allow some buffer time between when a commit is made and when it is queried
 # for reviews. This is to allow time for any new GitHub events to propogate.
+# Commits are scraped up to the end of the day this many days ago.
 LOOKBACK_DAYS = 2
 
+# How many days before the newest uploaded commit to look for the newest
+# uploaded commit on main in. Commit timestamps are not monotonic along main,
+# so this needs to cover how far out of order commits can land.
+RESUME_WINDOW_DAYS = 7
+
+# Format of each commit in the git log output that commit data is extracted
+# from. Records and fields are separated by ASCII separator characters, which
+# do not occur in commit messages.
+_LOG_RECORD_SEPARATOR = "\x1e"
+_LOG_FIELD_SEPARATOR = "\x1f"
+_LOG_FORMAT = "%x1e%H%x1f%ct%x1f%B%x1f"
+_LOG_READ_SIZE = 1 << 16
+
 # Template GraphQL subquery to check if a commit has an associated pull request
 # and whether that pull request has been reviewed and approved.
 COMMIT_GRAPHQL_SUBQUERY_TEMPLATE = """
@@ -46,6 +85,78 @@ commit_{commit_sha}:
 """
 
 
+def get_last_processed_commit(
+    bq_client: bigquery.Client, repo: git.Repo
+) -> str | None:
+  """Get the newest commit on main that has already been uploaded to BigQuery.
+
+  The commits table is uploaded last, so every commit in it has been fully
+  processed. Commit timestamps are not monotonic along main, so the newest
+  timestamp only bounds which commits to consider. The watermark is the first
+  of them found walking the first parent history of main back from its tip.
+  The walk stops RESUME_WINDOW_DAYS before the oldest of them, so that it
+  does not go through the whole history if none of them are on main.
+
+  Args:
+    bq_client: The BigQuery client to use for querying.
+    repo: The git repository that the commits were scraped from.
+
+  Returns:
+    The hash of the newest uploaded commit on main, or None if there is none.
+  """
+  query = f"""
+  SELECT commit_sha, commit_timestamp_seconds
+  FROM {OPERATIONAL_METRICS_DATASET}.{LLVM_COMMITS_TABLE}
+  WHERE commit_timestamp_seconds >= (
+    SELECT MAX(commit_timestamp_seconds)
+    FROM {OPERATIONAL_METRICS_DATASET}.{LLVM_COMMITS_TABLE}
+  ) - @resume_window_seconds
+  """
+  resume_window = datetime.timedelta(days=RESUME_WINDOW_DAYS)
+  job_config = bigquery.QueryJobConfig(
+      query_parameters=[
+          bigquery.ScalarQueryParameter(
+              "resume_window_seconds",
+              "INT64",
+              int(resume_window.total_seconds()),
+          ),
+      ],
+  )
+  processed_commit_timestamps = {
+      row.commit_sha: row.commit_timestamp_seconds
+      for row in bq_client.query(query, job_config=job_config).result()
+  }
+  if not processed_commit_timestamps:
+    return None
+  walk_since = (
+      datetime.datetime.fromtimestamp(
+          min(processed_commit_timestamps.values()), datetime.timezone.utc
+      )
+      - resume_window
+  )
+  for commit in repo.iter_commits(
+      "HEAD", first_parent=True, since=walk_since.isoformat()
+  ):
+    if commit.hexsha in processed_commit_timestamps:
+      return commit.hexsha
+  logging.warning(
+      "None of the %d most recently uploaded commits are on main since %s.",
+      len(processed_commit_timestamps),
+      walk_since,
+  )
+  return None
+
+
+def _get_start_of_next_day(
+    target_datetime: datetime.datetime,
+) -> datetime.datetime:
+  return datetime.datetime.combine(
+      target_datetime.astimezone(datetime.timezone.utc).date(),
+      datetime.time(),
+      tzinfo=datetime.timezone.utc,
+  ) + datetime.timedelta(days=1)
+
+
 def scrape_commits_by_date(
     repo: git.Repo,
     target_datetime: datetime.datetime,
@@ -60,9 +171,16 @@ def scrape_commits_by_date(
     List of new commits made on the given date.
   """
   # Scrape for new commits
-  # iter_commits() yields commits in reverse chronological order
+  # iter_commits() yields commits in reverse chronological order. Bounding the
+  # walk by date lets git stop once it reaches commits before the target date,
+  # rather than walking the whole history.
+  end_datetime = _get_start_of_next_day(target_datetime)
   commits = []
-  for commit in repo.iter_commits():
+  for commit in repo.iter_commits(
+      "HEAD",
+      since=(end_datetime - datetime.timedelta(days=1)).isoformat(),
+      until=end_datetime.isoformat(),
+  ):
     # Skip commits that don't match the target date
     committed_datetime = commit.committed_datetime.astimezone(
         datetime.timezone.utc
@@ -76,6 +194,87 @@ def scrape_commits_by_date(
   return commits
 
 
+def scrape_commits_after(
+    repo: git.Repo,
+    last_processed_commit_sha: str,
+    target_datetime: datetime.datetime,
+) -> list[git.Commit]:
+  """Scrape commits made after the last processed commit, up to a date.
+
+  Commits are scraped up to the last commit on the first parent history made
+  on or before the given date, so that the commits scraped by consecutive runs
+  follow on from each other without gaps, even across days that were missed.
+  The walk stops at the last processed commit rather than going through the
+  whole history.
+
+  Args:
+    repo: The git repository to scrape.
+    last_processed_commit_sha: The newest commit that has been processed.
+    target_datetime: The last date to scrape commits for.
+
+  Returns:
+    List of new commits, in reverse chronological order.
+  """
+  end_commit = next(
+      repo.iter_commits(
+          "HEAD",
+          max_count=1,
+          first_parent=True,
+          until=_get_start_of_next_day(target_datetime).isoformat(),
+      ),
+      None,
+  )
+  if end_commit is None:
+    return []
+  commits = list(
+      repo.iter_commits(f"{last_processed_commit_sha}..{end_commit.hexsha}")
+  )
+  logging.info(
+      "Found %d new commits after %s up to %s",
+      len(commits),
+      last_processed_commit_sha,
+      end_commit.hexsha,
+  )
+  return commits
+
+
+def scrape_commits_by_date_range(
+    repo: git.Repo,
+    start_date: datetime.date,
+    end_date: datetime.date,
+) -> list[str]:
+  """Scrape commits made within a range of dates in a single pass.
+
+  Args:
+    repo: The git repository to scrape.
+    start_date: The first date to scrape commits for.
+    end_date: The last date to scrape commits for.
+
+  Returns:
+    The hashes of the commits made on the given dates, oldest first.
+  """
+  start_datetime = datetime.datetime.combine(
+      start_date, datetime.time(), tzinfo=datetime.timezone.utc
+  )
+  end_datetime = datetime.datetime.combine(
+      end_date, datetime.time(), tzinfo=datetime.timezone.utc
+  ) + datetime.timedelta(days=1)
+  commit_shas = []
+  for commit in repo.iter_commits(
+      "HEAD",
+      since=start_datetime.isoformat(),
+      until=end_datetime.isoformat(),
+  ):
+    if start_datetime <= commit.committed_datetime < end_datetime:
+      commit_shas.append(commit.hexsha)
+  commit_shas.reverse()
+
+  logging.info(
+      "Found %d commits from %s to %s", len(commit_shas), start_date, end_date
+  )
+  return commit_shas
+
+
 def parse_commit_revert_info(
     commit_message: str,
 ) -> tuple[bool, Optional[int], Optional[str]]:
@@ -118,52 +317,134 @@ def parse_commit_revert_info(
   return is_revert, pull_request_reverted, commit_reverted
 
 
-def extract_initial_commit_data(
-    commit: git.Commit,
+def _parse_commit_log_record(
+    record: str,
 ) -> operational_metrics_lib.LLVMCommitData:
+  commit_sha, committed_date, rest = record.split(_LOG_FIELD_SEPARATOR, 2)
+  commit_message, numstat = rest.rsplit(_LOG_FIELD_SEPARATOR, 1)
+
   # Parse commit message for revert information
   is_revert, pull_request_reverted, commit_reverted = parse_commit_revert_info(
-      commit.message
+      commit_message
   )
 
+  # Every changed file is listed as "<additions>\t<deletions>\t<file>". The
+  # line counts of binary files are listed as "-".
+  diff = []
+  for numstat_entry in numstat.split("\0"):
+    numstat_entry = numstat_entry.strip("\n")
+    if not numstat_entry:
+      continue
+    additions, deletions, file = numstat_entry.split("\t", 2)
+    additions = int(additions) if additions != "-" else 0
+    deletions = int(deletions) if deletions != "-" else 0
+    diff.append({
+        "file": file,
+        "additions": additions,
+        "deletions": deletions,
+        "total": additions + deletions,
+    })
+
   # Add entry
   return operational_metrics_lib.LLVMCommitData(
-      commit_sha=commit.hexsha,
-      commit_timestamp_seconds=commit.committed_date,
-      diff=[
-          {
-              "file": file,
-              "additions": line_stats["insertions"],
-              "deletions": line_stats["deletions"],
-              "total": line_stats["lines"],
-          }
-          for file, line_stats in commit.stats.files.items()
-      ],
+      commit_sha=commit_sha,
+      commit_timestamp_seconds=int(committed_date),
+      diff=diff,
       is_revert=is_revert,
       pull_request_reverted=pull_request_reverted,
       commit_reverted=commit_reverted,
   )
 
 
+def extract_initial_commit_data(
+    repo: git.Repo,
+    commit_shas: list[str],
+) -> Iterator[operational_metrics_lib.LLVMCommitData]:
+  """Extract the commit data that is available from the repository.
+
+  The diffstats and messages of all commits are read from a single git log
+  invocation, whose output is parsed as it is streamed, rather than running a
+  git diff for every commit.
+
+  Args:
+    repo: The git repository the commits are in.
+    commit_shas: The commits to extract data for.
+
+  Yields:
+    LLVMCommitData objects with the data from the repository, in the order of
+    the given commits.
+  """
+  if not commit_shas:
+    return
+  # Commits are diffed against their first parent without rename detection,
+  # and file names are not quoted.
+  git_log = subprocess.Popen(
+      [
+          "git",
+          "log",
+          "--stdin",
+          "--no-walk=unsorted",
+          "--first-parent",
+          "--numstat",
+          "--no-renames",
+          "-z",
+          f"--format={_LOG_FORMAT}",
+      ],
+      cwd=repo.git_dir,
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      text=True,
+      encoding="utf-8",
+      errors="replace",
+  )
+  # git reads all revisions before writing any output.
+  git_log.stdin.write("\n".join(commit_shas))
+  git_log.stdin.close()
+  pending_output = ""
+  finished_reading = False
+  try:
+    while output := git_log.stdout.read(_LOG_READ_SIZE):
+      records = (pending_output + output).split(_LOG_RECORD_SEPARATOR)
+      pending_output = records.pop()
+      for record in records:
+        if record:
+          yield _parse_commit_log_record(record)
+    finished_reading = True
+  finally:
+    git_log.stdout.close()
+    # Stop git if the caller stopped reading early.
+    if not finished_reading:
+      git_log.kill()
+    git_log.wait()
+  if git_log.returncode != 0:
+    raise git.GitCommandError(git_log.args, git_log.returncode)
+  if pending_output:
+    yield _parse_commit_log_record(pending_output)
+
+
 def extract_commit_data(
-    scraped_commits: list[git.Commit],
-    api_data: dict[str, Any],
-) -> list[operational_metrics_lib.LLVMCommitData]:
+    initial_commit_data: Iterable[operational_metrics_lib.LLVMCommitData],
+    api_data: dict[str, Any] | operational_metrics_lib.RepositoryDataSpool,
+) -> Iterator[operational_metrics_lib.LLVMCommitData]:
   """Extract commit data from scraped Git commits and GitHub API data.
 
   Args:
-    scraped_commits: List of commits scraped from cloned LLVM repository.
-    api_data: JSON response from GitHub API.
+    initial_commit_data: The data of the commits scraped from the cloned LLVM
+      repository, as returned by extract_initial_commit_data.
+    api_data: JSON response from GitHub API, for the same commits in the same
+      order.
 
-  Returns:
-    List of LLVMCommitData objects for each commit found.
+  Yields:
+    LLVMCommitData objects for each commit found.
   """
-  commit_map = {
-      commit.hexsha: extract_initial_commit_data(commit)
-      for commit in scraped_commits
-  }
-  for commit_sha, commit_data in api_data.items():
-    commit = commit_map[commit_sha.removeprefix("commit_")]
+  api_items = iter(api_data.items())
+  for commit in initial_commit_data:
+    commit_sha, commit_data = next(api_items)
+    if commit_sha != f"commit_{commit.commit_sha}":
+      raise ValueError(
+          f"Expected GitHub API data for commit {commit.commit_sha}, got"
+          f" {commit_sha}"
+      )
 
     # Some commits have no author, possible when an account is deleted or
     # email address is changed.
@@ -173,81 +454,81 @@ def extract_commit_data(
       logging.warning("No author found for commit %s", commit.commit_sha)
       commit.commit_author = None
 
-    # If commit has no pull requests, skip it. No data to update.
     if commit_data["associatedPullRequests"]["totalCount"] == 0:
       commit.associated_pull_request = None
-      continue
     else:
       pull_request = commit_data["associatedPullRequests"]["pullRequest"][0]
       commit.associated_pull_request = pull_request["number"]
-
-  return list(commit_map.values())
+    yield commit
 
 
 def extract_pull_request_data(
-    api_data: dict[str, Any],
-) -> list[operational_metrics_lib.LLVMPullRequestData]:
+    api_data: dict[str, Any] | operational_metrics_lib.RepositoryDataSpool,
+) -> Iterator[operational_metrics_lib.LLVMPullRequestData]:
   """Extract pull request data from GitHub API data.
 
+  The data is read twice, first to find the commits of every pull request,
+  and then to parse each pull request, so that only the commits need to be
+  held in memory.
+
   Args:
     api_data: JSON response from GitHub API.
 
-  Returns:
-    List of LLVMPullRequestData objects for each pull request found.
+  Yields:
+    LLVMPullRequestData objects for each pull request found.
   """
-  pull_requests_by_number = {}
   commits_by_pull_request_number = {}
-
   for commit_sha, commit_data in api_data.items():
     if commit_data["associatedPullRequests"]["totalCount"] == 0:
       continue
 
     pull_request = commit_data["associatedPullRequests"]["pullRequest"][0]
-    pull_request_number = pull_request["number"]
-    commit_hash = commit_sha.removeprefix("commit_")
+    commits_by_pull_request_number.setdefault(
+        pull_request["number"], []
+    ).append(commit_sha.removeprefix("commit_"))
 
-    if pull_request_number not in pull_requests_by_number:
-      pull_requests_by_number[pull_request_number] = pull_request
-      commits_by_pull_request_number[pull_request_number] = []
-
-    commits_by_pull_request_number[pull_request_number].append(commit_hash)
+  for _, commit_data in api_data.items():
+    if commit_data["associatedPullRequests"]["totalCount"] == 0:
+      continue
 
-  return [
-      operational_metrics_lib.parse_pull_request_data(
-          pull_request=pull_request,
-          associated_commits=commits_by_pull_request_number[
-              pull_request_number
-          ],
-      )
-      for pull_request_number, pull_request in pull_requests_by_number.items()
-  ]
+    pull_request = commit_data["associatedPullRequests"]["pullRequest"][0]
+    # Only parse each pull request the first time it is seen.
+    associated_commits = commits_by_pull_request_number.pop(
+        pull_request["number"], None
+    )
+    if associated_commits is None:
+      continue
+    yield operational_metrics_lib.parse_pull_request_data(
+        pull_request=pull_request,
+        associated_commits=associated_commits,
+    )
 
 
 def extract_review_data(
-    api_data: dict[str, Any],
-) -> list[operational_metrics_lib.LLVMReviewData]:
+    api_data: dict[str, Any] | operational_metrics_lib.RepositoryDataSpool,
+) -> Iterator[operational_metrics_lib.LLVMReviewData]:
   """Extract review data from GitHub API data.
 
   Args:
     api_data: JSON response from Github API.
 
-  Returns:
-    List of LLVMReviewData objects for each review found.
+  Yields:
+    LLVMReviewData objects for each review found.
   """
-  review_data = []
   for _, commit_data in api_data.items():
     if commit_data["associatedPullRequests"]["totalCount"] == 0:
       continue
     pull_request = commit_data["associatedPullRequests"]["pullRequest"][0]
-    review_data.extend(operational_metrics_lib.parse_review_data(pull_request))
+    yield from operational_metrics_lib.parse_review_data(pull_request)
 
-  return review_data
 
-
-def fetch_commit_data_from_github(
+def iter_commit_data_from_github(
     github_token: str,
     commit_hashes: list[str],
-):
+    cache: operational_metrics_lib.GraphQLResponseCache | None = None,
+    max_workers: int = DEFAULT_GITHUB_API_WORKERS,
+) -> Iterator[dict[str, Any]]:
+  """Fetch GitHub API data for commits, in batches in the order of commits."""
   commit_subqueries = [
       COMMIT_GRAPHQL_SUBQUERY_TEMPLATE.format(
           commit_sha=commit_sha,
@@ -255,67 +536,279 @@ def fetch_commit_data_from_github(
       )
       for commit_sha in commit_hashes
   ]
-  return operational_metrics_lib.fetch_repository_data_from_github(
+  return operational_metrics_lib.iter_repository_data_from_github(
       github_token=github_token,
       subqueries=commit_subqueries,
+      max_workers=max_workers,
+      cache=cache,
   )
 
 
-def main() -> None:
+def upload_commits(
+    repo: git.Repo,
+    commit_shas: list[str],
+    sink: operational_metrics_lib.UploadSink,
+    github_token: str,
+    cache: operational_metrics_lib.GraphQLResponseCache,
+    github_api_workers: int = DEFAULT_GITHUB_API_WORKERS,
+) -> None:
+  """Upload the commits, pull requests and reviews of the given commits.
+
+  Args:
+    repo: The git repository the commits are in.
+    commit_shas: The hashes of the commits to upload.
+    sink: Where to upload the data to.
+    github_token: The GitHub API token to use for authentication.
+    cache: The cache of GitHub API responses to use.
+    github_api_workers: How many queries to the GitHub API to make
+      concurrently.
+  """
+  operational_metrics_lib.prefetch_diff_blobs(repo, commit_shas)
+
+  logging.info("Fetching GitHub API data for %d commits.", len(commit_shas))
+  with tempfile.TemporaryDirectory() as spool_directory:
+    # Spool the API data to disk as it arrives, so that the rows of every
+    # table can be parsed from it while they are uploaded, rather than held
+    # in memory.
+    api_data = operational_metrics_lib.RepositoryDataSpool(
+        os.path.join(spool_directory, "api_data.json")
+    )
+    api_data.extend(
+        iter_commit_data_from_github(
+            github_token, commit_shas, cache, github_api_workers
+        )
+    )
+    cache.log_stats()
+    commit_data = extract_commit_data(
+        extract_initial_commit_data(repo, commit_shas), api_data
+    )
+    pull_request_data = extract_pull_request_data(api_data)
+    review_data = extract_review_data(api_data)
+
+    logging.info("Uploading metrics.")
+    operational_metrics_lib.upload_tables(
+        sink,
+        [
+            [
+                operational_metrics_lib.TableUpload(
+                    LLVM_PULL_REQUESTS_TABLE,
+                    pull_request_data,
+                    "pull_request_number",
+                ),
+                operational_metrics_lib.TableUpload(
+                    LLVM_REVIEWS_TABLE, review_data, "review_id"
+                ),
+            ],
+            # Merge commits last, as they advance the watermark of processed
+            # commits.
+            [
+                operational_metrics_lib.TableUpload(
+                    LLVM_COMMITS_TABLE, commit_data, "commit_sha"
+                )
+            ],
+        ],
+    )
+
+
+def _read_backfill_state(state_path: str) -> dict[str, str] | None:
+  try:
+    with open(state_path) as state_file:
+      return json.load(state_file)
+  except FileNotFoundError:
+    return None
+
+
+def _write_backfill_state(state_path: str, state: dict[str, str]) -> None:
+  # Replace the state file atomically, so that a backfill interrupted while
+  # writing it can still be resumed.
+  with open(f"{state_path}.partial", "w") as state_file:
+    json.dump(state, state_file)
+  os.replace(f"{state_path}.partial", state_path)
+
+
+def backfill_commits(
+    repo: git.Repo,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    sink: operational_metrics_lib.UploadSink,
+    github_token: str,
+    cache: operational_metrics_lib.GraphQLResponseCache,
+    state_path: str = DEFAULT_BACKFILL_STATE_PATH,
+    chunk_commits: int = BACKFILL_CHUNK_COMMITS,
+    github_api_workers: int = DEFAULT_GITHUB_API_WORKERS,
+) -> None:
+  """Upload the data of all commits made within a range of dates.
+
+  Commits are uploaded oldest first, in chunks. The last uploaded commit is
+  saved to a state file after every chunk, and a backfill of the same range
+  of dates resumes after it. Delete the state file to start over.
+
+  Args:
+    repo: The git repository to scrape.
+    start_date: The first date to upload commits for.
+    end_date: The last date to upload commits for.
+    sink: Where to upload the data to.
+    github_token: The GitHub API token to use for authentication.
+    cache: The cache of GitHub API responses to use.
+    state_path: The file to save the progress of the backfill to.
+    chunk_commits: How many commits to upload at a time.
+    github_api_workers: How many queries to the GitHub API to make
+      concurrently.
+  """
+  commit_shas = scrape_commits_by_date_range(repo, start_date, end_date)
+  backfill_range = {
+      "start_date": start_date.isoformat(),
+      "end_date": end_date.isoformat(),
+  }
+  state = _read_backfill_state(state_path)
+  if state is not None and all(
+      state.get(key) == value for key, value in backfill_range.items()
+  ):
+    try:
+      resume_index = commit_shas.index(state["last_processed_commit_sha"]) + 1
+    except ValueError:
+      logging.warning(
+          "Commit %s of the saved backfill was not found, starting over.",
+          state["last_processed_commit_sha"],
+      )
+    else:
+      logging.info(
+          "Resuming backfill after %d of %d commits.",
+          resume_index,
+          len(commit_shas),
+      )
+      commit_shas = commit_shas[resume_index:]
+
+  start_time = time.monotonic()
+  for chunk_start in range(0, len(commit_shas), chunk_commits):
+    chunk_shas = commit_shas[chunk_start : chunk_start + chunk_commits]
+    upload_commits(
+        repo, chunk_shas, sink, github_token, cache, github_api_workers
+    )
+    _write_backfill_state(
+        state_path,
+        {**backfill_range, "last_processed_commit_sha": chunk_shas[-1]},
+    )
+    processed_commits = chunk_start + len(chunk_shas)
+    elapsed_seconds = time.monotonic() - start_time
+    logging.info(
+        "Backfilled %d of %d commits in %.1f seconds (%.1f commits per"
+        " second)",
+        processed_commits,
+        len(commit_shas),
+        elapsed_seconds,
+        processed_commits / elapsed_seconds if elapsed_seconds else 0,
+    )
+  logging.info("Backfill from %s to %s is complete.", start_date, end_date)
+
+
+def main(
+    sqlite_db_path: str | None = None,
+    backfill_dates: tuple[datetime.date, datetime.date] | None = None,
+    backfill_state_path: str = DEFAULT_BACKFILL_STATE_PATH,
+    github_api_workers: int = DEFAULT_GITHUB_API_WORKERS,
+) -> None:
   github_token = os.environ["GITHUB_TOKEN"]
 
   # Scrape new commits
   date_to_scrape = datetime.datetime.now(
       datetime.timezone.utc
   ) - datetime.timedelta(days=LOOKBACK_DAYS)
-  logging.info(
-      "Cloning and scraping llvm/llvm-project for new commits on %s",
-      date_to_scrape.strftime("%Y-%m-%d"),
-  )
+  if sqlite_db_path is None:
+    bq_client = bigquery.Client()
+    sink = operational_metrics_lib.BigQuerySink(
+        bq_client, OPERATIONAL_METRICS_DATASET
+    )
+  else:
+    bq_client = None
+    sink = operational_metrics_lib.SQLiteSink(sqlite_db_path)
+
+  try:
+    repo = operational_metrics_lib.open_repository_cache(
+        os.environ.get("LLVM_REPOSITORY_PATH", DEFAULT_REPOSITORY_PATH),
+        REPOSITORY_URL,
+    )
+    cache = operational_metrics_lib.GraphQLResponseCache(
+        os.environ.get("GITHUB_API_CACHE_PATH", DEFAULT_GITHUB_API_CACHE_PATH)
+    )
 
-  # Clone repository to current working directory
-  repo = git.Repo.clone_from(
-      url=REPOSITORY_URL,
-      to_path="./llvm-project",
-  )
+    if backfill_dates is not None:
+      backfill_commits(
+          repo,
+          *backfill_dates,
+          sink,
+          github_token,
+          cache,
+          state_path=backfill_state_path,
+          github_api_workers=github_api_workers,
+      )
+      return
+
+    # Local runs only scrape the commits of a single date.
+    last_processed_commit_sha = (
+        get_last_processed_commit(bq_client, repo) if bq_client else None
+    )
+    logging.info(
+        "Scraping llvm/llvm-project for new commits after %s up to %s",
+        last_processed_commit_sha,
+        date_to_scrape.strftime("%Y-%m-%d"),
+    )
+    if last_processed_commit_sha is None:
+      commits = scrape_commits_by_date(repo, date_to_scrape)
+    else:
+      commits = scrape_commits_after(
+          repo, last_processed_commit_sha, date_to_scrape
+      )
+    if not commits:
+      logging.info("No new commits found. Exiting.")
+      return
+    upload_commits(
+        repo,
+        [commit.hexsha for commit in commits],
+        sink,
+        github_token,
+        cache,
+        github_api_workers,
+    )
+  finally:
+    if bq_client is not None:
+      bq_client.close()
 
-  commits = scrape_commits_by_date(repo, date_to_scrape)
-  if not commits:
-    logging.info("No new commits found. Exiting.")
-    return
 
-  logging.info("Fetching GitHub API data for discovered commits.")
-  api_data = fetch_commit_data_from_github(github_token, commits)
-  commit_data = extract_commit_data(commits, api_data)
-  pull_request_data = extract_pull_request_data(api_data)
-  review_data = extract_review_data(api_data)
-
-  logging.info("Uploading metrics to BigQuery.")
-  bq_client = bigquery.Client()
-  operational_metrics_lib.upload_to_bigquery(
-      bq_client,
-      bq_dataset=OPERATIONAL_METRICS_DATASET,
-      bq_table=LLVM_COMMITS_TABLE,
-      llvm_data=commit_data,
-      primary_key="commit_sha",
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Upload metrics about new llvm-project commits."
   )
-  operational_metrics_lib.upload_to_bigquery(
-      bq_client,
-      bq_dataset=OPERATIONAL_METRICS_DATASET,
-      bq_table=LLVM_PULL_REQUESTS_TABLE,
-      llvm_data=pull_request_data,
-      primary_key="pull_request_number",
+  parser.add_argument(
+      "--sqlite-db",
+      help="Upload metrics to this SQLite database instead of BigQuery, to "
+      "run the pipeline locally.",
   )
-  operational_metrics_lib.upload_to_bigquery(
-      bq_client,
-      bq_dataset=OPERATIONAL_METRICS_DATASET,
-      bq_table=LLVM_REVIEWS_TABLE,
-      llvm_data=review_data,
-      primary_key="review_id",
+  parser.add_argument(
+      "--backfill",
+      nargs=2,
+      type=datetime.date.fromisoformat,
+      metavar=("START", "END"),
+      help="Upload all commits made from the START date to the END date, "
+      "inclusive, rather than only new commits.",
   )
-  bq_client.close()
-
-
-if __name__ == "__main__":
+  parser.add_argument(
+      "--backfill-state",
+      default=DEFAULT_BACKFILL_STATE_PATH,
+      help="The file to save the progress of backfills to. Backfills of the "
+      "same dates resume from it.",
+  )
+  parser.add_argument(
+      "--github-api-workers",
+      type=int,
+      default=DEFAULT_GITHUB_API_WORKERS,
+      help="How many queries to the GitHub API to make concurrently.",
+  )
+  args = parser.parse_args()
   logging.basicConfig(level=logging.INFO)
-  main()
+  main(
+      args.sqlite_db,
+      args.backfill,
+      args.backfill_state,
+      args.github_api_workers,
+  )
@@ -1,8 +1,13 @@
 import datetime
+import json
+import os
+import tempfile
 from typing import Any
 import unittest
 import unittest.mock
 
+import git
+import operational_metrics_lib
 import parameterized
 import process_llvm_commits
 import requests
@@ -10,22 +15,15 @@ import requests
 
 class TestProcessLLVMCommits(unittest.TestCase):
 
-  def _create_mock_commit(
-      self,
-      hexsha: str = 'abcdef',
-      message: str = 'Commit message.',
-      committed_date: int = 10000000,
-      stats: dict[str, dict[str, int]] | None = None,
-  ) -> unittest.mock.MagicMock:
-    """Creates a mock repository commit."""
-    commit = unittest.mock.MagicMock()
-    commit.hexsha = hexsha
-    commit.committed_date = committed_date
-    commit.stats.files = stats or {
-        'foo.c': {'insertions': 1, 'deletions': 2, 'lines': 3}
-    }
-    commit.message = message
-    return commit
+  def _create_initial_commit_data(
+      self, commit_sha: str = 'abcdef'
+  ) -> operational_metrics_lib.LLVMCommitData:
+    """Creates the commit data extracted from the repository."""
+    return operational_metrics_lib.LLVMCommitData(
+        commit_sha=commit_sha,
+        commit_timestamp_seconds=10000000,
+        diff=[{'file': 'foo.c', 'additions': 1, 'deletions': 2, 'total': 3}],
+    )
 
   def _create_mock_api_response(
       self, status_code: int = 200, payload: dict[str, Any] | None = None
@@ -33,6 +31,7 @@ class TestProcessLLVMCommits(unittest.TestCase):
     """Creates a mock API response."""
     response = requests.Response()
     response.status_code = status_code
+    response._content = json.dumps(payload if payload else {}).encode('utf-8')
     response.json = unittest.mock.MagicMock(
         return_value=payload if payload else {}
     )
@@ -182,49 +181,299 @@ class TestProcessLLVMCommits(unittest.TestCase):
     self.assertIn(commit_est, commits)
     self.assertNotIn(commit_pst, commits)
 
+  def _create_repo_with_commits(
+      self, repo_path: str, commit_datetimes: list[datetime.datetime]
+  ) -> tuple[git.Repo, list[str]]:
+    """Creates a repository with one commit on main per given date."""
+    repo = git.Repo.init(repo_path)
+    commit_hashes = []
+    for i, commit_datetime in enumerate(commit_datetimes):
+      commit = repo.index.commit(
+          f'Commit {i}',
+          author_date=commit_datetime,
+          commit_date=commit_datetime,
+      )
+      commit_hashes.append(commit.hexsha)
+    return repo, commit_hashes
+
+  def test_scrape_commits_after(self):
+    """Test scraping commits after the last processed commit."""
+    commit_datetimes = [
+        datetime.datetime(2023, 10, day, 12, tzinfo=datetime.timezone.utc)
+        for day in range(1, 6)
+    ]
+    with tempfile.TemporaryDirectory() as repo_path:
+      repo, commit_hashes = self._create_repo_with_commits(
+          repo_path, commit_datetimes
+      )
+
+      # Commits on every day after the last processed commit are scraped, up
+      # to the end of the target date.
+      commits = process_llvm_commits.scrape_commits_after(
+          repo, commit_hashes[0], commit_datetimes[3]
+      )
+      self.assertEqual(
+          [commit.hexsha for commit in commits], commit_hashes[3:0:-1]
+      )
+
+      # There is nothing to scrape until there are commits past the target.
+      commits = process_llvm_commits.scrape_commits_after(
+          repo, commit_hashes[3], commit_datetimes[3]
+      )
+      self.assertEqual(commits, [])
+
+      # Nothing is scraped when all commits are after the target date.
+      commits = process_llvm_commits.scrape_commits_after(
+          repo,
+          commit_hashes[0],
+          commit_datetimes[0] - datetime.timedelta(days=1),
+      )
+      self.assertEqual(commits, [])
+
+  def test_scrape_commits_by_date_range(self):
+    """Test scraping the commits of a range of dates, oldest first."""
+    commit_datetimes = [
+        datetime.datetime(2023, 10, day, 12, tzinfo=datetime.timezone.utc)
+        for day in range(1, 6)
+    ]
+    with tempfile.TemporaryDirectory() as repo_path:
+      repo, commit_hashes = self._create_repo_with_commits(
+          repo_path, commit_datetimes
+      )
+
+      commit_shas = process_llvm_commits.scrape_commits_by_date_range(
+          repo, datetime.date(2023, 10, 2), datetime.date(2023, 10, 4)
+      )
+    self.assertEqual(commit_shas, commit_hashes[1:4])
+
+  @unittest.mock.patch.object(process_llvm_commits, 'upload_commits')
+  def test_backfill_commits_resumes(self, mock_upload_commits):
+    """Test resuming an interrupted backfill after the last chunk uploaded."""
+    commit_datetimes = [
+        datetime.datetime(2023, 10, day, 12, tzinfo=datetime.timezone.utc)
+        for day in range(1, 8)
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+      repo, commit_hashes = self._create_repo_with_commits(
+          os.path.join(temp_dir, 'repo'), commit_datetimes
+      )
+      backfill_args = (
+          repo,
+          datetime.date(2023, 10, 2),
+          datetime.date(2023, 10, 6),
+          unittest.mock.MagicMock(),
+          'dummy_token',
+          unittest.mock.MagicMock(),
+      )
+      state_path = os.path.join(temp_dir, 'backfill_state.json')
+      mock_upload_commits.side_effect = [None, RuntimeError('interrupted')]
+
+      with self.assertRaises(RuntimeError):
+        process_llvm_commits.backfill_commits(
+            *backfill_args, state_path=state_path, chunk_commits=2
+        )
+      mock_upload_commits.side_effect = None
+      process_llvm_commits.backfill_commits(
+          *backfill_args, state_path=state_path, chunk_commits=2
+      )
+      with open(state_path) as state_file:
+        state = json.load(state_file)
+
+    self.assertEqual(
+        [call.args[1] for call in mock_upload_commits.call_args_list],
+        [
+            commit_hashes[1:3],
+            commit_hashes[3:5],
+            commit_hashes[3:5],
+            commit_hashes[5:6],
+        ],
+    )
+    self.assertEqual(
+        state,
+        {
+            'start_date': '2023-10-02',
+            'end_date': '2023-10-06',
+            'last_processed_commit_sha': commit_hashes[5],
+        },
+    )
+
+  def test_scrape_commits_by_date_bounds_walk(self):
+    """Test that scraping by date only walks commits on the target date."""
+    commit_datetimes = [
+        datetime.datetime(2023, 10, day, 12, tzinfo=datetime.timezone.utc)
+        for day in range(1, 4)
+    ]
+    with tempfile.TemporaryDirectory() as repo_path:
+      repo, commit_hashes = self._create_repo_with_commits(
+          repo_path, commit_datetimes
+      )
+
+      commits = process_llvm_commits.scrape_commits_by_date(
+          repo, commit_datetimes[1]
+      )
+
+    self.assertEqual([commit.hexsha for commit in commits], [commit_hashes[1]])
+
+  def test_get_last_processed_commit(self):
+    """Test getting the watermark of processed commits from BigQuery."""
+    # The second commit has the newest timestamp, but the third commit landed
+    # after it on main.
+    commit_datetimes = [
+        datetime.datetime(2023, 10, day, 12, tzinfo=datetime.timezone.utc)
+        for day in [1, 3, 2, 4]
+    ]
+    with tempfile.TemporaryDirectory() as repo_path:
+      repo, commit_hashes = self._create_repo_with_commits(
+          repo_path, commit_datetimes
+      )
+      mock_bq_client = unittest.mock.MagicMock()
+      mock_bq_client.query.return_value.result.return_value = [
+          unittest.mock.MagicMock(
+              commit_sha=commit_sha,
+              commit_timestamp_seconds=int(commit_datetime.timestamp()),
+          )
+          for commit_sha, commit_datetime in [
+              (commit_hashes[1], commit_datetimes[1]),
+              (commit_hashes[2], commit_datetimes[2]),
+              ('abcdef', commit_datetimes[3]),
+          ]
+      ]
+
+      self.assertEqual(
+          process_llvm_commits.get_last_processed_commit(mock_bq_client, repo),
+          commit_hashes[2],
+      )
+      executed_query = mock_bq_client.query.call_args.args[0]
+      self.assertIn('MAX(commit_timestamp_seconds)', executed_query)
+
+      # When none of the uploaded commits are on main, only the history from
+      # before the oldest of them is walked, rather than all of it.
+      mock_bq_client.query.return_value.result.return_value = [
+          unittest.mock.MagicMock(
+              commit_sha='abcdef',
+              commit_timestamp_seconds=int(
+                  datetime.datetime(
+                      2023, 10, 20, tzinfo=datetime.timezone.utc
+                  ).timestamp()
+              ),
+          )
+      ]
+      with unittest.mock.patch.object(
+          repo, 'iter_commits', wraps=repo.iter_commits
+      ) as mock_iter_commits:
+        with self.assertLogs(level='WARNING'):
+          self.assertIsNone(
+              process_llvm_commits.get_last_processed_commit(
+                  mock_bq_client, repo
+              )
+          )
+      self.assertEqual(
+          list(
+              repo.iter_commits(
+                  *mock_iter_commits.call_args.args,
+                  **mock_iter_commits.call_args.kwargs,
+              )
+          ),
+          [],
+      )
+
+      mock_bq_client.query.return_value.result.return_value = []
+      self.assertIsNone(
+          process_llvm_commits.get_last_processed_commit(mock_bq_client, repo)
+      )
+
+  def _commit_files(
+      self,
+      repo: git.Repo,
+      files: dict[str, bytes],
+      message: str,
+      commit_datetime: datetime.datetime,
+  ) -> str:
+    """Commits files with the given contents to a repository."""
+    for file_name, content in files.items():
+      file_path = os.path.join(repo.working_tree_dir, file_name)
+      os.makedirs(os.path.dirname(file_path), exist_ok=True)
+      with open(file_path, 'wb') as file:
+        file.write(content)
+    repo.index.add(list(files))
+    return repo.index.commit(
+        message, author_date=commit_datetime, commit_date=commit_datetime
+    ).hexsha
+
   def test_extract_initial_commit_data(self):
-    """Test that initial commit data is being extracted from scraped commits."""
-    commit = self._create_mock_commit(
-        hexsha='abcdef',
-        message='Change to foo.c',
-        committed_date=100,
-        stats={'foo.c': {'insertions': 1, 'deletions': 2, 'lines': 3}},
+    """Test extracting commit data from the repository in a single pass."""
+    commit_datetime = datetime.datetime(
+        2023, 10, 10, tzinfo=datetime.timezone.utc
     )
+    with tempfile.TemporaryDirectory() as repo_path:
+      repo = git.Repo.init(repo_path)
+      first_commit_sha = self._commit_files(
+          repo, {'foo.c': b'a\nb\n'}, 'Change to foo.c', commit_datetime
+      )
+      second_commit_sha = self._commit_files(
+          repo,
+          {
+              'foo.c': b'a\nc\nd\n',
+              'bar/with space\tand tab.c': b'bar\n',
+              'binary': b'\0\1',
+          },
+          'Revert "Foo" (#123)\nRevert llvm/llvm-project#123',
+          commit_datetime + datetime.timedelta(hours=1),
+      )
 
-    commit_data = process_llvm_commits.extract_initial_commit_data(commit)
+      commit_data = list(
+          process_llvm_commits.extract_initial_commit_data(
+              repo, [second_commit_sha, first_commit_sha]
+          )
+      )
 
-    self.assertEqual(commit_data.commit_sha, 'abcdef')
-    self.assertEqual(commit_data.commit_timestamp_seconds, 100)
     self.assertEqual(
-        commit_data.diff,
-        [{
-            'file': 'foo.c',
-            'additions': 1,
-            'deletions': 2,
-            'total': 3,
-        }],
-    )
-    self.assertFalse(commit_data.is_revert)
-    self.assertIsNone(commit_data.pull_request_reverted)
-    self.assertIsNone(commit_data.commit_reverted)
-
-  def test_extract_initial_commit_data_with_revert_data(self):
-    """Test that initial commit data includes revert data when present."""
-    commit = self._create_mock_commit(
-        hexsha='abcdef',
-        message='Revert "Foo" (#123)\nRevert llvm/llvm-project#123',
-        committed_date=100,
-        stats={'foo.c': {'insertions': 1, 'deletions': 2, 'lines': 3}},
-    )
-
-    commit_data = process_llvm_commits.extract_initial_commit_data(commit)
-
-    self.assertTrue(commit_data.is_revert)
-    self.assertEqual(commit_data.pull_request_reverted, 123)
-    self.assertIsNone(commit_data.commit_reverted)
-
-  @unittest.mock.patch.object(requests, 'post', autospec=True)
-  def test_fetch_commit_data_from_github(self, mock_post):
+        [commit.commit_sha for commit in commit_data],
+        [second_commit_sha, first_commit_sha],
+    )
+    self.assertEqual(
+        commit_data[1].commit_timestamp_seconds, commit_datetime.timestamp()
+    )
+    self.assertEqual(
+        commit_data[1].diff,
+        [{'file': 'foo.c', 'additions': 2, 'deletions': 0, 'total': 2}],
+    )
+    self.assertFalse(commit_data[1].is_revert)
+    self.assertIsNone(commit_data[1].pull_request_reverted)
+    self.assertIsNone(commit_data[1].commit_reverted)
+
+    self.assertCountEqual(
+        commit_data[0].diff,
+        [
+            {'file': 'foo.c', 'additions': 2, 'deletions': 1, 'total': 3},
+            {
+                'file': 'bar/with space\tand tab.c',
+                'additions': 1,
+                'deletions': 0,
+                'total': 1,
+            },
+            {'file': 'binary', 'additions': 0, 'deletions': 0, 'total': 0},
+        ],
+    )
+    self.assertTrue(commit_data[0].is_revert)
+    self.assertEqual(commit_data[0].pull_request_reverted, 123)
+    self.assertIsNone(commit_data[0].commit_reverted)
+
+  def test_extract_initial_commit_data_with_unknown_commit(self):
+    """Test that extracting data for commits not in the repository fails."""
+    with tempfile.TemporaryDirectory() as repo_path:
+      repo, _ = self._create_repo_with_commits(
+          repo_path,
+          [datetime.datetime(2023, 10, 10, tzinfo=datetime.timezone.utc)],
+      )
+
+      with self.assertRaises(git.GitCommandError):
+        list(
+            process_llvm_commits.extract_initial_commit_data(repo, ['0' * 40])
+        )
+
+  @unittest.mock.patch.object(requests.Session, 'post', autospec=True)
+  def test_iter_commit_data_from_github(self, mock_post):
     """Test fetching GitHub API data for a list of commits."""
     response_payload = {
         'data': {'repository': {'commit_abcdef': {}, 'commit_ghijkl': {}}}
@@ -233,20 +482,23 @@ class TestProcessLLVMCommits(unittest.TestCase):
         payload=response_payload
     )
 
-    api_data = process_llvm_commits.fetch_commit_data_from_github(
-        github_token='dummy_token',
-        commit_hashes=['abcdef', 'ghijkl'],
+    api_data = list(
+        process_llvm_commits.iter_commit_data_from_github(
+            github_token='dummy_token',
+            commit_hashes=['abcdef', 'ghijkl'],
+        )
     )
 
     _, mock_kwargs = mock_post.call_args
     mock_post.assert_called_once()
-    self.assertEqual(len(api_data), 2)
+    self.assertEqual(len(api_data), 1)
+    self.assertEqual(list(api_data[0]), ['commit_abcdef', 'commit_ghijkl'])
     self.assertIn('commit_abcdef', mock_kwargs['json']['query'])
     self.assertIn('commit_ghijkl', mock_kwargs['json']['query'])
 
   def test_extract_commit_data(self):
     """Test extracting commit data from scraped commits and GitHub API data."""
-    scraped_commit = self._create_mock_commit(hexsha='abcdef')
+    initial_commit_data = self._create_initial_commit_data('abcdef')
     pull_request_api_data = self._create_pull_request_api_data(
         pull_request_number=12345,
         pull_request_title='[TEST] Title',
@@ -258,8 +510,10 @@ class TestProcessLLVMCommits(unittest.TestCase):
         )
     }
 
-    commit_data = process_llvm_commits.extract_commit_data(
-        scraped_commits=[scraped_commit], api_data=commit_api_data
+    commit_data = list(
+        process_llvm_commits.extract_commit_data(
+            initial_commit_data=[initial_commit_data], api_data=commit_api_data
+        )
     )
 
     self.assertEqual(len(commit_data), 1)
@@ -270,17 +524,96 @@ class TestProcessLLVMCommits(unittest.TestCase):
   def test_extract_commit_data_with_missing_data(self):
     """Test extracting commit data from scraped commits and GitHub API data."""
     # Missing author and pull request data
-    scraped_commit = self._create_mock_commit(hexsha='abcdef')
+    initial_commit_data = self._create_initial_commit_data('abcdef')
     api_data = {'commit_abcdef': self._create_commit_api_data()}
 
     with self.assertLogs(level='WARNING'):
-      commit_data = process_llvm_commits.extract_commit_data(
-          scraped_commits=[scraped_commit], api_data=api_data
+      commit_data = list(
+          process_llvm_commits.extract_commit_data(
+              initial_commit_data=[initial_commit_data], api_data=api_data
+          )
       )
     self.assertEqual(len(commit_data), 1)
     self.assertIsNone(commit_data[0].associated_pull_request)
     self.assertIsNone(commit_data[0].commit_author)
 
+  def test_extract_commit_data_out_of_order(self):
+    """Test that commit data is only combined for the same commits."""
+    api_data = {
+        'commit_ghijkl': self._create_commit_api_data(),
+        'commit_abcdef': self._create_commit_api_data(),
+    }
+
+    with self.assertRaises(ValueError):
+      list(
+          process_llvm_commits.extract_commit_data(
+              initial_commit_data=[
+                  self._create_initial_commit_data('abcdef'),
+                  self._create_initial_commit_data('ghijkl'),
+              ],
+              api_data=api_data,
+          )
+      )
+
+  def test_extract_data_from_spooled_api_data(self):
+    """Test extracting each table from API data spooled to disk."""
+    pull_request_api_data = self._create_pull_request_api_data(
+        pull_request_number=12345,
+        pull_request_title='[TEST] Title',
+        pull_request_author='pr_author',
+        created_at='2020-01-01T00:00:00Z',
+        updated_at='2020-01-01T00:00:00Z',
+        reviews=[
+            self._create_review_api_data(
+                '2020-01-01T00:00:00Z', 'reviewer_1', 'APPROVED'
+            )
+        ],
+    )
+    with tempfile.TemporaryDirectory() as spool_directory:
+      api_data = operational_metrics_lib.RepositoryDataSpool(
+          os.path.join(spool_directory, 'api_data.json')
+      )
+      api_data.extend([
+          {
+              'commit_abcdef': self._create_commit_api_data(
+                  commit_author='commit_author',
+                  pull_request_data=pull_request_api_data,
+              )
+          },
+          {
+              'commit_ghijkl': self._create_commit_api_data(
+                  commit_author='commit_author',
+                  pull_request_data=pull_request_api_data,
+              )
+          },
+      ])
+
+      commit_data = list(
+          process_llvm_commits.extract_commit_data(
+              [
+                  self._create_initial_commit_data('abcdef'),
+                  self._create_initial_commit_data('ghijkl'),
+              ],
+              api_data,
+          )
+      )
+      pull_request_data = list(
+          process_llvm_commits.extract_pull_request_data(api_data)
+      )
+      review_data = list(process_llvm_commits.extract_review_data(api_data))
+
+    self.assertEqual(
+        [commit.associated_pull_request for commit in commit_data],
+        [12345, 12345],
+    )
+    self.assertEqual(len(pull_request_data), 1)
+    self.assertEqual(
+        pull_request_data[0].associated_commits, ['abcdef', 'ghijkl']
+    )
+    self.assertEqual(
+        {review.review_author for review in review_data}, {'reviewer_1'}
+    )
+
   def test_extract_pull_request_data(self):
     """Test extracting pull request data from GitHub API data."""
     created_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
@@ -303,8 +636,8 @@ class TestProcessLLVMCommits(unittest.TestCase):
         )
     }
 
-    pull_request_data = process_llvm_commits.extract_pull_request_data(
-        commit_api_data
+    pull_request_data = list(
+        process_llvm_commits.extract_pull_request_data(commit_api_data)
     )
 
     self.assertEqual(len(pull_request_data), 1)
@@ -350,8 +683,8 @@ class TestProcessLLVMCommits(unittest.TestCase):
         ),
     }
 
-    pull_request_data = process_llvm_commits.extract_pull_request_data(
-        commit_api_data
+    pull_request_data = list(
+        process_llvm_commits.extract_pull_request_data(commit_api_data)
     )
 
     self.assertEqual(len(pull_request_data), 1)
@@ -377,8 +710,8 @@ class TestProcessLLVMCommits(unittest.TestCase):
     }
 
     with self.assertLogs(level='WARNING'):
-      pull_request_data = process_llvm_commits.extract_pull_request_data(
-          commit_api_data
+      pull_request_data = list(
+          process_llvm_commits.extract_pull_request_data(commit_api_data)
       )
 
     self.assertEqual(len(pull_request_data), 1)
@@ -404,7 +737,7 @@ class TestProcessLLVMCommits(unittest.TestCase):
         )
     }
 
-    review_data = process_llvm_commits.extract_review_data(commit_data)
+    review_data = list(process_llvm_commits.extract_review_data(commit_data))
 
     self.assertEqual(len(review_data), 1)
     self.assertNotIn(
@@ -439,7 +772,9 @@ class TestProcessLLVMCommits(unittest.TestCase):
     }
 
     with self.assertLogs(level='WARNING'):
-      review_data = process_llvm_commits.extract_review_data(commit_data)
+      review_data = list(
+          process_llvm_commits.extract_review_data(commit_data)
+      )
     self.assertEqual(len(review_data), 1)
     self.assertIsNone(review_data[0].review_author)
 
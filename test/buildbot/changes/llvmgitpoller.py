@@ -0,0 +1,68 @@
+# RUN: python %s
+
+# Lit Regression Tests for parsing the commit details read by LLVMPoller.
+
+from zorg.buildbot.changes.llvmgitpoller import parse_commit_log
+
+# Output of 'git log --no-walk=unsorted -m --first-parent --name-only -z' with
+# COMMIT_LOG_FORMAT for a root commit, a commit with a multi-line message, an
+# empty commit, a regular commit and a merge of a side branch adding c.cpp.
+REV_LIST = [
+    '20aa9ebe70f8b61de874cf4a2922a26a6b0d7bd6',
+    '2e65712d92379e9cb7773b057dede668d0dec676',
+    'c4fcd222a8cc68e4b6ac5943c99061072fd13b22',
+    'a1dfac444eb37a6cfd70e69751e265abbc11c015',
+    'abb4b467afc53441e5c626c3f9678926dfb91a85',
+]
+GIT_LOG_OUTPUT = (
+    '20aa9ebe70f8b61de874cf4a2922a26a6b0d7bd6\x001700000000\x00'
+    'Jane Doe <jane@example.com>\x00John Roe <john@example.com>\x00'
+    'Add a and b\n\x00\x00\nclang/lib/b.cpp\x00llvm/lib/a.cpp\x00'
+    '2e65712d92379e9cb7773b057dede668d0dec676\x001700000100\x00'
+    'Jane Doe <jane@example.com>\x00John Roe <john@example.com>\x00'
+    'Change a\nThis is the body of the message.\nIt has several lines.\n'
+    '\x00\x00\nllvm/lib/a.cpp\x00'
+    'c4fcd222a8cc68e4b6ac5943c99061072fd13b22\x001700000200\x00'
+    'Jane Doe <jane@example.com>\x00John Roe <john@example.com>\x00'
+    'Empty commit\n\x00\x00'
+    'a1dfac444eb37a6cfd70e69751e265abbc11c015\x001700000350\x00'
+    'Jane Doe <jane@example.com>\x00John Roe <john@example.com>\x00'
+    'Add d\n\x00\x00\nllvm/lib/d.cpp\x00'
+    'abb4b467afc53441e5c626c3f9678926dfb91a85\x001700000400\x00'
+    'Jane Doe <jane@example.com>\x00John Roe <john@example.com>\x00'
+    'Merge side\n\x00\x00\nclang/lib/c.cpp\x00'
+)
+
+AUTHOR = 'Jane Doe <jane@example.com>'
+COMMITTER = 'John Roe <john@example.com>'
+
+commits = list(parse_commit_log(GIT_LOG_OUTPUT, REV_LIST))
+print("parsed commits: {}\n".format(commits))
+
+assert commits == [
+    (REV_LIST[0], 1700000000, AUTHOR, COMMITTER,
+     ['clang/lib/b.cpp', 'llvm/lib/a.cpp'], 'Add a and b'),
+    (REV_LIST[1], 1700000100, AUTHOR, COMMITTER, ['llvm/lib/a.cpp'],
+     'Change a\nThis is the body of the message.\nIt has several lines.'),
+    (REV_LIST[2], 1700000200, AUTHOR, COMMITTER, [], 'Empty commit'),
+    (REV_LIST[3], 1700000350, AUTHOR, COMMITTER, ['llvm/lib/d.cpp'], 'Add d'),
+    # Merges list the files changed relative to their first parent.
+    (REV_LIST[4], 1700000400, AUTHOR, COMMITTER, ['clang/lib/c.cpp'],
+     'Merge side'),
+]
+
+# The details of a commit other than the one expected are an error, rather
+# than being attributed to the wrong commit.
+try:
+    list(parse_commit_log(GIT_LOG_OUTPUT, REV_LIST[1:]))
+    assert False, 'expected a commit hash mismatch'
+except EnvironmentError as e:
+    print("hash mismatch: {}\n".format(e))
+    assert REV_LIST[0] in str(e)
+
+# So is output that ends before the details of every commit were read.
+try:
+    list(parse_commit_log(GIT_LOG_OUTPUT, REV_LIST + ['0' * 40]))
+    assert False, 'expected missing commit details'
+except EnvironmentError as e:
+    print("missing details: {}\n".format(e))
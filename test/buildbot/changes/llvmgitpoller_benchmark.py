@@ -0,0 +1,124 @@
+# RUN: python %s --commits 100
+
+# Benchmark reading the details of new commits in LLVMPoller.
+#
+# This compares reading the details of a catch-up of commits with a single
+# git log over all of them, as LLVMPoller does, against running one git log
+# per field and commit, as buildbot's GitPoller does. The commits are taken
+# from a synthetic repository of a similar shape to llvm-project.
+#
+# The lit test runs a small benchmark to check that both ways of reading the
+# commit details agree.
+#
+# Example usage, from the root of the repository:
+#   PYTHONPATH=. python3 test/buildbot/changes/llvmgitpoller_benchmark.py \
+#     --commits 1000
+
+import argparse
+import random
+import subprocess
+import tempfile
+import time
+
+from zorg.buildbot.changes.llvmgitpoller import COMMIT_LOG_FORMAT
+from zorg.buildbot.changes.llvmgitpoller import parse_commit_log
+
+PROJECTS = ['llvm', 'clang', 'mlir', 'lld', 'libcxx', 'compiler-rt']
+
+def generate_repository(path, commitCount, filesPerCommit, mergeInterval):
+    """
+    Generates a repository with commits changing random files of random
+    projects, with a single git fast-import. Every mergeInterval-th commit
+    on main merges a commit made on a side branch.
+    """
+    rnd = random.Random(0)
+    subprocess.run(['git', 'init', '-q', path], check=True)
+    commands = []
+    timestamp = 1700000000
+
+    def add_commit(branch, mark, parents, message, minFiles=0):
+        author = 'Author {0} <author{0}@example.com>'.format(rnd.randrange(50))
+        commands.append(
+            'commit refs/heads/{0}\n'
+            'mark :{1}\n'
+            'author {2} {3} +0000\n'
+            'committer {2} {3} +0000\n'
+            'data {4}\n{5}'.format(branch, mark, author, timestamp,
+                                   len(message), message))
+        for verb, parent in zip(['from', 'merge'], parents):
+            commands.append('{} :{}\n'.format(verb, parent))
+        for _ in range(rnd.randrange(minFiles, filesPerCommit + 1)):
+            content = 'line {}\n'.format(rnd.random())
+            commands.append('M 100644 inline {}/lib/file_{}.cpp\ndata {}\n{}'.format(
+                rnd.choice(PROJECTS), rnd.randrange(1000), len(content), content))
+        commands.append('\n')
+
+    for index in range(1, commitCount + 1):
+        timestamp += rnd.randrange(60, 600)
+        parents = [index - 1] if index > 1 else []
+        if index > 1 and index % mergeInterval == 0:
+            # Branch off the previous commit on main and merge it back, so
+            # that the merge changes files relative to its first parent.
+            sideMark = commitCount + index
+            add_commit('side', sideMark, parents,
+                       'Side change {}\n'.format(index), minFiles=1)
+            parents.append(sideMark)
+        message = 'Change {}\n\nRequires clean build: {}\n'.format(
+            index, rnd.random() < 0.01)
+        add_commit('main', index, parents, message)
+    subprocess.run(['git', 'fast-import', '--quiet'], cwd=path,
+                   input=''.join(commands), text=True, check=True)
+
+def git_log(path, args):
+    return subprocess.run(['git', 'log'] + args, cwd=path, check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+def read_details_per_commit(path, revList):
+    """Reads the details of each commit the way GitPoller does."""
+    for rev in revList:
+        timestamp = int(git_log(path, ['--no-walk', '--format=%ct', rev, '--']))
+        author = git_log(path, ['--no-walk', '--format=%aN <%aE>', rev, '--'])
+        committer = git_log(path, ['--no-walk', '--format=%cN <%cE>', rev, '--'])
+        files = [f for f in git_log(
+            path, ['-m', '--name-only', '--no-walk', '--format=%n',
+                   '--first-parent', rev, '--']
+        ).splitlines() if f]
+        comments = git_log(path, ['--no-walk', '--format=%s%n%b', rev, '--'])
+        yield rev, timestamp, author, committer, files, comments
+
+def read_details_at_once(path, revList):
+    """Reads the details of all commits the way LLVMPoller does."""
+    output = git_log(path, ['--no-walk=unsorted', '-m', '--first-parent',
+                            '--name-only', '-z', '--format=' + COMMIT_LOG_FORMAT]
+                     + revList + ['--'])
+    return parse_commit_log(output, revList)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark reading the details of new commits.')
+    parser.add_argument('--commits', type=int, default=1000,
+                        help='The number of commits to catch up on.')
+    parser.add_argument('--files-per-commit', type=int, default=6,
+                        help='The maximum number of files changed by a commit.')
+    parser.add_argument('--merge-interval', type=int, default=50,
+                        help='Merge a side branch every this many commits.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        generate_repository(path, args.commits, args.files_per_commit,
+                            args.merge_interval)
+        revList = git_log(path, ['--reverse', '--format=%H', 'main']).split()
+
+        start = time.perf_counter()
+        perCommit = list(read_details_per_commit(path, revList))
+        perCommitSeconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        atOnce = list(read_details_at_once(path, revList))
+        atOnceSeconds = time.perf_counter() - start
+
+    assert perCommit == atOnce, 'the commit details differ'
+    print('{} commits:'.format(len(revList)))
+    print('  git log per field and commit: {:.3f}s ({} processes)'.format(
+        perCommitSeconds, 5 * len(revList)))
+    print('  single git log: {:.3f}s (1 process)'.format(atOnceSeconds))
@@ -9,6 +9,59 @@ from twisted.internet import defer
 from buildbot.util import bytes2unicode
 from buildbot.plugins import changes
 
+# Format of each commit in the output of 'git log -z', with the fields read by
+# the poller separated by NULs. The changed files follow the comments.
+COMMIT_LOG_FORMAT = '%H%x00%ct%x00%aN <%aE>%x00%cN <%cE>%x00%s%n%b%x00'
+
+def parse_commit_log(output, revList):
+    """
+    Parses the output of 'git log --no-walk=unsorted --name-only -z' with
+    COMMIT_LOG_FORMAT for the commits in revList, in order.
+
+    Yields a (rev, timestamp, author, committer, files, comments) tuple for
+    each commit as it is parsed. The timestamp is the commit timestamp in
+    seconds since the epoch.
+    """
+    pos = 0
+    for index, rev in enumerate(revList):
+        fields = []
+        for _ in range(5):
+            end = output.find('\0', pos)
+            if end < 0:
+                raise EnvironmentError(
+                    'could not get commit details for rev {}'.format(rev))
+            fields.append(output[pos:end])
+            pos = end + 1
+        commitRev, timestamp, author, committer, comments = fields
+        if commitRev != rev:
+            raise EnvironmentError(
+                'expected commit details for rev {}, got {}'.format(
+                    rev, commitRev))
+        author = author.strip()
+        if not author:
+            raise EnvironmentError('could not get commit author for rev')
+        committer = committer.strip()
+        if not committer:
+            raise EnvironmentError('could not get commit committer for rev')
+
+        # The file names are NUL terminated and follow an empty field. The
+        # hash of the next commit, if there is one, follows the last of them.
+        nextRev = revList[index + 1] if index + 1 < len(revList) else None
+        files = []
+        while pos < len(output):
+            end = output.find('\0', pos)
+            if end < 0:
+                end = len(output)
+            field = output[pos:end]
+            if field == nextRev:
+                break
+            pos = end + 1
+            field = field.lstrip('\n')
+            if field:
+                files.append(field)
+
+        yield rev, int(timestamp), author, committer, files, comments.strip()
+
 class LLVMPoller(changes.GitPoller):
     """
     Poll LLVM repository for changes and submit them for builds scheduling.
@@ -82,6 +135,27 @@ class LLVMPoller(changes.GitPoller):
         log.msg("LLVMPoller: _transform_path: result: %s" % result)
         return [(k, result[k]) for k in result]
 
+    def _get_commits_details(self, revList):
+        """
+        Reads the timestamp, author, committer, changed files and comments of
+        all the commits in revList with a single git log, rather than one git
+        process per field and commit.
+
+        Returns a Deferred firing with an iterator over the details of each
+        commit, in the order of revList, as returned by parse_commit_log.
+        """
+        # -m --first-parent lists the files a merge commit changed relative
+        # to its first parent, rather than none.
+        args = (['--no-walk=unsorted', '-m', '--first-parent', '--name-only',
+                 '-z', '--format=' + COMMIT_LOG_FORMAT] + revList + ['--'])
+        d = self._dovccmd('log', args, path=self.workdir)
+
+        @d.addCallback
+        def process(git_output):
+            return parse_commit_log(git_output, revList)
+
+        return d
+
     @defer.inlineCallbacks
     def _process_changes(self, newRev, branch):
         """
@@ -130,29 +204,20 @@ class LLVMPoller(changes.GitPoller):
             log.msg('LLVMPoller: processing {} changes: {} from "{}" branch "{}"'.format(
                     self.changeCount, revList, self.repourl, branch))
 
-        for rev in revList:
-            dl = defer.DeferredList([
-                self._get_commit_timestamp(rev),
-                self._get_commit_author(rev),
-                self._get_commit_committer(rev),
-                self._get_commit_files(rev),
-                self._get_commit_comments(rev),
-            ], consumeErrors=True)
-
-            results = yield dl
-
-            # check for failures
-            failures = [r[1] for r in results if not r[0]]
-            if failures:
-                for failure in failures:
-                    log.err(
-                        failure, "while processing changes for {} {}".format(newRev, branch))
-                # just fail on the first error; they're probably all related!
-                failures[0].raiseException()
+        if not revList:
+            return
+
+        try:
+            commits = yield self._get_commits_details(revList)
+        except Exception:
+            log.err(None, "while processing changes for {} {}".format(newRev, branch))
+            raise
 
+        for rev, timestamp, author, committer, files, comments in commits:
             log.msg('>>> LLVMPoller: begin change adding cycle for revision: %s' % rev)
 
-            timestamp, author, committer, files, comments = [r[1] for r in results]
+            if not self.usetimestamps:
+                timestamp = None
 
             where = self._transform_path(files)
 